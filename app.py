@@ -1,11 +1,24 @@
 import os
 import json
+import base64
+import hashlib
+import io
+import time
+import atexit
+import queue
+import threading
 import traceback
 import re
+import uuid
+import gzip
+from collections import OrderedDict
 from datetime import datetime
 from typing import Any
 
+import click
 from flask import Flask, request, jsonify, render_template, Response
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import http_date
 
 # defensive imports
 try:
@@ -18,11 +31,41 @@ try:
 except Exception:
     ObjectId = None
 
+try:
+    from pymongo import UpdateOne
+except Exception:
+    UpdateOne = None
+
 try:
     import redis
 except Exception:
     redis = None
 
+try:
+    import qrcode
+except Exception:
+    qrcode = None
+
+try:
+    import gevent
+except Exception:
+    gevent = None
+
+try:
+    from pymongo.errors import ConnectionFailure as MongoConnectionFailure
+except Exception:
+    MongoConnectionFailure = None
+
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+try:
+    import brotli
+except Exception:
+    brotli = None
+
 # safe int parser
 def safe_int(v, default):
     try:
@@ -32,11 +75,510 @@ def safe_int(v, default):
     except Exception:
         return default
 
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ``ttl`` seconds."""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, ttl: float = None):
+        expires = time.monotonic() + (self.ttl if ttl is None else float(ttl))
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None:
+                self.invalidations += 1
+            return item[1] if item else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {'size': len(self._data), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses,
+                    'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
+
+class PubSubHub:
+    """One redis subscription per process, fanned out to per-client bounded queues.
+
+    ``get_client`` is called on every (re)connect so the hub keeps working
+    across redis outages. Slow consumers lose their oldest messages instead
+    of growing without bound. The subscription is polled with
+    ``get_message(timeout=...)`` rather than ``listen()``: the shared pool
+    has a socket read timeout, and a quiet channel is not a disconnect.
+    """
+
+    poll_timeout = 1.0
+
+    def __init__(self, get_client, channel: str, queue_size: int = 100):
+        self.get_client = get_client
+        self.channel = channel
+        self.queue_size = max(1, int(queue_size))
+        self._subs = {}
+        self._lock = threading.Lock()
+        self._listener = None
+        self.connected = False
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, user_id: str = None, typ: str = None):
+        sub = {'queue': queue.Queue(maxsize=self.queue_size),
+               'user_id': str(user_id) if user_id else None,
+               'type': str(typ).lower() if typ else None}
+        with self._lock:
+            self._subs[id(sub)] = sub
+        self._ensure_listener()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subs.pop(id(sub), None)
+
+    def _ensure_listener(self):
+        if self._listener is not None and self._listener.is_alive():
+            return
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen_loop, name=f'pubsub-hub-{self.channel}', daemon=True)
+                self._listener.start()
+
+    def _listen_loop(self):
+        backoff = 1
+        while True:
+            client = None
+            pubsub = None
+            try:
+                client = self.get_client()
+                if client is None:
+                    time.sleep(5)
+                    continue
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                self.connected = True
+                backoff = 1
+                while True:
+                    message = pubsub.get_message(timeout=self.poll_timeout)
+                    if message and message.get('type') == 'message':
+                        self.dispatch(message.get('data'))
+            except Exception as ex:
+                print(f"[pubsub_hub][{self.channel}] listener error: {ex}", flush=True)
+            finally:
+                self.connected = False
+                try:
+                    if pubsub is not None:
+                        pubsub.close()
+                except Exception:
+                    pass
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+    def dispatch(self, data):
+        try:
+            payload = json.loads(data) if isinstance(data, (str, bytes)) else (data or {})
+        except Exception:
+            payload = {}
+        if not isinstance(payload, dict):
+            payload = {}
+        msg_uid = str(payload.get('user_id') or '')
+        msg_type = str(payload.get('type') or '').lower()
+        with self._lock:
+            subs = list(self._subs.values())
+        self.published += 1
+        for sub in subs:
+            if sub['user_id'] and sub['user_id'] != msg_uid:
+                continue
+            if sub['type'] and sub['type'] != msg_type:
+                continue
+            q = sub['queue']
+            while True:
+                try:
+                    q.put_nowait(data)
+                    break
+                except queue.Full:
+                    try:
+                        q.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            n = len(self._subs)
+        return {'channel': self.channel, 'subscribers': n, 'connected': self.connected,
+                'published': self.published, 'dropped': self.dropped, 'queue_size': self.queue_size}
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of calling a backend whose circuit breaker is open."""
+
+class CircuitBreaker:
+    """Per-backend breaker: opens after ``threshold`` consecutive connection
+    failures, fails fast for ``reset_timeout`` seconds, then lets a single
+    trial call through (half-open) and closes again if it succeeds.
+
+    Only ``failure_types`` count as failures; any other exception means the
+    backend answered and counts as a success.
+    """
+
+    def __init__(self, name: str, failure_types=(), threshold: int = 5, reset_timeout: float = 10.0):
+        self.name = name
+        self.failure_types = tuple(t for t in failure_types if t)
+        self.threshold = max(1, int(threshold))
+        self.reset_timeout = float(reset_timeout)
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.rejected = 0
+        self.trips = 0
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self._trial = False
+            if self.state == 'half_open' and not self._trial:
+                self._trial = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial = False
+            self.state = 'closed'
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.state == 'half_open' or self.failures >= self.threshold:
+                if self.state != 'open':
+                    self.trips += 1
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def call(self, fn, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} circuit open")
+        self.calls += 1
+        try:
+            result = fn(*args, **kwargs)
+        except self.failure_types:
+            self.record_failure()
+            raise
+        except Exception:
+            self.record_success()
+            raise
+        self.record_success()
+        return result
+
+    @property
+    def healthy(self) -> bool:
+        return self.state == 'closed'
+
+    def stats(self) -> dict:
+        with self._lock:
+            retry_in = None
+            if self.state == 'open':
+                retry_in = round(max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at)), 1)
+            return {'state': self.state, 'failures': self.failures, 'calls': self.calls,
+                    'rejected': self.rejected, 'trips': self.trips, 'retry_in': retry_in}
+
+class _GuardedCursor:
+    """Cursor proxy that runs fetches through a breaker; chained calls keep the proxy."""
+
+    def __init__(self, cursor, breaker: CircuitBreaker):
+        self._cursor = cursor
+        self._breaker = breaker
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            res = self._breaker.call(attr, *args, **kwargs)
+            return self if res is self._cursor else res
+        return call
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._breaker.call(next, self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cursor.close()
+
+class GuardedCollection:
+    """Collection proxy: every server operation (and cursor fetch) goes through the backend's breaker.
+
+    Local helpers (with_options, attribute access, ...) pass straight
+    through, so they neither count as Mongo ops nor trip the breaker.
+    """
+
+    _CURSOR_METHODS = ('find', 'aggregate', 'list_indexes')
+    _IO_PREFIXES = ('find', 'update_', 'insert_', 'delete_', 'replace_')
+    _IO_METHODS = frozenset(('bulk_write', 'aggregate', 'aggregate_raw_batches', 'count_documents',
+                             'estimated_document_count', 'distinct', 'create_index', 'create_indexes',
+                             'drop_index', 'drop_indexes', 'list_indexes', 'index_information', 'watch',
+                             'drop', 'rename', 'options'))
+
+    def __init__(self, coll, breaker: CircuitBreaker):
+        self._coll = coll
+        self._breaker = breaker
+
+    def __getattr__(self, name):
+        attr = getattr(self._coll, name)
+        if not callable(attr) or not (name in self._IO_METHODS or name.startswith(self._IO_PREFIXES)):
+            return attr
+
+        def call(*args, **kwargs):
+            metrics.backend_op('mongo', name)
+            res = self._breaker.call(attr, *args, **kwargs)
+            if name in self._CURSOR_METHODS:
+                return _GuardedCursor(res, self._breaker)
+            return res
+        return call
+
+    def __getitem__(self, name):
+        return GuardedCollection(self._coll[name], self._breaker)
+
+    def __repr__(self):
+        return f"GuardedCollection({self._coll!r})"
+
+class Metrics:
+    """In-process counters and histograms, rendered in the Prometheus text format.
+
+    Requests are timed per route, and every redis command / mongo operation
+    is counted both globally and against the request being served, so a route
+    whose round trips grow with page size shows up in
+    keep_request_backend_roundtrips. Each gunicorn worker keeps its own
+    numbers; scrape them per worker or aggregate in the collector.
+    """
+
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    ROUNDTRIP_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250)
+    HELP = {
+        'keep_requests_total': ('counter', 'HTTP requests by route, method and status.'),
+        'keep_request_duration_seconds': ('histogram', 'Request latency by route.'),
+        'keep_request_backend_roundtrips': ('histogram', 'Backend round trips made while serving one request.'),
+        'keep_backend_ops_total': ('counter', 'Redis commands and mongo operations by backend and operation.'),
+        'keep_fallbacks_total': ('counter', 'Fallback paths taken, by reason.'),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counters = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _labels(labels: dict) -> tuple:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value=1, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = {'buckets': tuple(buckets), 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, le in enumerate(h['buckets']):
+                if value <= le:
+                    h['counts'][i] += 1
+                    break
+            h['sum'] += value
+            h['count'] += 1
+
+    def fallback(self, reason: str):
+        self.inc('keep_fallbacks_total', reason=reason)
+
+    # per-request round trips; threading.local is per greenlet under gevent
+    def start_request(self):
+        self._local.started = time.perf_counter()
+        self._local.ops = {'redis': 0, 'mongo': 0}
+
+    def end_request(self):
+        started = getattr(self._local, 'started', None)
+        ops = getattr(self._local, 'ops', None) or {}
+        self._local.started = self._local.ops = None
+        return (time.perf_counter() - started) if started is not None else None, ops
+
+    def bind(self, fn):
+        """Wrap fn so backend calls it makes on another greenlet count against the current request."""
+        ops = getattr(self._local, 'ops', None)
+
+        def run(*args, **kwargs):
+            self._local.ops = ops
+            return fn(*args, **kwargs)
+        return run
+
+    def backend_op(self, backend: str, op: str, commands: int = 1):
+        """One round trip to backend carrying `commands` operations (more than one for pipelines)."""
+        self.inc('keep_backend_ops_total', commands, backend=backend, op=op)
+        ops = getattr(self._local, 'ops', None)
+        if ops is not None:
+            ops[backend] = ops.get(backend, 0) + 1
+
+    @staticmethod
+    def _fmt(labels) -> str:
+        if not labels:
+            return ''
+        esc = lambda v: v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in labels) + '}'
+
+    def render(self, gauges=None) -> str:
+        """Prometheus exposition text; gauges maps name -> (help, [(labels dict, value)])."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: dict(v, counts=list(v['counts'])) for k, v in self._histograms.items()}
+        lines = []
+        for name, (kind, help_text) in self.HELP.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for (n, labels), value in sorted(counters.items()):
+                    if n == name:
+                        lines.append(f"{name}{self._fmt(labels)} {value}")
+                continue
+            for (n, labels), h in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for le, c in zip(h['buckets'], h['counts']):
+                    cumulative += c
+                    lines.append(f"{name}_bucket{self._fmt(labels + (('le', str(le)),))} {cumulative}")
+                lines.append(f"{name}_bucket{self._fmt(labels + (('le', '+Inf'),))} {h['count']}")
+                lines.append(f"{name}_sum{self._fmt(labels)} {h['sum']:.6f}")
+                lines.append(f"{name}_count{self._fmt(labels)} {h['count']}")
+        for name, (help_text, samples) in (gauges or {}).items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{self._fmt(self._labels(labels))} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def _drop_nulls(obj):
+    if isinstance(obj, dict):
+        return {k: _drop_nulls(v) for k, v in obj.items() if v is not None}
+    if isinstance(obj, (list, tuple)):
+        return [_drop_nulls(v) for v in obj]
+    return obj
+
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonify/request.get_json backed by orjson, falling back to the stdlib.
+
+    Mongo documents can be returned as they are: ObjectId becomes its hex
+    string and datetimes use the HTTP date format Flask has always used, in
+    the same pass as the rest of the encoding. Values neither encoder knows
+    are stringified rather than failing the response. Compact mode (env
+    JSON_COMPACT=1, or ?compact=1 on a request) drops null fields.
+    """
+
+    sort_keys = False
+    compact = os.getenv('JSON_COMPACT', '0') in ('1', 'true', 'yes')
+    _OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME) if orjson is not None else 0
+
+    @property
+    def name(self) -> str:
+        return 'orjson' if orjson is not None else 'json'
+
+    @staticmethod
+    def _default(o):
+        if ObjectId is not None and isinstance(o, ObjectId):
+            return str(o)
+        if isinstance(o, datetime):
+            return http_date(o)
+        try:
+            return DefaultJSONProvider.default(o)
+        except TypeError:
+            return str(o)
+
+    def _encode(self, obj) -> bytes:
+        if orjson is not None:
+            try:
+                return orjson.dumps(obj, default=self._default, option=self._OPTIONS)
+            except TypeError:
+                pass  # e.g. ints beyond 64 bits; the stdlib handles those
+        return json.dumps(obj, default=self._default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def dumps(self, obj, **kwargs) -> str:
+        if kwargs:
+            kwargs.setdefault('default', self._default)
+            return json.dumps(obj, **kwargs)
+        return self._encode(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+    def compact_requested(self) -> bool:
+        """Whether responses to the current request drop nulls. Routes that
+        set their own ETag fold this in, since the body differs."""
+        try:
+            return self.compact or request.args.get('compact') in ('1', 'true', 'yes')
+        except RuntimeError:
+            return self.compact
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if self.compact_requested():
+            obj = _drop_nulls(obj)
+        return self._app.response_class(self._encode(obj), mimetype=self.mimetype)
+
 # defaults (env override)
 DEFAULT_AVATAR = None
 DEFAULT_NAME = os.getenv('DEFAULT_NAME', 'Traveler')
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
+app.json = FastJSONProvider(app)
 _init_error = None
 
 try:
@@ -50,35 +592,72 @@ try:
     REDIS_PORT = safe_int(os.getenv('REDIS_PORT'), 13380)  
     REDIS_PASSWORD = os.getenv('REDIS_PASSWORD', "NRwYNwxwAjbyFxHDod1esj2hwsxugTiw")  
 
+    # Clients are built without any network round trip: pymongo and
+    # redis-py connect lazily on first use and reconnect on their own, so a
+    # cold start against an unreachable backend no longer stalls the worker
+    # and a backend that comes up later is picked up without a restart.
+    # Identical URIs share one MongoClient (and so one pool), and all redis
+    # users share one blocking pool, sized for many greenlets per worker.
+    MONGO_MAX_POOL_SIZE = safe_int(os.getenv('MONGO_MAX_POOL_SIZE'), 100)
+    MONGO_MIN_POOL_SIZE = safe_int(os.getenv('MONGO_MIN_POOL_SIZE'), 0)
+    MONGO_WAIT_QUEUE_TIMEOUT_MS = safe_int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS'), 5000)
+    MONGO_SERVER_SELECTION_MS = safe_int(os.getenv('MONGO_SERVER_SELECTION_MS'), 5000)
+    REDIS_MAX_CONNECTIONS = safe_int(os.getenv('REDIS_MAX_CONNECTIONS'), 50)
+    REDIS_POOL_TIMEOUT = safe_int(os.getenv('REDIS_POOL_TIMEOUT'), 5)
+    _mongo_clients = {}
+
     def safe_mongo(uri: str):
         if MongoClient is None or not uri:
             return None
+        client = _mongo_clients.get(uri)
+        if client is not None:
+            return client
         try:
-            client = MongoClient(uri, serverSelectionTimeoutMS=5000)
-            try:
-                client.admin.command('ping')
-            except Exception:
-                pass
+            client = MongoClient(uri, serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_MS,
+                                 maxPoolSize=MONGO_MAX_POOL_SIZE, minPoolSize=MONGO_MIN_POOL_SIZE,
+                                 waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS, connect=False)
+            _mongo_clients[uri] = client
             return client
-        except Exception:
+        except Exception as ex:
+            print(f"[safe_mongo] init failed: {ex}", flush=True)
             return None
 
+    # ---------- circuit breakers ----------
+    # One breaker per backend (redis, and each distinct MongoClient). The
+    # redis client and every collection handle run their calls through it,
+    # so when a backend keeps timing out the existing try/except fallbacks
+    # fail fast with CircuitOpenError instead of each waiting out the socket
+    # timeout; /api/top then serves the last good snapshot.
+    BREAKER_THRESHOLD = safe_int(os.getenv('BREAKER_THRESHOLD'), 5)
+    BREAKER_RESET_SECONDS = float(os.getenv('BREAKER_RESET_SECONDS', '10') or 10)
+    redis_breaker = CircuitBreaker('redis', (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) if redis else (),
+                                   threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET_SECONDS)
+    breakers = {'redis': redis_breaker}
+
+    if redis is not None:
+        class GuardedPipeline(redis.client.Pipeline):
+            def execute(self, raise_on_error=True):
+                if self.command_stack:
+                    metrics.backend_op('redis', 'PIPELINE', len(self.command_stack))
+                return redis_breaker.call(super().execute, raise_on_error)
+
+        class GuardedRedis(redis.Redis):
+            def execute_command(self, *args, **options):
+                metrics.backend_op('redis', str(args[0]).upper() if args else '?')
+                return redis_breaker.call(super().execute_command, *args, **options)
+
+            def pipeline(self, transaction=True, shard_hint=None):
+                return GuardedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
     def safe_redis(host: str, port: int, password: str):
         if redis is None or not host:
             return None
         try:
-            r = redis.Redis(host=host, port=port, password=password, decode_responses=True,
-                            socket_connect_timeout=5, socket_timeout=5)
-            try:
-                r.ping()
-                return r
-            except Exception as ex:
-                print(f"[safe_redis] ping failed: {ex}", flush=True)
-                try:
-                    r.close()
-                except Exception:
-                    pass
-                return None
+            pool = redis.BlockingConnectionPool(host=host, port=port, password=password or None, decode_responses=True,
+                                                socket_connect_timeout=5, socket_timeout=5,
+                                                max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT,
+                                                health_check_interval=30)
+            return GuardedRedis(connection_pool=pool)
         except Exception as ex:
             print(f"[safe_redis] init failed: {ex}", flush=True)
             return None
@@ -94,6 +673,72 @@ try:
 
     r = safe_redis(REDIS_HOST, REDIS_PORT, REDIS_PASSWORD)
 
+    _mongo_breakers = {}
+    _labels = {}
+    for _label, _client in (('market', market_client), ('waifu', waifu_client), ('husband', husband_client)):
+        if _client is not None:
+            _labels.setdefault(id(_client), []).append(_label)
+    for _cid, _names in _labels.items():
+        _mongo_breakers[_cid] = breakers['mongo_' + '_'.join(_names)] = CircuitBreaker(
+            'mongo_' + '_'.join(_names), (MongoConnectionFailure,), threshold=BREAKER_THRESHOLD,
+            reset_timeout=BREAKER_RESET_SECONDS)
+
+    def guard_collection(coll, client):
+        if coll is None or client is None or id(client) not in _mongo_breakers:
+            return coll
+        return GuardedCollection(coll, _mongo_breakers[id(client)])
+
+    def backends_degraded() -> bool:
+        return any(not b.healthy for b in breakers.values())
+
+    _health_cache = TTLCache(maxsize=1, ttl=float(os.getenv('HEALTH_CACHE_SECONDS', '2') or 2))
+
+    def backend_health(force: bool = False) -> dict:
+        """Ping redis and each distinct MongoClient; cached briefly so probes do not hammer the backends."""
+        cached = None if force else _health_cache.get('health')
+        if cached is not None:
+            return cached
+        out = {}
+        if r is not None:
+            t0 = time.perf_counter()
+            try:
+                r.ping()
+                out['redis'] = {'ok': True, 'latency_ms': round((time.perf_counter() - t0) * 1000, 1)}
+            except Exception as ex:
+                out['redis'] = {'ok': False, 'error': str(ex)}
+            try:
+                pool = r.connection_pool
+                created = len(getattr(pool, '_connections', None) or [])
+                if hasattr(pool, 'pool'):
+                    # BlockingConnectionPool: the queue holds one slot per allowed
+                    # connection (idle connections or None placeholders), so
+                    # whatever is missing from it is checked out
+                    in_use = pool.max_connections - pool.pool.qsize()
+                else:
+                    in_use = len(getattr(pool, '_in_use_connections', ()) or ())
+                out['redis']['pool'] = {'max': pool.max_connections, 'created': created, 'in_use': in_use}
+            except Exception:
+                pass
+        else:
+            out['redis'] = {'ok': False, 'error': 'not configured'}
+        names = {}
+        for name, client in (('market', market_client), ('waifu', waifu_client), ('husband', husband_client)):
+            if client is not None:
+                names.setdefault(id(client), (client, []))[1].append(name)
+        for client, labels in names.values():
+            t0 = time.perf_counter()
+            try:
+                client.admin.command('ping')
+                res = {'ok': True, 'latency_ms': round((time.perf_counter() - t0) * 1000, 1)}
+            except Exception as ex:
+                res = {'ok': False, 'error': str(ex)}
+            res['max_pool_size'] = MONGO_MAX_POOL_SIZE
+            out['mongo_' + '_'.join(labels)] = res
+        if not names:
+            out['mongo'] = {'ok': False, 'error': 'not configured'}
+        _health_cache.set('health', out)
+        return out
+
     def get_collection(client, dbname, collname):
         try:
             if client is None:
@@ -113,6 +758,10 @@ try:
     registered_users = None
     global_user_profiles_coll = None
     top_global_coll = None
+    market_coll = None
+    market_purchases_coll = None
+    friendships_coll = None
+    user_assets_coll = None
 
     if market_client is not None:
         try:
@@ -130,25 +779,26 @@ try:
             top_global_coll = market_client['Character_catcher']['top_global_db']
         except Exception:
             top_global_coll = None
+        try:
+            market_coll = market_client['Character_catcher'][os.getenv('MARKET_COLLECTION', 'market')]
+            market_purchases_coll = market_client['Character_catcher']['market_purchases']
+        except Exception:
+            market_coll = market_purchases_coll = None
+        try:
+            friendships_coll = market_client['Character_catcher']['friendships']
+            user_assets_coll = market_client['Character_catcher']['user_assets']
+        except Exception:
+            friendships_coll = user_assets_coll = None
 
-    def serialize_mongo(obj: Any):
-        if isinstance(obj, list):
-            return [serialize_mongo(i) for i in obj]
-        if isinstance(obj, dict):
-            out = {}
-            for k, v in obj.items():
-                try:
-                    if ObjectId is not None and isinstance(v, ObjectId):
-                        out[k] = str(v)
-                    else:
-                        out[k] = serialize_mongo(v)
-                except Exception:
-                    try:
-                        out[k] = str(v)
-                    except Exception:
-                        out[k] = None
-            return out
-        return obj
+    waifu_users_coll = guard_collection(waifu_users_coll, waifu_client)
+    husband_users_coll = guard_collection(husband_users_coll, husband_client)
+    registered_users = guard_collection(registered_users, market_client)
+    global_user_profiles_coll = guard_collection(global_user_profiles_coll, market_client)
+    top_global_coll = guard_collection(top_global_coll, market_client)
+    market_coll = guard_collection(market_coll, market_client)
+    market_purchases_coll = guard_collection(market_purchases_coll, market_client)
+    friendships_coll = guard_collection(friendships_coll, market_client)
+    user_assets_coll = guard_collection(user_assets_coll, market_client)
 
     def _try_many_fields_for_avatar(doc: Any):
         if not isinstance(doc, dict):
@@ -231,6 +881,7 @@ try:
                 except Exception as ex:
                     print(f"[get_charms][redis_error] {ex}", flush=True)
             if top_global_coll is not None:
+                metrics.fallback('charms_from_top_global')
                 try:
                     doc = top_global_coll.find_one({'user_id': str(uid)})
                     if doc and 'charms' in doc:
@@ -241,75 +892,436 @@ try:
         except Exception:
             return 0
 
-    def update_charms(uid: str, amt: int, typ: str = None) -> bool:
-        try:
-            if r is not None:
-                try:
-                    r.hincrby(f"user:{uid}", "charm", int(amt))
-                except Exception:
+    def get_charms_bulk(uids, mongo_fallback: bool = True) -> dict:
+        """get_charms for many uids: one redis pipeline plus one top_global $in query.
+
+        Users with no balance anywhere are left out of the result.
+        """
+        out = {}
+        uids = [str(u) for u in uids]
+        if not uids:
+            return out
+        if r is not None:
+            try:
+                pipe = r.pipeline(transaction=False)
+                for uid in uids:
+                    pipe.hgetall(f"user:{uid}")
+                    pipe.zscore('leaderboard:charms', uid)
+                res = pipe.execute(raise_on_error=False)
+                for i, uid in enumerate(uids):
+                    h, s = res[2 * i], res[2 * i + 1]
+                    h = h if isinstance(h, dict) else {}
+                    v = h.get('charm') or h.get('charms') or h.get('balance') or None
                     try:
-                        cur = int(r.hget(f"user:{uid}", "charm") or 0) + int(amt)
-                        r.hset(f"user:{uid}", "charm", str(cur))
+                        if v is not None:
+                            out[uid] = int(float(v))
+                            continue
                     except Exception:
                         pass
+                    if s is not None and not isinstance(s, Exception):
+                        out[uid] = int(float(s))
+            except Exception as ex:
+                print(f"[get_charms_bulk][redis_error] {ex}", flush=True)
+        missing = [u for u in uids if u not in out]
+        if mongo_fallback and missing and top_global_coll is not None:
+            metrics.fallback('charms_bulk_from_top_global')
+            try:
+                for doc in top_global_coll.find({'user_id': {'$in': missing}}, {'user_id': 1, 'charms': 1}):
+                    if 'charms' in doc:
+                        out[str(doc.get('user_id'))] = int(doc.get('charms') or 0)
+            except Exception as ex:
+                print(f"[get_charms_bulk][mongo_error] {ex}", flush=True)
+        return out
+
+    # ---------- charm ledger ----------
+    # Every balance change is appended, inside the same script that moves
+    # the charms, to a capped per-user stream (ledger:{uid}) and to a shared
+    # outbox stream. /api/history reads the user stream newest-first by entry
+    # id; a background archiver drains the outbox in batches into monthly
+    # charm_ledger_YYYYMM collections, which serve history older than what
+    # the capped stream still holds.
+    LEDGER_KEY = 'ledger:{}'
+    LEDGER_OUTBOX_KEY = 'ledger:outbox'
+    LEDGER_GROUP = 'ledger-archiver'
+    LEDGER_STREAM_MAXLEN = safe_int(os.getenv('LEDGER_STREAM_MAXLEN'), 500)
+    LEDGER_OUTBOX_MAXLEN = safe_int(os.getenv('LEDGER_OUTBOX_MAXLEN'), 1000000)
+    LEDGER_ARCHIVE_BATCH = safe_int(os.getenv('LEDGER_ARCHIVE_BATCH'), 500)
+    LEDGER_ARCHIVE_INTERVAL = float(os.getenv('LEDGER_ARCHIVE_INTERVAL', '2') or 2)
+    LEDGER_ARCHIVE_MONTHS = safe_int(os.getenv('LEDGER_ARCHIVE_MONTHS'), 24)
+    HISTORY_PAGE_DEFAULT = safe_int(os.getenv('HISTORY_PAGE_DEFAULT'), 20)
+    HISTORY_PAGE_MAX = safe_int(os.getenv('HISTORY_PAGE_MAX'), 100)
+    _ledger_stats = {'archived': 0, 'batches': 0, 'errors': 0, 'last_archive': None}
+    _ledger_archiver = None
+    _ledger_partitions = TTLCache(maxsize=1, ttl=60)
+    _ledger_indexed = set()
+
+    # Prepended to every script that moves charms; XADD with '*' needs effect
+    # replication, which is the default from redis 5 on.
+    LEDGER_APPEND_LUA = """
+pcall(redis.replicate_commands)
+local function ledger_append(stream, outbox, uid, amount, balance, typ, title, ref, maxlen, outbox_maxlen)
+    local id = redis.call('XADD', stream, 'MAXLEN', '~', maxlen, '*',
+        'amount', amount, 'balance', balance, 'type', typ, 'title', title, 'ref', ref)
+    redis.call('XADD', outbox, 'MAXLEN', '~', outbox_maxlen, '*', 'user_id', uid, 'id', id,
+        'amount', amount, 'balance', balance, 'type', typ, 'title', title, 'ref', ref)
+    return id
+end
+"""
+
+    def ledger_title(amt: int, title: str = None) -> str:
+        if title:
+            return str(title)[:120]
+        return 'Received charms' if int(amt) >= 0 else 'Spent charms'
+
+    def _ledger_entry(entry_id: str, fields: dict) -> dict:
+        ms = safe_int(str(entry_id).split('-')[0], 0)
+        return {
+            'id': entry_id,
+            'title': fields.get('title') or '-',
+            'amount': safe_int(fields.get('amount'), 0),
+            'balance': safe_int(fields.get('balance'), 0),
+            'type': fields.get('type') or None,
+            'ref': fields.get('ref') or None,
+            'ts': datetime.utcfromtimestamp(ms / 1000.0).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z',
+        }
+
+    def _ledger_partition(ms: int) -> str:
+        return 'charm_ledger_' + datetime.utcfromtimestamp(ms / 1000.0).strftime('%Y%m')
+
+    def _ledger_db():
+        return guard_collection(market_client['Character_catcher'], market_client) if market_client is not None else None
+
+    def archive_ledger_batch(entries) -> int:
+        """Upsert outbox entries [(outbox_id, fields)] into their monthly partitions. Idempotent per entry id."""
+        db = _ledger_db()
+        if db is None or UpdateOne is None:
+            return 0
+        by_part = {}
+        for _oid, f in entries:
+            uid_s, entry_id = f.get('user_id'), f.get('id')
+            if not uid_s or not entry_id:
+                continue
+            ms, _, seq = str(entry_id).partition('-')
+            ms, seq = safe_int(ms, 0), safe_int(seq, 0)
+            doc = {'user_id': uid_s, 'ms': ms, 'seq': seq, 'amount': safe_int(f.get('amount'), 0),
+                   'balance': safe_int(f.get('balance'), 0), 'type': f.get('type') or None,
+                   'title': f.get('title') or None, 'ref': f.get('ref') or None,
+                   'created_at': datetime.utcfromtimestamp(ms / 1000.0)}
+            by_part.setdefault(_ledger_partition(ms), []).append(
+                UpdateOne({'_id': f"{uid_s}:{entry_id}"}, {'$setOnInsert': doc}, upsert=True))
+        n = 0
+        for part, ops in by_part.items():
+            coll = db[part]
+            if part not in _ledger_indexed:
                 try:
-                    cur2 = int(r.hget(f"user:{uid}", "charm") or 0)
-                    r.hset(f"user:{uid}", "charms", str(cur2))
-                except Exception:
-                    pass
+                    coll.create_index([('user_id', 1), ('ms', -1), ('seq', -1)], name='user_id_ms_seq', background=True)
+                except Exception as ex:
+                    print(f"[ledger][index_error] coll={part} err={ex}", flush=True)
+                _ledger_indexed.add(part)
+            coll.bulk_write(ops, ordered=False)
+            n += len(ops)
+        _ledger_partitions.clear()
+        return n
+
+    def _ledger_archive_loop():
+        consumer = f"{os.getenv('HOSTNAME', 'local')}-{os.getpid()}"
+        try:
+            r.xgroup_create(LEDGER_OUTBOX_KEY, LEDGER_GROUP, id='0', mkstream=True)
+        except Exception as ex:
+            if 'BUSYGROUP' not in str(ex):
+                print(f"[ledger][group_error] {ex}", flush=True)
+        # entries this consumer read but never acked (previous run with the same name)
+        start = '0'
+        while True:
+            try:
+                entries = []
                 try:
-                    current = get_charms(uid)
-                    r.zadd('leaderboard:charms', {str(uid): int(current)})
-                    if typ and str(typ).lower() in ('waifu', 'husband'):
-                        r.zadd(f'leaderboard:charms:{typ}', {str(uid): int(current)})
+                    # pick up work left pending by a worker that died mid-batch
+                    claimed = r.xautoclaim(LEDGER_OUTBOX_KEY, LEDGER_GROUP, consumer, min_idle_time=300000,
+                                           count=LEDGER_ARCHIVE_BATCH)
+                    entries.extend(claimed[1] or [])
                 except Exception:
                     pass
+                resp = r.xreadgroup(LEDGER_GROUP, consumer, {LEDGER_OUTBOX_KEY: start}, count=LEDGER_ARCHIVE_BATCH)
+                for _stream, items in resp or []:
+                    entries.extend(items)
+                if start == '0' and not (resp and resp[0][1]):
+                    start = '>'
+                entries = [(oid, f) for oid, f in entries if f]
+                if entries:
+                    n = archive_ledger_batch(entries)
+                    ids = [oid for oid, _f in entries]
+                    r.xack(LEDGER_OUTBOX_KEY, LEDGER_GROUP, *ids)
+                    r.xdel(LEDGER_OUTBOX_KEY, *ids)
+                    _ledger_stats['archived'] += n
+                    _ledger_stats['batches'] += 1
+                    _ledger_stats['last_archive'] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+                if len(entries) >= LEDGER_ARCHIVE_BATCH:
+                    continue
+            except Exception as ex:
+                _ledger_stats['errors'] += 1
+                print(f"[ledger][archive_error] {ex}", flush=True)
+            time.sleep(LEDGER_ARCHIVE_INTERVAL)
+
+    def _ensure_ledger_archiver():
+        global _ledger_archiver
+        if r is None or market_client is None or (_ledger_archiver is not None and _ledger_archiver.is_alive()):
+            return
+        with _wb_lock:
+            if _ledger_archiver is None or not _ledger_archiver.is_alive():
+                _ledger_archiver = threading.Thread(target=_ledger_archive_loop, name='ledger-archiver', daemon=True)
+                _ledger_archiver.start()
+
+    def _ledger_args(uid_s: str, title: str, ref: str = None):
+        return ([LEDGER_KEY.format(uid_s), LEDGER_OUTBOX_KEY],
+                [title, ref or '', LEDGER_STREAM_MAXLEN, LEDGER_OUTBOX_MAXLEN])
+
+    def _parse_history_cursor(cursor: str):
+        if not cursor:
+            return None
+        if not re.fullmatch(r'\d+-\d+', str(cursor)):
+            raise ValueError('cursor must be a ledger entry id')
+        ms, seq = str(cursor).split('-')
+        return int(ms), int(seq)
+
+    def _archived_history(uid_s: str, before, limit: int):
+        db = _ledger_db()
+        if db is None or limit <= 0:
+            return []
+        parts = _ledger_partitions.get('names')
+        if parts is None:
+            parts = sorted((n for n in db.list_collection_names() if n.startswith('charm_ledger_')), reverse=True)
+            _ledger_partitions.set('names', parts)
+        q = {'user_id': uid_s}
+        if before is not None:
+            ms, seq = before
+            q['$or'] = [{'ms': {'$lt': ms}}, {'ms': ms, 'seq': {'$lt': seq}}]
+            newest = _ledger_partition(ms)
+            parts = [pt for pt in parts if pt <= newest]
+        out = []
+        for part in parts[:LEDGER_ARCHIVE_MONTHS]:
+            for d in db[part].find(q).sort([('ms', -1), ('seq', -1)]).limit(limit - len(out)):
+                out.append(_ledger_entry(f"{d['ms']}-{d['seq']}", d))
+            if len(out) >= limit:
+                break
+        return out
+
+    def read_charm_history(uid: str, cursor: str = None, limit: int = None):
+        """Newest-first ledger page strictly older than cursor. Returns (items, next_cursor)."""
+        uid_s = str(uid)
+        limit = max(1, min(safe_int(limit, HISTORY_PAGE_DEFAULT), HISTORY_PAGE_MAX))
+        before = _parse_history_cursor(cursor)
+        items = []
+        trimmed = True
+        if r is not None:
+            _ensure_ledger_archiver()
+            key = LEDGER_KEY.format(uid_s)
+            pipe = r.pipeline(transaction=False)
+            pipe.xrevrange(key, max=cursor or '+', min='-', count=limit + 1)
+            pipe.xlen(key)
+            rows, length = pipe.execute()
+            items = [_ledger_entry(i, f) for i, f in rows if i != cursor][:limit]
+            # approximate trimming never cuts below MAXLEN, so a shorter stream is
+            # complete; an empty one may just have been lost, so check the archive
+            length = int(length or 0)
+            trimmed = length == 0 or length >= LEDGER_STREAM_MAXLEN
+        if len(items) < limit and trimmed:
+            older = _parse_history_cursor(items[-1]['id']) if items else before
+            items.extend(_archived_history(uid_s, older, limit - len(items)))
+        next_cursor = items[-1]['id'] if len(items) >= limit else None
+        return items, next_cursor
+
+    # Applies a balance delta in one round trip: increments `charm`, mirrors
+    # it into `charms`, updates the global (and typed) leaderboard, appends
+    # the ledger entry and publishes the charms_updates event. Returns the
+    # new balance.
+    # KEYS: user hash, global board, typed board ('' for none), version counter, ledger stream, outbox
+    # ARGV: delta, user_id, type ('' for none), channel, title, ref, ledger maxlen, outbox maxlen
+    CHARM_DELTA_LUA = LEDGER_APPEND_LUA + """
+local v = redis.pcall('HINCRBY', KEYS[1], 'charm', ARGV[1])
+if type(v) == 'table' and v.err then
+    local cur = tonumber(redis.call('HGET', KEYS[1], 'charm')) or 0
+    v = math.floor(cur) + tonumber(ARGV[1])
+    redis.call('HSET', KEYS[1], 'charm', tostring(v))
+end
+redis.call('HSET', KEYS[1], 'charms', tostring(v))
+redis.call('ZADD', KEYS[2], v, ARGV[2])
+if KEYS[3] ~= '' then
+    redis.call('ZADD', KEYS[3], v, ARGV[2])
+end
+local typ = cjson.null
+if ARGV[3] ~= '' then typ = ARGV[3] end
+redis.call('INCR', KEYS[4])
+ledger_append(KEYS[5], KEYS[6], ARGV[2], ARGV[1], v, ARGV[3], ARGV[5], ARGV[6], ARGV[7], ARGV[8])
+redis.call('PUBLISH', ARGV[4], cjson.encode({user_id = ARGV[2], charms = v, type = typ}))
+return v
+"""
+    _charm_delta_script = None
+    if r is not None:
+        try:
+            _charm_delta_script = r.register_script(CHARM_DELTA_LUA)
+        except Exception as ex:
+            print(f"[update_charms] lua unavailable: {ex}", flush=True)
+
+    def _apply_charm_delta_multi(uid_s: str, amt: int, typ: str = None, title: str = None, ref: str = None) -> int:
+        """WATCH/MULTI fallback for servers where EVAL is not allowed."""
+        key = f"user:{uid_s}"
+        with r.pipeline(transaction=True) as pipe:
+            while True:
                 try:
-                    r.publish('charms_updates', json.dumps({"user_id": str(uid), "charms": get_charms(uid), "type": typ}))
-                except Exception:
-                    pass
-            else:
-                if top_global_coll is not None:
+                    pipe.watch(key)
                     try:
-                        top_global_coll.update_one({'user_id': str(uid)}, {'$inc': {'charms': int(amt)}, '$set': {'updated_at': datetime.utcnow()}}, upsert=True)
+                        cur = int(float(pipe.hget(key, 'charm') or 0))
                     except Exception:
-                        pass
-            if top_global_coll is not None:
-                try:
-                    top_global_coll.update_one({'user_id': str(uid)}, {'$set': {'charms': int(get_charms(uid)), 'updated_at': datetime.utcnow()}}, upsert=True)
-                except Exception:
-                    pass
+                        cur = 0
+                    v = cur + int(amt)
+                    fields = {'amount': int(amt), 'balance': v, 'type': typ or '', 'title': title, 'ref': ref or ''}
+                    pipe.multi()
+                    pipe.hset(key, mapping={'charm': str(v), 'charms': str(v)})
+                    pipe.zadd('leaderboard:charms', {uid_s: v})
+                    if typ:
+                        pipe.zadd(f'leaderboard:charms:{typ}', {uid_s: v})
+                    pipe.incr('leaderboard:version')
+                    pipe.xadd(LEDGER_KEY.format(uid_s), fields, maxlen=LEDGER_STREAM_MAXLEN, approximate=True)
+                    pipe.publish('charms_updates', json.dumps({"user_id": uid_s, "charms": v, "type": typ}))
+                    entry_id = pipe.execute()[-2]
+                    break
+                except redis.WatchError:
+                    continue
+        # the outbox copy needs the entry id, so it follows outside the transaction here
+        r.xadd(LEDGER_OUTBOX_KEY, dict(fields, user_id=uid_s, id=entry_id), maxlen=LEDGER_OUTBOX_MAXLEN, approximate=True)
+        return v
+
+    def apply_charm_delta(uid: str, amt: int, typ: str = None, title: str = None, ref: str = None):
+        """Atomically apply amt to uid's balance in redis and record it in the ledger.
+
+        Returns the new balance, or None without redis.
+        """
+        if r is None:
+            return None
+        uid_s = str(uid)
+        typ = str(typ).lower() if typ and str(typ).lower() in ('waifu', 'husband') else None
+        title = ledger_title(amt, title)
+        _ensure_ledger_archiver()
+        if _charm_delta_script is not None:
+            try:
+                lkeys, largs = _ledger_args(uid_s, title, ref)
+                v = _charm_delta_script(keys=[f"user:{uid_s}", 'leaderboard:charms', f'leaderboard:charms:{typ}' if typ else '',
+                                              'leaderboard:version'] + lkeys,
+                                        args=[int(amt), uid_s, typ or '', 'charms_updates'] + largs)
+                return int(v)
+            except redis.exceptions.ResponseError as ex:
+                print(f"[update_charms] lua failed, using MULTI: {ex}", flush=True)
+        return _apply_charm_delta_multi(uid_s, amt, typ, title, ref)
+
+    def update_charms(uid: str, amt: int, typ: str = None, title: str = None, ref: str = None) -> bool:
+        try:
+            if r is not None:
+                current = apply_charm_delta(uid, amt, typ, title=title, ref=ref)
+                # top_global_db follows asynchronously via the write-behind flush
+                queue_profile_write(str(uid), charms=current)
+            elif top_global_coll is not None:
+                top_global_coll.update_one({'user_id': str(uid)}, {'$inc': {'charms': int(amt)}, '$set': {'updated_at': datetime.utcnow()}}, upsert=True)
             return True
         except Exception as ex:
             print(f"[update_charms] err={ex}", flush=True)
             return False
 
-    def _find_doc_in_coll_variants(coll, uid_s):
+    # Order in which identifier variants win when several documents match.
+    UID_LOOKUP_ORDER = (('user_id', 'str'), ('id', 'str'), ('id', 'int'), ('user_id', 'int'), ('_id', 'str'))
+    # api_my_collection historically looked at `id` first and never at `_id`.
+    COLLECTION_LOOKUP_ORDER = (('id', 'str'), ('id', 'int'), ('user_id', 'str'), ('user_id', 'int'))
+
+    # Remembers which (field, type) matched a uid in a collection, so later
+    # lookups are a single indexed equality query instead of the $or.
+    UID_FIELD_CACHE_ENABLED = os.getenv('UID_FIELD_CACHE', '1') not in ('0', 'false', 'no')
+    uid_field_cache = TTLCache(maxsize=safe_int(os.getenv('UID_FIELD_CACHE_SIZE'), 50000),
+                               ttl=float(os.getenv('UID_FIELD_CACHE_TTL', '3600') or 3600))
+
+    def _uid_variants(uid_s, order):
+        out = []
+        for field, typ in order:
+            if typ == 'int':
+                if not uid_s.isdigit():
+                    continue
+                out.append((field, typ, int(uid_s)))
+            else:
+                out.append((field, typ, uid_s))
+        return out
+
+    def _find_doc_in_coll_variants(coll, uid_s, projection=None, order=UID_LOOKUP_ORDER):
         if coll is None:
             return None
+        uid_s = str(uid_s)
+        variants = _uid_variants(uid_s, order)
+        if not variants:
+            return None
+        if projection and any(v not in (0, False) for v in projection.values()):
+            # inclusion projections must still return the fields we match on
+            projection = dict(projection, **{field: 1 for field, _, _ in variants if field not in projection})
+        cache_key = None
         try:
-            doc = coll.find_one({'user_id': uid_s})
-            if doc:
-                return doc
-            doc = coll.find_one({'id': uid_s})
-            if doc:
-                return doc
-            if uid_s.isdigit():
-                try:
-                    doc = coll.find_one({'id': int(uid_s)}) or coll.find_one({'user_id': int(uid_s)})
+            if UID_FIELD_CACHE_ENABLED:
+                cache_key = (coll.full_name, uid_s)
+                hint = uid_field_cache.get(cache_key)
+                if hint is not None:
+                    field, value = hint
+                    doc = coll.find_one({field: value}, projection)
                     if doc:
                         return doc
-                except Exception:
-                    pass
-            try:
-                doc = coll.find_one({'_id': uid_s})
-                if doc:
-                    return doc
-            except Exception:
-                pass
-        except Exception:
+                    uid_field_cache.pop(cache_key)
+
+            best = None
+            best_rank = len(variants)
+            query = {'$or': [{field: value} for field, _, value in variants]}
+            for doc in coll.find(query, projection).limit(len(variants)):
+                for rank, (field, _, value) in enumerate(variants[:best_rank]):
+                    if doc.get(field) == value:
+                        best, best_rank = doc, rank
+                        break
+                if best_rank == 0:
+                    break
+            if best is not None and cache_key is not None:
+                field, _, value = variants[best_rank]
+                uid_field_cache.set(cache_key, (field, value))
+            return best
+        except Exception as ex:
+            print(f"[_find_doc_in_coll_variants][mongo_error] uid={uid_s} err={ex}", flush=True)
             return None
-        return None
+
+    def ensure_uid_indexes():
+        """Create the id/user_id indexes the identifier lookups rely on, where missing."""
+        report = {}
+        seen = set()
+        wanted = [(c, [[('user_id', 1)], [('id', 1)]]) for c in
+                  (registered_users, global_user_profiles_coll, waifu_users_coll, husband_users_coll)]
+        wanted.append((top_global_coll, [[('user_id', 1)], [('charms', -1)]]))
+        for coll, specs in wanted:
+            if coll is None:
+                continue
+            try:
+                name = coll.full_name
+                if name in seen:
+                    continue
+                seen.add(name)
+                existing = [list(ix.get('key') or []) for ix in coll.index_information().values()]
+                created = []
+                for keys in specs:
+                    if any(ex[:len(keys)] == keys for ex in existing):
+                        continue
+                    coll.create_index(keys)
+                    created.append(keys[0][0])
+                report[name] = {'ok': True, 'created': created}
+            except Exception as ex:
+                report[getattr(coll, 'full_name', str(coll))] = {'ok': False, 'error': str(ex)}
+                print(f"[ensure_uid_indexes] err={ex}", flush=True)
+        _uid_index_report.clear()
+        _uid_index_report.update(report)
+        return report
+
+    _uid_index_report = {}
+    if os.getenv('ENSURE_INDEXES', '1') not in ('0', 'false', 'no'):
+        threading.Thread(target=ensure_uid_indexes, name='ensure-uid-indexes', daemon=True).start()
 
     def _normalize_profile_doc(raw):
         if not isinstance(raw, dict):
@@ -333,7 +1345,64 @@ try:
         out['avatar'] = avatar
         return out
 
-    def upsert_top_global(uid: str, firstname: str = None, username: str = None, avatar: str = None):
+    def _usable_avatar(a):
+        if a and isinstance(a, str) and 'picsum.photos' not in a and not a.startswith('/static/'):
+            return a
+        return None
+
+    def _is_bad_registered(d):
+        if not isinstance(d, dict):
+            return True
+        fn = d.get('firstname') or d.get('first_name') or None
+        ph = d.get('photo_url') or d.get('avatar') or None
+        if not fn or fn == DEFAULT_NAME:
+            return True
+        if ph and isinstance(ph, str) and ('picsum.photos' in ph or ph.startswith('/static/')):
+            return True
+        return False
+
+    def _profile_from_registered(doc, first_name=None, username=None, avatar=None):
+        norm = _normalize_profile_doc(doc) or {}
+        if first_name:
+            norm['firstname'] = first_name
+        if username:
+            norm['username'] = username
+        if avatar:
+            norm['avatar'] = avatar
+            norm['photo_url'] = avatar
+        if not norm.get('firstname'):
+            norm['firstname'] = DEFAULT_NAME
+        if not norm.get('avatar'):
+            norm['avatar'] = None
+        return norm
+
+    def _choose_profile_candidate(uid_s, candidates, first_name=None, username=None, avatar=None):
+        chosen = None
+        for c in candidates:
+            n = _normalize_profile_doc(c)
+            if not n:
+                continue
+            if not chosen:
+                chosen = n
+                continue
+            if (n.get('avatar') and 'picsum.photos' not in str(n.get('avatar'))) and (not chosen.get('avatar') or 'picsum.photos' in str(chosen.get('avatar') or '')):
+                chosen = n
+            if n.get('firstname') and (not chosen.get('firstname') or chosen.get('firstname') == DEFAULT_NAME):
+                chosen = n
+
+        if not chosen:
+            chosen = {'user_id': uid_s, 'firstname': first_name or DEFAULT_NAME, 'username': username or None, 'photo_url': avatar or None, 'avatar': avatar or None}
+        else:
+            if first_name:
+                chosen['firstname'] = first_name
+            if username:
+                chosen['username'] = username
+            if avatar:
+                chosen['avatar'] = avatar
+                chosen['photo_url'] = avatar
+        return chosen
+
+    def upsert_top_global(uid: str, firstname: str = None, username: str = None, avatar: str = None):
         uid_s = str(uid)
         try:
             charms = get_charms(uid_s)
@@ -390,10 +1459,270 @@ try:
             except Exception as ex:
                 print(f"[upsert_top_global][mongo_error] uid={uid_s} err={ex}", flush=True)
 
+    # ---------- profile write-behind ----------
+    # ensure_user_profile runs on read endpoints, so it must not write on
+    # every call. Changed profiles are queued here, coalesced per user, and
+    # flushed in bulk by a background worker started on first use.
+    WRITE_BEHIND_INTERVAL = float(os.getenv('WRITE_BEHIND_INTERVAL', '2') or 2)
+    WRITE_BEHIND_BATCH = safe_int(os.getenv('WRITE_BEHIND_BATCH'), 500)
+    WRITE_BEHIND_SYNCED_MAX = safe_int(os.getenv('WRITE_BEHIND_SYNCED_MAX'), 50000)
+
+    _wb_lock = threading.Lock()
+    _wb_pending = {}
+    _wb_synced = {}
+    _wb_stats = {'queued': 0, 'coalesced': 0, 'skipped': 0, 'flushed': 0, 'errors': 0, 'retried': 0}
+    _wb_worker = None
+
+    def queue_profile_write(uid: str, registered: dict = None, redis_hash: dict = None, top_global: dict = None,
+                            charms: int = None):
+        """Queue profile writes for uid; repeated calls before a flush are merged.
+
+        Passing charms only asks for the top_global_db balance to be synced;
+        the flush re-reads the authoritative value from redis.
+        """
+        global _wb_worker
+        uid_s = str(uid)
+        with _wb_lock:
+            entry = _wb_pending.get(uid_s)
+            if entry is None:
+                entry = _wb_pending[uid_s] = {'registered': {}, 'redis': {}, 'top_global': {}}
+                _wb_stats['queued'] += 1
+            else:
+                _wb_stats['coalesced'] += 1
+            if registered:
+                entry['registered'].update(registered)
+            if redis_hash:
+                entry['redis'].update(redis_hash)
+            if top_global:
+                entry['top_global'].update(top_global)
+            if charms is not None:
+                entry['charms'] = int(charms)
+            if _wb_worker is None or not _wb_worker.is_alive():
+                _wb_worker = threading.Thread(target=_write_behind_loop, name='profile-write-behind', daemon=True)
+                _wb_worker.start()
+
+    def pending_profile_writes() -> int:
+        with _wb_lock:
+            return len(_wb_pending)
+
+    def flush_profile_writes() -> int:
+        global _wb_pending
+        with _wb_lock:
+            if not _wb_pending:
+                return 0
+            batch = _wb_pending
+            _wb_pending = {}
+        uids = list(batch.keys())
+        for i in range(0, len(uids), WRITE_BEHIND_BATCH):
+            _flush_profile_chunk({u: batch[u] for u in uids[i:i + WRITE_BEHIND_BATCH]})
+        return len(uids)
+
+    def _flush_profile_chunk(chunk):
+        now = datetime.utcnow()
+        charms = get_charms_bulk(list(chunk.keys()), mongo_fallback=False)
+        failed = False
+
+        if r is not None:
+            try:
+                pipe = r.pipeline(transaction=False)
+                for uid_s, entry in chunk.items():
+                    # balances are owned by update_charms; only backfill a
+                    # missing leaderboard entry, never overwrite a score
+                    c = charms.get(uid_s)
+                    if c is not None:
+                        pipe.zadd('leaderboard:charms', {uid_s: int(c)}, nx=True)
+                    if entry['redis']:
+                        pipe.hset(f"user:{uid_s}", mapping=entry['redis'])
+                pipe.execute()
+            except Exception as ex:
+                failed = True
+                print(f"[write_behind][redis_error] n={len(chunk)} err={ex}", flush=True)
+
+        reg_ops = []
+        tg_ops = []
+        for uid_s, entry in chunk.items():
+            if entry['registered'] and registered_users is not None:
+                reg_ops.append(UpdateOne({'user_id': uid_s}, {'$set': entry['registered']}, upsert=True))
+            if (entry['top_global'] or 'charms' in entry) and top_global_coll is not None:
+                doc = dict(entry['top_global'])
+                doc['user_id'] = uid_s
+                doc['updated_at'] = now
+                update = {'$set': doc}
+                c = charms.get(uid_s, entry.get('charms'))
+                if c is not None:
+                    doc['charms'] = int(c)
+                else:
+                    update['$setOnInsert'] = {'charms': 0}
+                tg_ops.append(UpdateOne({'user_id': uid_s}, update, upsert=True))
+        for coll, ops, label in ((registered_users, reg_ops, 'registered_users'), (top_global_coll, tg_ops, 'top_global')):
+            if not ops:
+                continue
+            try:
+                coll.bulk_write(ops, ordered=False)
+            except Exception as ex:
+                failed = True
+                print(f"[write_behind][mongo_error] coll={label} n={len(ops)} err={ex}", flush=True)
+
+        with _wb_lock:
+            if failed:
+                _wb_stats['errors'] += 1
+                for uid_s, entry in chunk.items():
+                    _wb_synced.pop(uid_s, None)
+                    # requeue for the next flush; anything queued since wins
+                    newer = _wb_pending.get(uid_s)
+                    if newer is not None:
+                        for part in ('registered', 'redis', 'top_global'):
+                            entry[part].update(newer[part])
+                        if 'charms' in newer:
+                            entry['charms'] = newer['charms']
+                    _wb_pending[uid_s] = entry
+                    _wb_stats['retried'] += 1
+            else:
+                _wb_stats['flushed'] += len(chunk)
+        if not failed:
+            publish_profile_invalidation(chunk.keys())
+
+    def _write_behind_loop():
+        while True:
+            time.sleep(WRITE_BEHIND_INTERVAL)
+            try:
+                flush_profile_writes()
+            except Exception as ex:
+                print(f"[write_behind] loop err={ex}", flush=True)
+
+    def _schedule_profile_sync(uid_s: str, prof: dict, reg_doc=None):
+        """Queue a write-back of the resolved profile, but only if something changed.
+
+        A per-worker fingerprint of the last synced (name, username, avatar)
+        short-circuits repeat calls; otherwise the registered doc we already
+        read and the redis hash are compared with what would be written.
+        """
+        if not isinstance(prof, dict):
+            return
+        firstname = prof.get('firstname') or DEFAULT_NAME
+        username = prof.get('username') or None
+        avatar = _usable_avatar(prof.get('avatar')) or _usable_avatar(prof.get('photo_url'))
+        fingerprint = (firstname, username, avatar)
+        if _wb_synced.get(uid_s) == fingerprint:
+            _wb_stats['skipped'] += 1
+            return
+
+        reg = {'user_id': uid_s, 'firstname': firstname}
+        if avatar:
+            reg['photo_url'] = avatar
+            reg['avatar'] = avatar
+        if username:
+            reg['username'] = username
+        reg_changed = not isinstance(reg_doc, dict) or any(reg_doc.get(k) != v for k, v in reg.items())
+
+        hash_changes = {}
+        if r is not None:
+            wanted = {'firstname': firstname}
+            if username:
+                wanted['username'] = username
+            if avatar:
+                wanted['avatar'] = avatar
+                wanted['photo_url'] = avatar
+            try:
+                h = r.hgetall(f"user:{uid_s}") or {}
+            except Exception:
+                h = {}
+            hash_changes = {k: v for k, v in wanted.items() if h.get(k) != v}
+
+        if reg_changed or hash_changes or uid_s not in _wb_synced:
+            tg = {'firstname': firstname, 'username': username}
+            if avatar:
+                tg['avatar'] = avatar
+            queue_profile_write(uid_s, registered=reg if reg_changed else None,
+                                redis_hash=hash_changes or None, top_global=tg)
+        if len(_wb_synced) >= WRITE_BEHIND_SYNCED_MAX:
+            _wb_synced.clear()
+        _wb_synced[uid_s] = fingerprint
+
+    atexit.register(flush_profile_writes)
+
+    # ---------- profile cache ----------
+    # Resolved profiles are cached per worker. Whenever the write-behind
+    # flush persists a profile, the uids are published on
+    # PROFILE_UPDATES_CHANNEL so the other workers drop their copies.
+    PROFILE_UPDATES_CHANNEL = os.getenv('PROFILE_UPDATES_CHANNEL', 'profile_updates')
+    profile_cache = TTLCache(maxsize=safe_int(os.getenv('PROFILE_CACHE_SIZE'), 10000),
+                             ttl=float(os.getenv('PROFILE_CACHE_TTL', '60') or 60))
+    _profile_listener = None
+
+    def publish_profile_invalidation(uids):
+        uids = [str(u) for u in uids]
+        if r is None or not uids:
+            return
+        try:
+            r.publish(PROFILE_UPDATES_CHANNEL, json.dumps({'user_ids': uids, 'origin': os.getpid()}))
+        except Exception as ex:
+            print(f"[profile_cache][publish_error] {ex}", flush=True)
+
+    def _profile_invalidation_loop():
+        while True:
+            pubsub = None
+            try:
+                pubsub = r.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(PROFILE_UPDATES_CHANNEL)
+                # poll rather than listen(): the pool's socket_timeout would
+                # turn every quiet stretch into an error (and a cache wipe)
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if not message or message.get('type') != 'message':
+                        continue
+                    try:
+                        payload = json.loads(message.get('data') or '{}')
+                    except Exception:
+                        continue
+                    if payload.get('origin') == os.getpid():
+                        continue
+                    for uid in payload.get('user_ids') or []:
+                        profile_cache.pop(str(uid))
+            except Exception as ex:
+                print(f"[profile_cache][listener_error] {ex}", flush=True)
+                # a real disconnect: entries may have been missed meanwhile
+                profile_cache.clear()
+            finally:
+                try:
+                    if pubsub is not None:
+                        pubsub.close()
+                except Exception:
+                    pass
+            time.sleep(1)
+
+    def _ensure_profile_listener():
+        global _profile_listener
+        if r is None or (_profile_listener is not None and _profile_listener.is_alive()):
+            return
+        with _wb_lock:
+            if _profile_listener is None or not _profile_listener.is_alive():
+                _profile_listener = threading.Thread(target=_profile_invalidation_loop, name='profile-invalidation', daemon=True)
+                _profile_listener.start()
+
+    def get_cached_profile(uid_s: str):
+        _ensure_profile_listener()
+        prof = profile_cache.get(uid_s)
+        return dict(prof) if prof is not None else None
+
+    def cache_profile(uid_s: str, prof: dict):
+        if isinstance(prof, dict):
+            profile_cache.set(uid_s, dict(prof))
+
     def ensure_user_profile(uid: str, first_name: str = None, username: str = None, avatar: str = None):
         if uid is None:
             return None
         uid_s = str(uid)
+        # explicit overrides must go through resolution (and the write-behind)
+        if not (first_name or username or avatar):
+            cached = get_cached_profile(uid_s)
+            if cached is not None:
+                return cached
+        prof = _resolve_user_profile(uid_s, first_name, username, avatar)
+        cache_profile(uid_s, prof)
+        return prof
+
+    def _resolve_user_profile(uid_s: str, first_name: str = None, username: str = None, avatar: str = None):
 
         doc = None
         try:
@@ -402,58 +1731,9 @@ try:
         except Exception:
             doc = None
 
-        def _is_bad_registered(d):
-            if not isinstance(d, dict):
-                return True
-            fn = d.get('firstname') or d.get('first_name') or None
-            ph = d.get('photo_url') or d.get('avatar') or None
-            if not fn or fn == DEFAULT_NAME:
-                return True
-            if ph and isinstance(ph, str) and ('picsum.photos' in ph or ph.startswith('/static/')):
-                return True
-            return False
-
         if doc and not _is_bad_registered(doc):
-            norm = _normalize_profile_doc(doc) or {}
-            if first_name:
-                norm['firstname'] = first_name
-            if username:
-                norm['username'] = username
-            if avatar:
-                norm['avatar'] = avatar
-                norm['photo_url'] = avatar
-            if not norm.get('firstname'):
-                norm['firstname'] = DEFAULT_NAME
-            if not norm.get('avatar'):
-                norm['avatar'] = None
-            try:
-                update_doc = {'user_id': uid_s, 'firstname': norm['firstname']}
-                if norm.get('photo_url'):
-                    update_doc['photo_url'] = norm['photo_url']
-                if norm.get('avatar'):
-                    update_doc['avatar'] = norm['avatar']
-                if norm.get('username'):
-                    update_doc['username'] = norm['username']
-                registered_users.update_one({'user_id': uid_s}, {'$set': update_doc}, upsert=True)
-            except Exception:
-                pass
-            try:
-                chosen_av = norm.get('avatar') or norm.get('photo_url')
-                if r is not None and chosen_av and isinstance(chosen_av, str) and 'picsum.photos' not in chosen_av and not chosen_av.startswith('/static/'):
-                    try:
-                        r.hset(f"user:{uid_s}", mapping={'avatar': chosen_av, 'photo_url': chosen_av, 'firstname': norm['firstname'], 'username': norm.get('username') or ''})
-                    except Exception:
-                        try:
-                            r.hset(f"user:{uid_s}", 'avatar', chosen_av)
-                            r.hset(f"user:{uid_s}", 'photo_url', chosen_av)
-                        except Exception:
-                            pass
-            except Exception:
-                pass
-            try:
-                upsert_top_global(uid_s, firstname=norm['firstname'], username=norm.get('username'), avatar=norm.get('avatar'))
-            except Exception:
-                pass
+            norm = _profile_from_registered(doc, first_name, username, avatar)
+            _schedule_profile_sync(uid_s, norm, doc)
             return norm
 
         candidates = []
@@ -479,104 +1759,2237 @@ try:
         except Exception:
             pass
 
-        chosen = None
-        for c in candidates:
-            n = _normalize_profile_doc(c)
-            if not n:
-                continue
-            if not chosen:
-                chosen = n
-                continue
-            if (n.get('avatar') and 'picsum.photos' not in str(n.get('avatar'))) and (not chosen.get('avatar') or 'picsum.photos' in str(chosen.get('avatar') or '')):
-                chosen = n
-            if n.get('firstname') and (not chosen.get('firstname') or chosen.get('firstname') == DEFAULT_NAME):
-                chosen = n
+        chosen = _choose_profile_candidate(uid_s, candidates, first_name, username, avatar)
 
-        if not chosen:
-            chosen = {'user_id': uid_s, 'firstname': first_name or DEFAULT_NAME, 'username': username or None, 'photo_url': avatar or None, 'avatar': avatar or None}
-        else:
-            if first_name:
-                chosen['firstname'] = first_name
-            if username:
-                chosen['username'] = username
-            if avatar:
-                chosen['avatar'] = avatar
-                chosen['photo_url'] = avatar
+        _schedule_profile_sync(uid_s, chosen, doc)
 
-        try:
-            to_save = {'user_id': uid_s, 'firstname': chosen.get('firstname') or DEFAULT_NAME}
-            if chosen.get('photo_url') and 'picsum.photos' not in str(chosen.get('photo_url')) and not str(chosen.get('photo_url')).startswith('/static/'):
-                to_save['photo_url'] = chosen.get('photo_url')
-            if chosen.get('avatar') and 'picsum.photos' not in str(chosen.get('avatar')) and not str(chosen.get('avatar')).startswith('/static/'):
-                to_save['avatar'] = chosen.get('avatar')
-            if chosen.get('username'):
-                to_save['username'] = chosen.get('username')
-            if registered_users is not None:
-                registered_users.update_one({'user_id': uid_s}, {'$set': to_save}, upsert=True)
-        except Exception:
-            pass
+        return chosen
 
+    # ---------- bulk hydration (leaderboards) ----------
+    # Character arrays are never needed to resolve a name/avatar, so the user
+    # collections are always read without them.
+    PROFILE_ONLY_PROJECTION = {'characters': 0}
+
+    def _bulk_redis_hashes(uids):
+        out = {}
+        if r is None or not uids:
+            return out
         try:
-            chosen_av = chosen.get('avatar') or chosen.get('photo_url')
-            if r is not None and chosen_av and isinstance(chosen_av, str) and 'picsum.photos' not in chosen_av and not chosen_av.startswith('/static/'):
+            pipe = r.pipeline(transaction=False)
+            for uid in uids:
+                pipe.hgetall(f"user:{uid}")
+            res = pipe.execute(raise_on_error=False)
+            for uid, h in zip(uids, res):
+                if isinstance(h, dict):
+                    out[uid] = h
+        except Exception as ex:
+            print(f"[_bulk_redis_hashes][redis_error] {ex}", flush=True)
+        return out
+
+    def _find_docs_in_coll_bulk(coll, uids, projection=None):
+        """Bulk counterpart of _find_doc_in_coll_variants: one $in query for many uids.
+
+        Returns {uid_str: doc}. When several documents match the same uid the
+        one found via user_id wins over id, and id over _id, like the
+        single-document lookup.
+        """
+        out = {}
+        if coll is None or not uids:
+            return out
+        wanted = set(str(u) for u in uids)
+        keys = list(wanted)
+        for u in wanted:
+            if u.isdigit():
                 try:
-                    r.hset(f"user:{uid_s}", mapping={'avatar': chosen_av, 'photo_url': chosen_av, 'firstname': chosen.get('firstname') or DEFAULT_NAME, 'username': chosen.get('username') or ''})
+                    keys.append(int(u))
                 except Exception:
-                    try:
-                        r.hset(f"user:{uid_s}", 'avatar', chosen_av)
-                        r.hset(f"user:{uid_s}", 'photo_url', chosen_av)
-                    except Exception:
-                        pass
-        except Exception:
-            pass
+                    pass
+        query = {'$or': [{'user_id': {'$in': keys}}, {'id': {'$in': keys}}, {'_id': {'$in': list(wanted)}}]}
+        rank = {}
+        try:
+            for doc in coll.find(query, projection):
+                for prio, field in enumerate(('user_id', 'id', '_id')):
+                    v = doc.get(field)
+                    if v is None:
+                        continue
+                    k = str(v)
+                    if k in wanted and prio < rank.get(k, 99):
+                        out[k] = doc
+                        rank[k] = prio
+        except Exception as ex:
+            print(f"[_find_docs_in_coll_bulk][mongo_error] {ex}", flush=True)
+        return out
+
+    def hydrate_top_rows(pairs):
+        """Resolve name/username/avatar for (uid, score) leaderboard pairs.
+
+        Applies the same priority rules as the old per-row path (redis hash,
+        then the ensure_user_profile resolution, then top_global_db, then the
+        waifu/husband collections) but with a constant number of round trips:
+        one redis pipeline and at most one $in query per collection.
+        """
+        uids = [str(m) for m, _ in pairs]
+        hashes = _bulk_redis_hashes(uids)
+
+        profiles = {}
+        for uid in uids:
+            cached = get_cached_profile(uid)
+            if cached is not None:
+                profiles[uid] = cached
+        uncached = [u for u in uids if u not in profiles]
+        reg_docs = _find_docs_in_coll_bulk(registered_users, uncached)
+
+        fallback = []
+        for uid in uncached:
+            d = reg_docs.get(uid)
+            if d and not _is_bad_registered(d):
+                profiles[uid] = _profile_from_registered(d)
+            else:
+                fallback.append(uid)
+
+        glob_docs = _find_docs_in_coll_bulk(global_user_profiles_coll, fallback, PROFILE_ONLY_PROJECTION)
+        wai_docs = {}
+        hus_docs = {}
+        if fallback:
+            wai_docs = _find_docs_in_coll_bulk(waifu_users_coll, fallback, PROFILE_ONLY_PROJECTION)
+            hus_docs = _find_docs_in_coll_bulk(husband_users_coll, fallback, PROFILE_ONLY_PROJECTION)
+        for uid in fallback:
+            candidates = [c for c in (glob_docs.get(uid), wai_docs.get(uid), hus_docs.get(uid)) if c]
+            profiles[uid] = _choose_profile_candidate(uid, candidates)
+        for uid in uncached:
+            cache_profile(uid, profiles[uid])
+
+        rows = {}
+        missing = []
+        for uid in uids:
+            h = hashes.get(uid) or {}
+            name = h.get('firstname') or DEFAULT_NAME
+            username = h.get('username') or None
+            avatar = _usable_avatar(h.get('avatar') or h.get('photo_url'))
+            prof = profiles.get(uid) or {}
+            if prof.get('firstname'):
+                name = prof.get('firstname')
+            username = username or prof.get('username')
+            avatar = _usable_avatar(prof.get('avatar') or prof.get('photo_url')) or avatar
+            rows[uid] = {'name': name, 'username': username, 'avatar': avatar}
+            if not avatar:
+                missing.append(uid)
+
+        if missing:
+            tg_docs = _find_docs_in_coll_bulk(top_global_coll, missing)
+            rest = [u for u in missing if u not in wai_docs and u not in hus_docs]
+            wai_docs.update(_find_docs_in_coll_bulk(waifu_users_coll, rest, PROFILE_ONLY_PROJECTION))
+            hus_docs.update(_find_docs_in_coll_bulk(husband_users_coll, rest, PROFILE_ONLY_PROJECTION))
+            for uid in missing:
+                row = rows[uid]
+                tg = tg_docs.get(uid)
+                if tg:
+                    row['avatar'] = _usable_avatar(tg.get('avatar'))
+                    row['name'] = tg.get('firstname') or row['name']
+                    row['username'] = row['username'] or tg.get('username')
+                for d in (wai_docs.get(uid), hus_docs.get(uid)):
+                    if row['avatar'] or not d:
+                        continue
+                    a2 = _try_many_fields_for_avatar(d)
+                    if a2:
+                        row['avatar'] = a2
+                    row['name'] = d.get('first_name') or d.get('firstname') or row['name']
+                    row['username'] = row['username'] or d.get('username')
+
+        items = []
+        for rank, (member, score) in enumerate(pairs, start=1):
+            row = rows[str(member)]
+            items.append({
+                "rank": rank,
+                "user_id": str(member),
+                "name": row['name'],
+                "username": row['username'],
+                "avatar": _usable_avatar(row['avatar']),
+                "charms": int(score),
+                "score": int(score),
+                "count": int(score)
+            })
+        return items
+
+    def hydrate_top_global_docs(docs):
+        """Overlay redis hashes (and registered_users for missing avatars) on top_global_db docs."""
+        uids = [str(doc.get('user_id')) for doc in docs]
+        hashes = _bulk_redis_hashes(uids)
+        rows = []
+        missing = []
+        for uid, doc in zip(uids, docs):
+            name = doc.get('firstname') or DEFAULT_NAME
+            username = doc.get('username') or None
+            avatar = doc.get('avatar') or None
+            h = hashes.get(uid) or {}
+            avatar = _usable_avatar(h.get('avatar') or h.get('photo_url')) or avatar
+            if h.get('firstname'):
+                name = h.get('firstname')
+            if h.get('username'):
+                username = username or h.get('username')
+            row = {'name': name, 'username': username, 'avatar': avatar}
+            rows.append(row)
+            if not avatar or 'picsum.photos' in str(avatar):
+                missing.append(uid)
+
+        if missing:
+            reg_docs = _find_docs_in_coll_bulk(registered_users, missing)
+            for uid, row in zip(uids, rows):
+                ru = reg_docs.get(uid)
+                if not ru or uid not in missing:
+                    continue
+                a2 = _try_many_fields_for_avatar(ru)
+                if a2:
+                    row['avatar'] = a2
+                row['name'] = ru.get('firstname') or row['name']
+                row['username'] = row['username'] or ru.get('username')
+
+        items = []
+        for rank, (uid, doc, row) in enumerate(zip(uids, docs, rows), start=1):
+            charms = int(doc.get('charms') or 0)
+            items.append({
+                "rank": rank,
+                "user_id": uid,
+                "name": row['name'],
+                "username": row['username'],
+                "avatar": _usable_avatar(row['avatar']),
+                "charms": charms,
+                "score": charms,
+                "count": charms
+            })
+        return items
+
+    # ---------- top_global_db rebuild ----------
+    # The rebuild runs as a background job: registered_users (or, without it,
+    # the redis leaderboard) is walked in batches, balances are read with one
+    # pipeline per batch and top_global_db is written with unordered
+    # bulk_write. Progress is checkpointed in redis so an interrupted rebuild
+    # resumes where it stopped, and a redis lock keeps it to one job across
+    # workers.
+    REBUILD_STATE_KEY = 'top_global_rebuild'
+    REBUILD_LOCK_KEY = 'top_global_rebuild:lock'
+    REBUILD_LOCK_TTL = 300
+    REBUILD_BATCH = safe_int(os.getenv('REBUILD_BATCH'), 500)
+
+    _rebuild_local_state = {}
+    _rebuild_local_lock = threading.Lock()
+    _rebuild_lock_token = None
+
+    # Token-checked lock helpers: a holder that outlived its TTL must not
+    # extend or delete a lock some other worker has taken since.
+    LOCK_RENEW_LUA = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('EXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    LOCK_RELEASE_LUA = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+    _lock_renew_script = _lock_release_script = None
+    if r is not None:
+        try:
+            _lock_renew_script = r.register_script(LOCK_RENEW_LUA)
+            _lock_release_script = r.register_script(LOCK_RELEASE_LUA)
+        except Exception as ex:
+            print(f"[locks] lua unavailable: {ex}", flush=True)
+
+    class RebuildLockLost(RuntimeError):
+        pass
+
+    def get_rebuild_state() -> dict:
+        if r is not None:
+            try:
+                st = r.hgetall(REBUILD_STATE_KEY) or {}
+                for k in ('processed', 'offset', 'limit', 'batch'):
+                    if k in st:
+                        st[k] = safe_int(st[k], 0)
+                if st.get('status') == 'running' and not r.exists(REBUILD_LOCK_KEY):
+                    st['status'] = 'interrupted'
+                return st
+            except Exception as ex:
+                print(f"[rebuild][state_read_error] {ex}", flush=True)
+        return dict(_rebuild_local_state)
+
+    def _save_rebuild_state(fields: dict, reset: bool = False):
+        fields = {k: ('' if v is None else str(v)) for k, v in fields.items()}
+        fields['updated_at'] = datetime.utcnow().isoformat() + 'Z'
+        if reset:
+            _rebuild_local_state.clear()
+        _rebuild_local_state.update(fields)
+        if r is not None:
+            # every checkpoint also extends the lock, and stops the job if
+            # another worker has taken it over
+            if not _extend_rebuild_lock():
+                raise RebuildLockLost(f"{REBUILD_LOCK_KEY} is held by another rebuild")
+            try:
+                pipe = r.pipeline(transaction=True)
+                if reset:
+                    pipe.delete(REBUILD_STATE_KEY)
+                pipe.hset(REBUILD_STATE_KEY, mapping=fields)
+                pipe.execute()
+            except Exception as ex:
+                print(f"[rebuild][state_write_error] {ex}", flush=True)
+
+    def _acquire_rebuild_lock() -> bool:
+        global _rebuild_lock_token
+        if r is not None:
+            try:
+                token = f"{os.getpid()}:{uuid.uuid4().hex}"
+                if not r.set(REBUILD_LOCK_KEY, token, nx=True, ex=REBUILD_LOCK_TTL):
+                    return False
+                _rebuild_lock_token = token
+                return True
+            except Exception as ex:
+                print(f"[rebuild][lock_error] {ex}", flush=True)
+        return _rebuild_local_lock.acquire(blocking=False)
+
+    def _extend_rebuild_lock() -> bool:
+        """False only when the lock is known to belong to someone else."""
+        if r is None or _rebuild_lock_token is None or _lock_renew_script is None:
+            return True
+        try:
+            return bool(_lock_renew_script(keys=[REBUILD_LOCK_KEY], args=[_rebuild_lock_token, REBUILD_LOCK_TTL]))
+        except Exception as ex:
+            print(f"[rebuild][lock_error] {ex}", flush=True)
+            return True
 
+    def _release_rebuild_lock():
+        global _rebuild_lock_token
+        if r is not None and _rebuild_lock_token is not None:
+            try:
+                _lock_release_script(keys=[REBUILD_LOCK_KEY], args=[_rebuild_lock_token])
+                _rebuild_lock_token = None
+                return
+            except Exception:
+                pass
         try:
-            upsert_top_global(uid_s, firstname=chosen.get('firstname'), username=chosen.get('username'), avatar=chosen.get('avatar'))
+            _rebuild_local_lock.release()
         except Exception:
             pass
 
-        return chosen
+    def _encode_checkpoint_id(v):
+        if ObjectId is not None and isinstance(v, ObjectId):
+            return 'oid', str(v)
+        if isinstance(v, int):
+            return 'int', str(v)
+        return 'str', str(v)
 
-    def build_top_from_users_coll(users_coll, limit=100):
-        if users_coll is None:
-            return []
+    def _decode_checkpoint_id(typ, v):
+        if not v:
+            return None
+        if typ == 'oid' and ObjectId is not None:
+            return ObjectId(v)
+        if typ == 'int':
+            return safe_int(v, None)
+        return v
+
+    def start_top_global_rebuild(limit: int, batch: int = None, resume: bool = True, wait: bool = False):
+        """Start (or resume) the rebuild. Returns (started, state)."""
+        if not _acquire_rebuild_lock():
+            return False, get_rebuild_state()
+        prev = get_rebuild_state()
+        batch = max(1, min(safe_int(batch, REBUILD_BATCH), 5000))
+        source = 'registered_users' if registered_users is not None else 'leaderboard'
+        if resume and prev.get('status') in ('running', 'interrupted', 'failed') and prev.get('source') == source:
+            state = {'status': 'running', 'resumed': 1, 'error': ''}
+        else:
+            state = {'status': 'running', 'source': source, 'limit': limit, 'batch': batch, 'processed': 0,
+                     'offset': 0, 'last_id': '', 'last_id_type': '', 'error': '', 'resumed': 0,
+                     'started_at': datetime.utcnow().isoformat() + 'Z', 'finished_at': ''}
+        _save_rebuild_state(state, reset=not state.get('resumed'))
+        if wait:
+            _run_top_global_rebuild()
+        else:
+            threading.Thread(target=_run_top_global_rebuild, name='top-global-rebuild', daemon=True).start()
+        return True, get_rebuild_state()
+
+    def _run_top_global_rebuild():
         try:
-            pipeline = [
-                {"$addFields": {"character_count": {"$cond": {"if": {"$isArray": "$characters"}, "then": {"$size": "$characters"}, "else": 0}}}},
-                {"$project": {"user_id": {"$ifNull": ["$id", "$user_id"]}, "first_name": 1, "username": 1, "character_count": 1}},
-                {"$sort": {"character_count": -1}},
-                {"$limit": limit}
-            ]
-            cursor = users_coll.aggregate(pipeline)
-            return list(cursor)
-        except Exception:
-            return []
+            st = get_rebuild_state()
+            if st.get('source') == 'registered_users':
+                _rebuild_from_registered(st)
+            else:
+                _rebuild_from_leaderboard(st)
+            _save_rebuild_state({'status': 'done', 'finished_at': datetime.utcnow().isoformat() + 'Z'})
+        except RebuildLockLost as ex:
+            # the state now belongs to the other job; leave it alone
+            print(f"[rebuild][lock_lost] {ex}", flush=True)
+        except Exception as ex:
+            traceback.print_exc()
+            try:
+                _save_rebuild_state({'status': 'failed', 'error': str(ex)})
+            except RebuildLockLost as lost:
+                print(f"[rebuild][lock_lost] {lost}", flush=True)
+        finally:
+            _release_rebuild_lock()
+
+    def _write_rebuild_batch(rows):
+        """rows: [(uid, firstname, username, avatar, charms)] -> one bulk_write + one pipeline."""
+        now = datetime.utcnow()
+        ops = [UpdateOne({'user_id': uid}, {'$set': {'user_id': uid, 'firstname': fn, 'avatar': av, 'username': un,
+                                                     'charms': int(ch), 'updated_at': now}}, upsert=True)
+               for uid, fn, un, av, ch in rows]
+        if ops:
+            top_global_coll.bulk_write(ops, ordered=False)
+        if r is not None and rows:
+            try:
+                pipe = r.pipeline(transaction=False)
+                for uid, fn, un, av, ch in rows:
+                    mapping = {'firstname': fn}
+                    if un:
+                        mapping['username'] = un
+                    if av:
+                        mapping['avatar'] = av
+                        mapping['photo_url'] = av
+                    pipe.hset(f"user:{uid}", mapping=mapping)
+                    # never clobber a live balance; only backfill a missing mirror
+                    pipe.hsetnx(f"user:{uid}", 'charm', str(int(ch)))
+                    pipe.hsetnx(f"user:{uid}", 'charms', str(int(ch)))
+                pipe.execute()
+            except Exception as ex:
+                print(f"[rebuild][redis_error] {ex}", flush=True)
+
+    def _rebuild_from_registered(st):
+        limit = safe_int(st.get('limit'), 10000)
+        batch = safe_int(st.get('batch'), REBUILD_BATCH)
+        processed = safe_int(st.get('processed'), 0)
+        last_id = _decode_checkpoint_id(st.get('last_id_type'), st.get('last_id'))
+        projection = {'user_id': 1, 'firstname': 1, 'photo_url': 1, 'avatar': 1, 'username': 1}
+        while processed < limit:
+            query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+            docs = list(registered_users.find(query, projection).sort('_id', 1).limit(min(batch, limit - processed)))
+            if not docs:
+                break
+            docs_with_uid = [u for u in docs if u.get('user_id')]
+            charms = get_charms_bulk([u.get('user_id') for u in docs_with_uid])
+            rows = []
+            for u in docs_with_uid:
+                uid = str(u.get('user_id'))
+                avatar = _try_many_fields_for_avatar(u) or u.get('photo_url') or u.get('avatar') or None
+                if avatar and 'picsum.photos' in avatar:
+                    avatar = None
+                rows.append((uid, u.get('firstname') or DEFAULT_NAME, u.get('username') or None, avatar, charms.get(uid, 0)))
+            _write_rebuild_batch(rows)
+            processed += len(rows)
+            last_type, last_val = _encode_checkpoint_id(docs[-1].get('_id'))
+            last_id = docs[-1].get('_id')
+            _save_rebuild_state({'processed': processed, 'last_id': last_val, 'last_id_type': last_type})
+
+    def _rebuild_from_leaderboard(st):
+        if r is None:
+            raise RuntimeError("no source to rebuild from")
+        limit = safe_int(st.get('limit'), 10000)
+        batch = safe_int(st.get('batch'), REBUILD_BATCH)
+        offset = safe_int(st.get('offset'), 0)
+        processed = safe_int(st.get('processed'), 0)
+        while offset < limit:
+            pairs = r.zrevrange('leaderboard:charms', offset, min(offset + batch, limit) - 1, withscores=True)
+            if not pairs:
+                break
+            uids = [str(m) for m, _ in pairs]
+            glob_docs = _find_docs_in_coll_bulk(global_user_profiles_coll, uids, PROFILE_ONLY_PROJECTION)
+            wai_docs = _find_docs_in_coll_bulk(waifu_users_coll, uids, PROFILE_ONLY_PROJECTION)
+            hus_docs = _find_docs_in_coll_bulk(husband_users_coll, uids, PROFILE_ONLY_PROJECTION)
+            rows = []
+            for uid, score in zip(uids, (sc for _, sc in pairs)):
+                firstname = DEFAULT_NAME
+                avatar = None
+                username = None
+                d = glob_docs.get(uid)
+                if d:
+                    firstname = d.get('firstname') or d.get('first_name') or firstname
+                    username = username or d.get('username')
+                    avatar = _try_many_fields_for_avatar(d) or avatar
+                d2 = wai_docs.get(uid)
+                if firstname == DEFAULT_NAME and d2:
+                    firstname = d2.get('first_name') or d2.get('firstname') or firstname
+                    username = username or d2.get('username')
+                    avatar = avatar or _try_many_fields_for_avatar(d2)
+                d3 = hus_docs.get(uid)
+                if not avatar and d3:
+                    firstname = firstname or d3.get('first_name') or d3.get('firstname')
+                    username = username or d3.get('username')
+                    avatar = avatar or _try_many_fields_for_avatar(d3)
+                if avatar and 'picsum.photos' in str(avatar):
+                    avatar = None
+                rows.append((uid, firstname, username, avatar, int(score)))
+            _write_rebuild_batch(rows)
+            offset += len(pairs)
+            processed += len(rows)
+            _save_rebuild_state({'offset': offset, 'processed': processed})
+
+    # ---------- charms_updates fan-out ----------
+    SSE_RETRY_MS = safe_int(os.getenv('SSE_RETRY_MS'), 5000)
+    SSE_HEARTBEAT_SECONDS = safe_int(os.getenv('SSE_HEARTBEAT_SECONDS'), 15)
+    charms_hub = PubSubHub(lambda: r, 'charms_updates', queue_size=safe_int(os.getenv('SSE_QUEUE_SIZE'), 100))
+
+    def compute_top(typ: str, limit: int):
+        """Build the /api/top rows for a (normalized) type without any caching."""
+        if top_global_coll is not None and not typ:
+            try:
+                docs = list(top_global_coll.find({}, {"_id": 0}).sort("charms", -1).limit(limit))
+                return hydrate_top_global_docs(docs)
+            except Exception as ex:
+                print("[api_top][top_global_read_error]", ex, flush=True)
+                metrics.fallback('top_global_read_error')
+
+        redis_key = 'leaderboard:charms'
+        users_coll = None
+        if typ == 'waifu':
+            redis_key = 'leaderboard:charms:waifu'
+            users_coll = waifu_users_coll
+        elif typ == 'husband':
+            redis_key = 'leaderboard:charms:husband'
+            users_coll = husband_users_coll
+
+        raw = []
+        try:
+            if r is not None:
+                raw = r.zrevrange(redis_key, 0, limit - 1, withscores=True)
+        except Exception:
+            raw = []
+
+        if not raw and typ in ('waifu', 'husband') and users_coll is not None:
+            metrics.fallback('top_by_character_count')
+            raw = top_by_character_count(typ, users_coll, limit)
+
+        if not raw and (not typ):
+            try:
+                if r is not None:
+                    raw = r.zrevrange('leaderboard:charms', 0, limit - 1, withscores=True)
+            except Exception:
+                raw = []
+
+        if not raw:
+            raw = []
+            if registered_users is not None:
+                metrics.fallback('top_registered_users_scan')
+                try:
+                    for u in registered_users.find({}, {'user_id': 1}):
+                        uid = u.get('user_id')
+                        if not uid:
+                            continue
+                        c = get_charms(uid)
+                        if c > 0:
+                            raw.append((str(uid), int(c)))
+                    raw.sort(key=lambda x: -x[1])
+                    raw = raw[:limit]
+                except Exception:
+                    raw = []
+
+        return hydrate_top_rows(raw)
+
+    # ---------- leaderboard snapshots ----------
+    # /api/top is served from fully hydrated JSON snapshots kept in redis per
+    # (type, limit bucket). Every balance change bumps leaderboard:version;
+    # a per-worker materializer listens to charms_updates, waits
+    # TOP_SNAPSHOT_DEBOUNCE seconds so bursts coalesce (and the write-behind
+    # has synced top_global_db), then rebuilds the affected types. Snapshots
+    # also expire after TOP_SNAPSHOT_TTL so profile-only changes show up.
+    TOP_LIMIT_BUCKETS = (10, 25, 50, 100)
+    TOP_SNAPSHOT_TYPES = ('', 'charms', 'waifu', 'husband')
+    TOP_SNAPSHOT_TTL = safe_int(os.getenv('TOP_SNAPSHOT_TTL'), 300)
+    TOP_SNAPSHOT_DEBOUNCE = float(os.getenv('TOP_SNAPSHOT_DEBOUNCE', str(WRITE_BEHIND_INTERVAL + 1)) or 3)
+    LEADERBOARD_VERSION_KEY = 'leaderboard:version'
+
+    top_snapshot_local = TTLCache(maxsize=len(TOP_SNAPSHOT_TYPES) * len(TOP_LIMIT_BUCKETS), ttl=TOP_SNAPSHOT_TTL)
+    # last non-empty snapshot per key, kept without expiry for degraded serving
+    top_snapshot_last_good = {}
+    _top_materializer = None
+    _top_snapshot_stats = {'served': 0, 'built': 0, 'rebuilds': 0, 'not_modified': 0}
+
+    def normalize_top_type(typ) -> str:
+        """'' (top_global_db), 'waifu', 'husband'; any other value reads the global redis board."""
+        typ = (typ or '').lower().strip()
+        if typ in ('', 'waifu', 'husband'):
+            return typ
+        return 'charms'
+
+    def _top_snapshot_key(typ: str, bucket: int) -> str:
+        return f"top_snapshot:{typ or 'global'}:{bucket}"
+
+    def leaderboard_version() -> int:
+        if r is None:
+            return 0
+        try:
+            return safe_int(r.get(LEADERBOARD_VERSION_KEY), 0)
+        except Exception:
+            return 0
+
+    def get_top_snapshot(typ: str, bucket: int):
+        _ensure_top_materializer()
+        key = _top_snapshot_key(typ, bucket)
+        snap = None
+        if r is not None:
+            try:
+                snap = r.hgetall(key) or None
+            except Exception as ex:
+                print(f"[top_snapshot][read_error] {ex}", flush=True)
+        if snap is None:
+            snap = top_snapshot_local.get(key)
+        if snap and snap.get('body') and snap.get('etag'):
+            _top_snapshot_stats['served'] += 1
+            top_snapshot_last_good[key] = snap
+            return snap
+        return None
+
+    def top_snapshot_etag(typ: str, bucket: int):
+        """Only the current snapshot's etag (one small HGET), for answering If-None-Match without the body."""
+        _ensure_top_materializer()
+        key = _top_snapshot_key(typ, bucket)
+        if r is not None:
+            try:
+                etag = r.hget(key, 'etag')
+                if etag:
+                    return etag
+            except Exception as ex:
+                print(f"[top_snapshot][read_error] {ex}", flush=True)
+        snap = top_snapshot_local.get(key)
+        return snap.get('etag') if snap else None
+
+    def stale_top_snapshot(typ: str, bucket: int):
+        return top_snapshot_last_good.get(_top_snapshot_key(typ, bucket))
+
+    def store_top_snapshot(typ: str, bucket: int, items, version: int = None) -> dict:
+        body = json.dumps({"ok": True, "items": items})
+        if version is None:
+            version = leaderboard_version()
+        snap = {'body': body, 'etag': hashlib.sha1(body.encode('utf-8')).hexdigest()[:20],
+                'version': str(version), 'built_at': datetime.utcnow().isoformat() + 'Z'}
+        key = _top_snapshot_key(typ, bucket)
+        if not items:
+            # an empty list usually means a source is down or not synced yet
+            # (top_global_db fills through write-behind); caching it would
+            # pin "no players" behind a valid etag until the next rebuild
+            snap['uncached'] = True
+            return snap
+        top_snapshot_local.set(key, snap)
+        top_snapshot_last_good[key] = snap
+        if r is not None:
+            try:
+                pipe = r.pipeline(transaction=True)
+                pipe.hset(key, mapping=snap)
+                pipe.expire(key, TOP_SNAPSHOT_TTL)
+                pipe.execute()
+            except Exception as ex:
+                print(f"[top_snapshot][write_error] {ex}", flush=True)
+        _top_snapshot_stats['built'] += 1
+        return snap
+
+    def rebuild_top_snapshots(types=TOP_SNAPSHOT_TYPES):
+        """Rebuild every bucket of the given types from one hydration of the largest bucket."""
+        version = leaderboard_version()
+        biggest = TOP_LIMIT_BUCKETS[-1]
+        for typ in types:
+            items = compute_top(typ, biggest)
+            for bucket in TOP_LIMIT_BUCKETS:
+                store_top_snapshot(typ, bucket, items[:bucket], version)
+        _top_snapshot_stats['rebuilds'] += 1
+
+    def _top_materializer_loop():
+        sub = charms_hub.subscribe()
+        while True:
+            try:
+                data = sub['queue'].get()
+                dirty = set()
+
+                def _mark(raw):
+                    try:
+                        t = (json.loads(raw) or {}).get('type')
+                    except Exception:
+                        t = None
+                    dirty.update(('', 'charms'))
+                    if t in ('waifu', 'husband'):
+                        dirty.add(t)
+
+                _mark(data)
+                deadline = time.monotonic() + TOP_SNAPSHOT_DEBOUNCE
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        _mark(sub['queue'].get(timeout=remaining))
+                    except queue.Empty:
+                        break
+                flush_profile_writes()
+                lock_ok = True
+                if r is not None:
+                    try:
+                        lock_ok = bool(r.set('top_snapshot:lock', str(os.getpid()), nx=True, px=int(TOP_SNAPSHOT_DEBOUNCE * 1000)))
+                    except Exception:
+                        lock_ok = True
+                if lock_ok:
+                    rebuild_top_snapshots([t for t in TOP_SNAPSHOT_TYPES if t in dirty])
+                else:
+                    # another worker rebuilt the shared snapshots; refresh our local copies lazily
+                    top_snapshot_local.clear()
+            except Exception as ex:
+                print(f"[top_snapshot][materializer_error] {ex}", flush=True)
+                time.sleep(1)
+
+    def _ensure_top_materializer():
+        global _top_materializer
+        if r is None or (_top_materializer is not None and _top_materializer.is_alive()):
+            return
+        with _wb_lock:
+            if _top_materializer is None or not _top_materializer.is_alive():
+                _top_materializer = threading.Thread(target=_top_materializer_loop, name='top-snapshot-materializer', daemon=True)
+                _top_materializer.start()
+
+    # ---------- collection pages ----------
+    COLLECTION_PAGE_DEFAULT = safe_int(os.getenv('COLLECTION_PAGE_DEFAULT'), 500)
+    COLLECTION_PAGE_MAX = safe_int(os.getenv('COLLECTION_PAGE_MAX'), 1000)
+    COLLECTION_ARRAY_FIELDS = ('characters', 'waifu', 'husband', 'char')
+    CHARACTER_IMAGE_FIELDS = ('img_url', 'image', 'image_url', 'avatar', 'photo', 'picture', 'thumbnail', 'img')
+    character_image_cache = TTLCache(maxsize=safe_int(os.getenv('CHARACTER_IMAGE_CACHE_SIZE'), 100000),
+                                     ttl=float(os.getenv('CHARACTER_IMAGE_CACHE_TTL', '3600') or 3600))
+
+    def _extract_character_image(c: dict):
+        candidate = None
+        for f in CHARACTER_IMAGE_FIELDS:
+            candidate = c.get(f)
+            if candidate:
+                break
+        img = _pick_first_valid_image(candidate)
+        if not img:
+            for v in c.values():
+                if isinstance(v, (list, str)):
+                    img = _pick_first_valid_image(v)
+                    if img:
+                        break
+        return img
+
+    def character_image(c: dict, typ: str = 'waifu'):
+        """Image URL for a character entry, cached by collection type and id ('' means none).
+
+        The waifu and husband collections are separate databases whose ids
+        can collide, so the type is part of the key.
+        """
+        cid = c.get('id') or c.get('_id') or c.get('char_id')
+        if cid is None:
+            return _extract_character_image(c)
+        key = f"{typ}:{cid}"
+        img = character_image_cache.get(key)
+        if img is None:
+            img = _extract_character_image(c) or ''
+            character_image_cache.set(key, img)
+        return img or None
+
+    def _first_array_expr(fields=COLLECTION_ARRAY_FIELDS):
+        expr = []
+        for f in reversed(fields):
+            expr = {'$ifNull': [f'${f}', expr]}
+        return expr
+
+    def load_collection_page(users_coll, uid: str, offset: int = 0, limit: int = None, rarity: str = None, name: str = None,
+                             with_version: bool = False):
+        """Return (raw_entries, total) for one page of a user's characters.
+
+        Filtering and slicing run inside MongoDB, so only the requested page
+        of the characters array ever leaves the server. with_version adds a
+        third value that changes whenever the characters do (array length,
+        last entry and updated_at, read in the same aggregation), for ETags.
+        """
+        limit = max(1, min(safe_int(limit, COLLECTION_PAGE_DEFAULT), COLLECTION_PAGE_MAX))
+        offset = max(0, safe_int(offset, 0))
+        ref = _find_doc_in_coll_variants(users_coll, str(uid), projection={'_id': 1}, order=COLLECTION_LOOKUP_ORDER)
+        if not ref:
+            return ([], 0, None) if with_version else ([], 0)
+
+        array = _first_array_expr()
+        source = array
+        conds = []
+        if rarity:
+            conds.append({'$or': [{'$eq': ['$$c.rarity', rarity]}, {'$eq': ['$$c.rank', rarity]}]})
+        if name:
+            label = {'$ifNull': ['$$c.name', {'$ifNull': ['$$c.title', {'$ifNull': ['$$c.character_name', '']}]}]}
+            conds.append({'$regexMatch': {'input': {'$toString': label}, 'regex': re.escape(name), 'options': 'i'}})
+        if conds:
+            source = {'$filter': {'input': source, 'as': 'c', 'cond': {'$and': conds}}}
+        pipeline = [
+            {'$match': {'_id': ref['_id']}},
+            {'$project': {'items': source, 'updated_at': 1,
+                          'count': {'$cond': [{'$isArray': array}, {'$size': array}, 0]},
+                          'last': {'$cond': [{'$isArray': array}, {'$arrayElemAt': [array, -1]}, None]}}},
+            {'$project': {'total': {'$size': '$items'}, 'items': {'$slice': ['$items', offset, limit]},
+                          'updated_at': 1, 'count': 1, 'last': 1}},
+        ]
+        for d in users_coll.aggregate(pipeline):
+            items, total = d.get('items') or [], int(d.get('total') or 0)
+            if not with_version:
+                return items, total
+            version = hashlib.sha1(json.dumps([str(ref['_id']), str(d.get('updated_at')), d.get('count'), d.get('last')],
+                                              default=str, sort_keys=True).encode('utf-8')).hexdigest()
+            return items, total, version
+        return ([], 0, None) if with_version else ([], 0)
+
+    # ---------- market listings ----------
+    # Listing pages are keyset-paginated over compound (type, rarity,
+    # price/created_at, _id) indexes and cached briefly in redis. The cache
+    # key embeds market:version:{type}, which invalidate_market() bumps on
+    # any stock change, so stale pages are simply never read again.
+    MARKET_PAGE_DEFAULT = safe_int(os.getenv('MARKET_PAGE_DEFAULT'), 50)
+    MARKET_PAGE_MAX = 100
+    MARKET_CACHE_TTL = safe_int(os.getenv('MARKET_CACHE_TTL'), 15)
+    MARKET_FIELDS = {'name': 1, 'image': 1, 'img_url': 1, 'rarity': 1, 'price': 1, 'stock': 1}
+    MARKET_SORTS = {
+        'price-asc': ('price', 1),
+        'price-desc': ('price', -1),
+        'newest': ('created_at', -1),
+    }
+    RARITY_LABELS = ("⚪ Common", "🟠 Rare", "🟢 Medium", "🟡 Legendary", "💮 Special Edition",
+                     "🔮 Mythical", "🎐 Celestial", "❄️ Premium Edition", "🫧 X Verse")
+
+    def ensure_market_indexes():
+        if market_coll is None:
+            return
+        try:
+            for field in ('price', 'created_at'):
+                market_coll.create_index([('type', 1), ('rarity', 1), (field, 1), ('_id', 1)])
+                market_coll.create_index([('type', 1), (field, 1), ('_id', 1)])
+        except Exception as ex:
+            print(f"[ensure_market_indexes] err={ex}", flush=True)
+
+    if os.getenv('ENSURE_INDEXES', '1') not in ('0', 'false', 'no'):
+        threading.Thread(target=ensure_market_indexes, name='ensure-market-indexes', daemon=True).start()
+
+    def market_rarity_values(rarity: str):
+        """The filter sends plain labels ('Rare'); stored values may carry the emoji prefix."""
+        rarity = (rarity or '').strip()
+        if not rarity or rarity.lower() == 'all':
+            return None
+        values = [rarity]
+        for full in RARITY_LABELS:
+            if full != rarity and full.split(' ', 1)[-1].lower() == rarity.lower():
+                values.append(full)
+        return values
+
+    def market_version(typ: str) -> int:
+        if r is None:
+            return 0
+        try:
+            return safe_int(r.get(f"market:version:{typ}"), 0)
+        except Exception:
+            return 0
+
+    def invalidate_market(typ: str = None):
+        if r is None:
+            return
+        try:
+            for t in ([typ] if typ else ['waifu', 'husband']):
+                r.incr(f"market:version:{t}")
+        except Exception as ex:
+            print(f"[market][invalidate_error] {ex}", flush=True)
+
+    def _encode_market_cursor(value, oid) -> str:
+        raw = json.dumps([value.isoformat() if isinstance(value, datetime) else value, str(oid),
+                          isinstance(value, datetime)])
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+    def _decode_market_cursor(cursor: str):
+        value, oid, is_dt = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        if is_dt:
+            value = datetime.fromisoformat(value)
+        if ObjectId is not None and ObjectId.is_valid(oid):
+            oid = ObjectId(oid)
+        return value, oid
+
+    def _market_card(doc: dict) -> dict:
+        return {
+            "_id": str(doc.get('_id')),
+            "name": doc.get('name') or 'Unknown',
+            "image": _pick_first_valid_image(doc.get('image') or doc.get('img_url')),
+            "rarity": doc.get('rarity'),
+            "price": safe_int(doc.get('price'), 0),
+            "stock": safe_int(doc.get('stock'), 0),
+        }
+
+    def query_market_page(typ: str, sort: str, rarity: str = None, cursor: str = None, limit: int = None) -> dict:
+        query = {'type': typ}
+        rarities = market_rarity_values(rarity)
+        if rarities:
+            query['rarity'] = rarities[0] if len(rarities) == 1 else {'$in': rarities}
+        if sort == 'random':
+            docs = list(market_coll.aggregate([{'$match': query}, {'$sample': {'size': limit}}, {'$project': MARKET_FIELDS}]))
+            return {"ok": True, "items": [_market_card(d) for d in docs], "next_cursor": None}
+
+        field, direction = MARKET_SORTS.get(sort, MARKET_SORTS['newest'])
+        if cursor:
+            value, oid = _decode_market_cursor(cursor)
+            op = '$gt' if direction == 1 else '$lt'
+            query['$or'] = [{field: {op: value}}, {field: value, '_id': {op: oid}}]
+        projection = dict(MARKET_FIELDS, **{field: 1})
+        docs = list(market_coll.find(query, projection).sort([(field, direction), ('_id', direction)]).limit(limit + 1))
+        next_cursor = None
+        if len(docs) > limit:
+            docs = docs[:limit]
+            next_cursor = _encode_market_cursor(docs[-1].get(field), docs[-1].get('_id'))
+        return {"ok": True, "items": [_market_card(d) for d in docs], "next_cursor": next_cursor}
+
+    def get_market_page(typ: str, sort: str, rarity: str = None, cursor: str = None, limit: int = None) -> str:
+        """JSON body for one listing page, served from the redis page cache when possible."""
+        limit = max(1, min(safe_int(limit, MARKET_PAGE_DEFAULT), MARKET_PAGE_MAX))
+        cacheable = sort != 'random' and r is not None
+        key = None
+        if cacheable:
+            key = f"market:page:{typ}:{market_version(typ)}:{sort}:{rarity or 'all'}:{limit}:{cursor or ''}"
+            try:
+                body = r.get(key)
+                if body:
+                    return body
+            except Exception:
+                pass
+        body = json.dumps(query_market_page(typ, sort, rarity, cursor, limit))
+        if cacheable:
+            try:
+                r.set(key, body, ex=MARKET_CACHE_TTL)
+            except Exception:
+                pass
+        return body
+
+    # ---------- market purchases ----------
+    # Redis is the authority for stock and balance during a sale: one Lua
+    # script checks the idempotency key, stock and balance, then decrements
+    # stock and debits the buyer atomically, so concurrent buyers can never
+    # oversell. The character is then delivered to MongoDB through steps
+    # that are each idempotent per purchase id (market_purchases record,
+    # guarded $push, claimed stock mirror), so a replayed request re-runs
+    # delivery safely instead of buying twice.
+    # The item hash is a seed of the Mongo doc that expires after
+    # MARKET_SEED_TTL, so restocks and price changes made in Mongo are picked
+    # up on the next reseed; a sold-out answer also rechecks Mongo (at most
+    # every MARKET_RESTOCK_CHECK seconds per item). Sales not yet mirrored
+    # to Mongo's stock are tracked in market:unsynced:{id} and subtracted
+    # whenever the hash is reseeded.
+    # KEYS: item hash, user hash, global board, idempotency key, leaderboard version, ledger stream, outbox,
+    #       unsynced purchases set
+    # ARGV: user_id, idempotency ttl, channel, title, ref, ledger maxlen, outbox maxlen, purchase id
+    MARKET_BUY_LUA = LEDGER_APPEND_LUA + """
+local done = redis.call('GET', KEYS[4])
+if done then return {'replay', done} end
+if redis.call('EXISTS', KEYS[1]) == 0 then return {'unseeded', ''} end
+local stock = tonumber(redis.call('HGET', KEYS[1], 'stock')) or 0
+local price = tonumber(redis.call('HGET', KEYS[1], 'price')) or 0
+if stock <= 0 then return {'error', cjson.encode({ok = false, error = 'Sold out'})} end
+local bal = tonumber(redis.call('HGET', KEYS[2], 'charm')) or tonumber(redis.call('HGET', KEYS[2], 'charms'))
+    or tonumber(redis.call('HGET', KEYS[2], 'balance')) or tonumber(redis.call('ZSCORE', KEYS[3], ARGV[1])) or 0
+bal = math.floor(bal)
+if bal < price then return {'error', cjson.encode({ok = false, error = 'No Balance'})} end
+local left = redis.call('HINCRBY', KEYS[1], 'stock', -1)
+redis.call('SADD', KEYS[8], ARGV[8])
+local nb = bal - price
+redis.call('HSET', KEYS[2], 'charm', tostring(nb))
+redis.call('HSET', KEYS[2], 'charms', tostring(nb))
+redis.call('ZADD', KEYS[3], nb, ARGV[1])
+redis.call('INCR', KEYS[5])
+ledger_append(KEYS[6], KEYS[7], ARGV[1], -price, nb, redis.call('HGET', KEYS[1], 'type') or '', ARGV[4], ARGV[5], ARGV[6], ARGV[7])
+redis.call('PUBLISH', ARGV[3], cjson.encode({user_id = ARGV[1], charms = nb, type = cjson.null}))
+local out = cjson.encode({ok = true, balance = nb, stock = left, price = price})
+redis.call('SET', KEYS[4], out, 'EX', ARGV[2])
+return {'new', out}
+"""
+    # KEYS: item hash, unsynced purchases set
+    # ARGV: mongo stock, price, type, ttl, mode ('missing': only seed an absent hash,
+    #       'restock': only raise the stock)
+    MARKET_SEED_LUA = """
+local stock = tonumber(ARGV[1]) - redis.call('SCARD', KEYS[2])
+if stock < 0 then stock = 0 end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    if ARGV[5] == 'missing' then return 0 end
+    if ARGV[5] == 'restock' and stock <= (tonumber(redis.call('HGET', KEYS[1], 'stock')) or 0) then return 0 end
+end
+redis.call('HSET', KEYS[1], 'stock', stock, 'price', ARGV[2], 'type', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+    MARKET_IDEMPOTENCY_TTL = safe_int(os.getenv('MARKET_IDEMPOTENCY_TTL'), 86400)
+    MARKET_SEED_TTL = safe_int(os.getenv('MARKET_SEED_TTL'), 60)
+    MARKET_RESTOCK_CHECK = safe_int(os.getenv('MARKET_RESTOCK_CHECK'), 1)
+    market_item_cache = TTLCache(maxsize=5000, ttl=float(os.getenv('MARKET_ITEM_CACHE_TTL', '30') or 30))
+    _market_buy_script = _market_seed_script = None
+    if r is not None:
+        try:
+            _market_buy_script = r.register_script(MARKET_BUY_LUA)
+            _market_seed_script = r.register_script(MARKET_SEED_LUA)
+        except Exception as ex:
+            print(f"[buy_market] lua unavailable: {ex}", flush=True)
+
+    class PurchaseError(Exception):
+        def __init__(self, message: str, status: int = 400):
+            super().__init__(message)
+            self.status = status
+
+    def _market_item_id(item_id: str):
+        if ObjectId is not None and ObjectId.is_valid(str(item_id)):
+            return ObjectId(str(item_id))
+        return item_id
+
+    def get_market_item(item_id: str):
+        item = market_item_cache.get(str(item_id))
+        if item is None and market_coll is not None:
+            item = market_coll.find_one({'_id': _market_item_id(item_id)})
+            if item:
+                market_item_cache.set(str(item_id), item)
+        return item
+
+    def seed_market_item(item_id, mode: str = 'missing') -> bool:
+        """Seed market:item:{id} from a fresh read of the Mongo doc; see MARKET_SEED_LUA for modes."""
+        item = market_coll.find_one({'_id': _market_item_id(item_id)}) if market_coll is not None else None
+        if not item:
+            return False
+        market_item_cache.set(str(item_id), item)
+        return bool(_market_seed_script(
+            keys=[f"market:item:{item['_id']}", f"market:unsynced:{item['_id']}"],
+            args=[safe_int(item.get('stock'), 0), safe_int(item.get('price'), 0), str(item.get('type') or 'waifu'),
+                  MARKET_SEED_TTL, mode]))
+
+    def _restocked(item_id) -> bool:
+        """After a sold-out answer: reseed if Mongo now has more stock, checked once per MARKET_RESTOCK_CHECK."""
+        try:
+            if not r.set(f"market:restock_check:{item_id}", 1, nx=True, ex=max(1, MARKET_RESTOCK_CHECK)):
+                return False
+            return seed_market_item(item_id, mode='restock')
+        except Exception as ex:
+            print(f"[buy_market] restock check err={ex}", flush=True)
+            return False
+
+    def _deliver_purchase(purchase_id: str, uid: str, item: dict):
+        typ = 'husband' if str(item.get('type') or '').lower() == 'husband' else 'waifu'
+        users_coll = husband_users_coll if typ == 'husband' else waifu_users_coll
+        now = datetime.utcnow()
+        if market_purchases_coll is not None:
+            market_purchases_coll.update_one({'_id': purchase_id}, {'$setOnInsert': {
+                'user_id': uid, 'item_id': str(item['_id']), 'type': typ, 'price': safe_int(item.get('price'), 0),
+                'status': 'reserved', 'created_at': now}}, upsert=True)
+        entry = {
+            'id': str(item.get('char_id') or item.get('character_id') or item.get('id') or item['_id']),
+            'name': item.get('name') or 'Unknown',
+            'rarity': item.get('rarity'),
+            'img_url': _pick_first_valid_image(item.get('image') or item.get('img_url')),
+            'purchase_id': purchase_id,
+        }
+        doc_id = None
+        if users_coll is not None:
+            ref = _find_doc_in_coll_variants(users_coll, uid, projection={'_id': 1}, order=COLLECTION_LOOKUP_ORDER)
+            if ref:
+                doc_id = ref['_id']
+                users_coll.update_one({'_id': doc_id, 'characters.purchase_id': {'$ne': purchase_id}},
+                                      {'$push': {'characters': entry}, '$set': {'updated_at': now}})
+            else:
+                doc_id = users_coll.insert_one({'id': uid, 'characters': [entry], 'updated_at': now}).inserted_id
+        claimed = True
+        if market_purchases_coll is not None:
+            claimed = market_purchases_coll.find_one_and_update(
+                {'_id': purchase_id, 'stock_synced': {'$ne': True}}, {'$set': {'stock_synced': True}}) is not None
+        if claimed and market_coll is not None:
+            market_coll.update_one({'_id': item['_id'], 'stock': {'$gt': 0}}, {'$inc': {'stock': -1}})
+        if r is not None:
+            r.srem(f"market:unsynced:{item['_id']}", purchase_id)
+        if market_purchases_coll is not None:
+            market_purchases_coll.update_one({'_id': purchase_id}, {'$set': {'status': 'delivered', 'delivered_at': now}})
+        if doc_id is not None:
+            try:
+                refresh_character_count(typ, doc_id)
+            except Exception:
+                pass
+        invalidate_market(typ)
+
+    def buy_market_item(uid: str, item_id: str, idempotency_key: str = None) -> dict:
+        if r is None or _market_buy_script is None:
+            raise PurchaseError("market unavailable", 503)
+        uid = str(uid)
+        item = get_market_item(item_id)
+        if not item:
+            raise PurchaseError("item not found", 404)
+        purchase_id = f"{uid}:{idempotency_key}" if idempotency_key else f"{uid}:{uuid.uuid4().hex}"
+        lkeys, largs = _ledger_args(uid, f"Bought {item.get('name') or 'a character'}", purchase_id)
+        keys = [f"market:item:{item['_id']}", f"user:{uid}", 'leaderboard:charms',
+                f"market:purchase:{purchase_id}", 'leaderboard:version'] + lkeys + [f"market:unsynced:{item['_id']}"]
+        args = [uid, MARKET_IDEMPOTENCY_TTL, 'charms_updates'] + largs + [purchase_id]
+        _ensure_ledger_archiver()
+        status, payload = _market_buy_script(keys=keys, args=args)
+        if status == 'unseeded':
+            seed_market_item(item['_id'])
+            status, payload = _market_buy_script(keys=keys, args=args)
+        result = json.loads(payload or '{}')
+        if status == 'error' and result.get('error') == 'Sold out' and _restocked(item['_id']):
+            status, payload = _market_buy_script(keys=keys, args=args)
+            result = json.loads(payload or '{}')
+        if status == 'error':
+            raise PurchaseError(result.get('error') or 'purchase failed', 409 if result.get('error') == 'Sold out' else 402)
+        # deliver on replays as well: every step is idempotent per purchase id
+        _deliver_purchase(purchase_id, uid, item)
+        if status == 'new':
+            queue_profile_write(uid, charms=result.get('balance'))
+        result['purchase_id'] = purchase_id
+        result['replayed'] = status == 'replay'
+        return result
+
+    # ---------- peer-to-peer transfers ----------
+    # Moves charms between two users in one script: both balances, both
+    # leaderboard entries, both ledger entries and the optional idempotency
+    # record change together or not at all. top_global_db follows through
+    # the write-behind queue, so a burst of transfers costs one bulk write
+    # per flush instead of two upserts per transfer.
+    # KEYS: sender hash, recipient hash, global board, version counter,
+    #       sender ledger, recipient ledger, outbox, idempotency key ('' for none)
+    # ARGV: from, to, amount, channel, title out, title in, ref, ledger maxlen,
+    #       outbox maxlen, allow new recipient ('1'/'0'), idempotency ttl
+    TRANSFER_LUA = LEDGER_APPEND_LUA + """
+if KEYS[8] ~= '' then
+    local done = redis.call('GET', KEYS[8])
+    if done then return {'replay', done, ''} end
+end
+local function balance(hash, uid)
+    local b = tonumber(redis.call('HGET', hash, 'charm')) or tonumber(redis.call('HGET', hash, 'charms'))
+        or tonumber(redis.call('HGET', hash, 'balance')) or tonumber(redis.call('ZSCORE', KEYS[3], uid))
+    if b then return math.floor(b) end
+    return nil
+end
+local amt = tonumber(ARGV[3])
+local from_bal = balance(KEYS[1], ARGV[1]) or 0
+if from_bal < amt then return {'error', cjson.encode({ok = false, error = 'No Balance'}), ''} end
+local to_bal = balance(KEYS[2], ARGV[2])
+if to_bal == nil then
+    if ARGV[10] ~= '1' then return {'unknown', '', ''} end
+    to_bal = 0
+end
+local nf = from_bal - amt
+local nt = to_bal + amt
+redis.call('HSET', KEYS[1], 'charm', tostring(nf), 'charms', tostring(nf))
+redis.call('HSET', KEYS[2], 'charm', tostring(nt), 'charms', tostring(nt))
+redis.call('ZADD', KEYS[3], nf, ARGV[1], nt, ARGV[2])
+redis.call('INCR', KEYS[4])
+ledger_append(KEYS[5], KEYS[7], ARGV[1], -amt, nf, '', ARGV[5], ARGV[7], ARGV[8], ARGV[9])
+ledger_append(KEYS[6], KEYS[7], ARGV[2], amt, nt, '', ARGV[6], ARGV[7], ARGV[8], ARGV[9])
+redis.call('PUBLISH', ARGV[4], cjson.encode({user_id = ARGV[1], charms = nf, type = cjson.null}))
+redis.call('PUBLISH', ARGV[4], cjson.encode({user_id = ARGV[2], charms = nt, type = cjson.null}))
+local out = cjson.encode({ok = true, balance = nf, amount = amt, to_user_id = ARGV[2]})
+if KEYS[8] ~= '' then redis.call('SET', KEYS[8], out, 'EX', ARGV[11]) end
+return {'new', out, tostring(nt)}
+"""
+    TRANSFER_MAX_AMOUNT = safe_int(os.getenv('TRANSFER_MAX_AMOUNT'), 1000000)
+    TRANSFER_RATE_LIMIT = safe_int(os.getenv('TRANSFER_RATE_LIMIT'), 10)
+    TRANSFER_RATE_WINDOW = safe_int(os.getenv('TRANSFER_RATE_WINDOW'), 60)
+    TRANSFER_IDEMPOTENCY_TTL = safe_int(os.getenv('TRANSFER_IDEMPOTENCY_TTL'), 86400)
+    _transfer_script = None
+    if r is not None:
+        try:
+            _transfer_script = r.register_script(TRANSFER_LUA)
+        except Exception as ex:
+            print(f"[transfer] lua unavailable: {ex}", flush=True)
+
+    class TransferError(Exception):
+        def __init__(self, message: str, status: int = 400, retry_after: int = None):
+            super().__init__(message)
+            self.status = status
+            self.retry_after = retry_after
+
+    def check_rate_limit(name: str, uid: str, limit: int, window: int) -> int:
+        """Fixed-window counter shared by all workers. Returns seconds to wait, 0 when allowed."""
+        if r is None or limit <= 0:
+            return 0
+        now = int(time.time())
+        key = f"ratelimit:{name}:{uid}:{now // window}"
+        pipe = r.pipeline(transaction=False)
+        pipe.incr(key)
+        pipe.expire(key, window + 1)
+        n, _ = pipe.execute()
+        if int(n) > limit:
+            return max(1, window - now % window)
+        return 0
+
+    def _known_user(uid_s: str) -> bool:
+        for coll in (registered_users, top_global_coll):
+            if coll is not None and _find_doc_in_coll_variants(coll, uid_s, projection={'_id': 1}) is not None:
+                return True
+        return False
+
+    def transfer_charms(from_uid: str, to_uid: str, amount, idempotency_key: str = None) -> dict:
+        if r is None or _transfer_script is None:
+            raise TransferError("transfers unavailable", 503)
+        from_s, to_s = str(from_uid), str(to_uid)
+        if from_s == to_s:
+            raise TransferError("cannot send charms to yourself")
+        try:
+            amt = int(str(amount).strip())
+        except Exception:
+            raise TransferError("amount must be a whole number")
+        if amt <= 0 or amt > TRANSFER_MAX_AMOUNT:
+            raise TransferError(f"amount must be between 1 and {TRANSFER_MAX_AMOUNT}")
+        idem_key = f"transfer:{from_s}:{idempotency_key}" if idempotency_key else ''
+        # replays of an already settled transfer are not rate limited
+        if not (idem_key and r.exists(idem_key)):
+            wait = check_rate_limit('transfer', from_s, TRANSFER_RATE_LIMIT, TRANSFER_RATE_WINDOW)
+            if wait:
+                raise TransferError("too many transfers, slow down", 429, retry_after=wait)
+        ref = f"{from_s}:{idempotency_key}" if idempotency_key else f"{from_s}:{uuid.uuid4().hex}"
+        _ensure_ledger_archiver()
+        keys = [f"user:{from_s}", f"user:{to_s}", 'leaderboard:charms', 'leaderboard:version',
+                LEDGER_KEY.format(from_s), LEDGER_KEY.format(to_s), LEDGER_OUTBOX_KEY, idem_key]
+
+        def _run(allow_new):
+            return _transfer_script(keys=keys, args=[
+                from_s, to_s, amt, 'charms_updates', f"Sent to {to_s}", f"Received from {from_s}", ref,
+                LEDGER_STREAM_MAXLEN, LEDGER_OUTBOX_MAXLEN, '1' if allow_new else '0', TRANSFER_IDEMPOTENCY_TTL])
+
+        status, payload, to_balance = _run(False)
+        if status == 'unknown':
+            # recipient has no redis state yet; only create it for users we know about
+            if not _known_user(to_s):
+                raise TransferError("recipient not found", 404)
+            status, payload, to_balance = _run(True)
+        result = json.loads(payload or '{}')
+        if status == 'error':
+            raise TransferError(result.get('error') or 'transfer failed', 402)
+        if status == 'new':
+            queue_profile_write(from_s, charms=result.get('balance'))
+            queue_profile_write(to_s, charms=safe_int(to_balance, 0))
+        result['transfer_id'] = ref
+        result['replayed'] = status == 'replay'
+        return result
+
+    # ---------- friends ----------
+    # Adjacency lives in redis sets (friends:{uid}, incoming requests in
+    # friends:requests:{uid}), so membership checks are O(1). The
+    # friendships collection is the durable copy: a user's sets are loaded
+    # from it once (friends:loaded:{uid} marks that) and every change is
+    # written to both. The friends-only ranking is a ZINTERSTORE of the
+    # adjacency set with leaderboard:charms, and the whole list is hydrated
+    # through hydrate_top_rows, so 500 friends cost the same handful of
+    # round trips as 5.
+    FRIENDS_KEY = 'friends:{}'
+    FRIEND_REQUESTS_KEY = 'friends:requests:{}'
+    FRIENDS_RANK_KEY = 'friends:rank:{}'
+    FRIENDS_LOADED_KEY = 'friends:loaded:{}'
+    FRIENDS_MAX = safe_int(os.getenv('FRIENDS_MAX'), 1000)
+    FRIENDS_LOADED_TTL = safe_int(os.getenv('FRIENDS_LOADED_TTL'), 86400)
+    FRIENDS_RANK_TTL = safe_int(os.getenv('FRIENDS_RANK_TTL'), 60)
+
+    class FriendError(Exception):
+        def __init__(self, message: str, status: int = 400):
+            super().__init__(message)
+            self.status = status
+
+    def ensure_friend_indexes():
+        if friendships_coll is None:
+            return
+        try:
+            friendships_coll.create_index([('users', 1)])
+        except Exception as ex:
+            print(f"[ensure_friend_indexes] err={ex}", flush=True)
+
+    if os.getenv('ENSURE_INDEXES', '1') not in ('0', 'false', 'no'):
+        threading.Thread(target=ensure_friend_indexes, name='ensure-friend-indexes', daemon=True).start()
+
+    def _friendship_id(a: str, b: str) -> str:
+        return '|'.join(sorted((a, b)))
+
+    def _load_friends(uids):
+        """Populate the redis adjacency sets of uids from the friendships collection if not loaded yet."""
+        pipe = r.pipeline(transaction=False)
+        for u in uids:
+            pipe.exists(FRIENDS_LOADED_KEY.format(u))
+        todo = [u for u, loaded in zip(uids, pipe.execute()) if not loaded]
+        if not todo:
+            return
+        pipe = r.pipeline(transaction=False)
+        if friendships_coll is not None:
+            for d in friendships_coll.find({'users': {'$in': todo}}):
+                a, b = (list(d.get('users') or []) + [None, None])[:2]
+                if not a or not b:
+                    continue
+                if d.get('status') == 'accepted':
+                    for me, other in ((a, b), (b, a)):
+                        if me in todo:
+                            pipe.sadd(FRIENDS_KEY.format(me), other)
+                elif d.get('from') in (a, b):
+                    to = b if d['from'] == a else a
+                    if to in todo:
+                        pipe.sadd(FRIEND_REQUESTS_KEY.format(to), d['from'])
+        for u in todo:
+            pipe.set(FRIENDS_LOADED_KEY.format(u), '1', ex=FRIENDS_LOADED_TTL)
+        pipe.execute()
+
+    def add_friend(uid: str, friend_id: str) -> str:
+        """Send a friend request, or accept one if friend_id already asked. Returns the resulting status."""
+        if r is None:
+            raise FriendError("friends unavailable", 503)
+        uid_s, fid = str(uid), str(friend_id)
+        if uid_s == fid:
+            raise FriendError("cannot add yourself")
+        if not r.exists(f"user:{fid}") and not _known_user(fid):
+            raise FriendError("user not found", 404)
+        _load_friends([uid_s, fid])
+        pipe = r.pipeline(transaction=False)
+        pipe.sismember(FRIENDS_KEY.format(uid_s), fid)
+        pipe.sismember(FRIEND_REQUESTS_KEY.format(uid_s), fid)
+        pipe.scard(FRIENDS_KEY.format(uid_s))
+        already, incoming, count = pipe.execute()
+        if already:
+            return 'friends'
+        if int(count or 0) >= FRIENDS_MAX:
+            raise FriendError(f"friend list is full ({FRIENDS_MAX})", 409)
+        now = datetime.utcnow()
+        pipe = r.pipeline(transaction=True)
+        if incoming:
+            if friendships_coll is not None:
+                friendships_coll.update_one({'_id': _friendship_id(uid_s, fid)},
+                                            {'$set': {'status': 'accepted', 'accepted_at': now},
+                                             '$setOnInsert': {'users': sorted((uid_s, fid)), 'from': fid, 'created_at': now}},
+                                            upsert=True)
+            pipe.sadd(FRIENDS_KEY.format(uid_s), fid)
+            pipe.sadd(FRIENDS_KEY.format(fid), uid_s)
+            pipe.srem(FRIEND_REQUESTS_KEY.format(uid_s), fid)
+            pipe.srem(FRIEND_REQUESTS_KEY.format(fid), uid_s)
+            pipe.delete(FRIENDS_RANK_KEY.format(uid_s), FRIENDS_RANK_KEY.format(fid))
+            status = 'friends'
+        else:
+            if friendships_coll is not None:
+                friendships_coll.update_one({'_id': _friendship_id(uid_s, fid), 'status': {'$ne': 'accepted'}},
+                                            {'$set': {'status': 'pending', 'from': uid_s, 'users': sorted((uid_s, fid)),
+                                                      'created_at': now}},
+                                            upsert=True)
+            pipe.sadd(FRIEND_REQUESTS_KEY.format(fid), uid_s)
+            status = 'requested'
+        pipe.execute()
+        return status
+
+    def remove_friend(uid: str, friend_id: str):
+        """Unfriend, cancel an outgoing request or decline an incoming one."""
+        if r is None:
+            raise FriendError("friends unavailable", 503)
+        uid_s, fid = str(uid), str(friend_id)
+        _load_friends([uid_s, fid])
+        if friendships_coll is not None:
+            friendships_coll.delete_one({'_id': _friendship_id(uid_s, fid)})
+        pipe = r.pipeline(transaction=True)
+        pipe.srem(FRIENDS_KEY.format(uid_s), fid)
+        pipe.srem(FRIENDS_KEY.format(fid), uid_s)
+        pipe.srem(FRIEND_REQUESTS_KEY.format(uid_s), fid)
+        pipe.srem(FRIEND_REQUESTS_KEY.format(fid), uid_s)
+        pipe.delete(FRIENDS_RANK_KEY.format(uid_s), FRIENDS_RANK_KEY.format(fid))
+        pipe.execute()
+
+    def list_friends(uid: str, limit: int = None) -> dict:
+        """Friends ranked by charms plus incoming requests, hydrated in one pass."""
+        if r is None:
+            return {'items': [], 'requests': [], 'count': 0}
+        uid_s = str(uid)
+        limit = max(1, min(safe_int(limit, FRIENDS_MAX), FRIENDS_MAX))
+        _load_friends([uid_s])
+        fkey, rank_key = FRIENDS_KEY.format(uid_s), FRIENDS_RANK_KEY.format(uid_s)
+        # the intersection is reused for FRIENDS_RANK_TTL (charm changes show
+        # up after that); add/remove_friend delete it when the set changes
+        pipe = r.pipeline(transaction=False)
+        pipe.exists(rank_key)
+        pipe.zrevrange(rank_key, 0, limit - 1, withscores=True)
+        pipe.smembers(fkey)
+        pipe.smembers(FRIEND_REQUESTS_KEY.format(uid_s))
+        cached, ranked, members, requests_in = pipe.execute()
+        if not cached and members:
+            pipe = r.pipeline(transaction=False)
+            # friends are a plain set (score 1), so weights 1/0 keep the charm score
+            pipe.zinterstore(rank_key, {'leaderboard:charms': 1, fkey: 0})
+            pipe.expire(rank_key, FRIENDS_RANK_TTL)
+            pipe.zrevrange(rank_key, 0, limit - 1, withscores=True)
+            _n, _e, ranked = pipe.execute()
+        pairs = [(m, sc) for m, sc in ranked]
+        seen = {m for m, _ in pairs}
+        # friends without a leaderboard entry have no charms yet
+        pairs.extend((m, 0) for m in sorted(members or ()) if m not in seen)
+        pairs = pairs[:limit]
+        req_pairs = [(m, 0) for m in sorted(requests_in or ())][:limit]
+        rows = hydrate_top_rows(pairs + req_pairs)
+        items = rows[:len(pairs)]
+        requests_out = []
+        for row in rows[len(pairs):]:
+            requests_out.append({k: row[k] for k in ('user_id', 'name', 'username', 'avatar')})
+        return {'items': items, 'requests': requests_out, 'count': len(members or ())}
+
+    # ---------- user settings ----------
+    # Settings live in their own redis hash (settings:{uid}) and reach
+    # registered_users.settings through the write-behind queue. The hash
+    # always carries a `_loaded` marker, so a user without settings is still
+    # a single HGETALL after the first load. Uploaded theme/BGM files are
+    # not kept in the hash: they are stored once per content hash in
+    # user_assets and the setting holds their immutable URL.
+    SETTINGS_KEY = 'settings:{}'
+    SETTINGS_FIELDS = ('lang', 'theme_url', 'bgm_url')
+    SETTINGS_UPLOADS = {'theme_b64': ('theme_url', 'image/'), 'bgm_b64': ('bgm_url', 'audio/')}
+    SETTINGS_ASSET_MAX_BYTES = safe_int(os.getenv('SETTINGS_ASSET_MAX_BYTES'), 8 * 1024 * 1024)
+    SETTINGS_VALUE_MAX = 2048
+
+    def _store_settings_asset(data_uri: str, kind: str) -> str:
+        m = re.match(r'^data:([\w.+-]+/[\w.+-]+)(?:;[^,]*)?;base64,', data_uri or '')
+        if not m or not m.group(1).startswith(kind):
+            raise ValueError(f"expected a base64 {kind}* data URI")
+        try:
+            raw = base64.b64decode(data_uri[m.end():], validate=False)
+        except Exception:
+            raise ValueError("invalid base64 payload")
+        if len(raw) > SETTINGS_ASSET_MAX_BYTES:
+            raise ValueError(f"file too large (max {SETTINGS_ASSET_MAX_BYTES} bytes)")
+        if user_assets_coll is None:
+            raise RuntimeError("asset storage unavailable")
+        asset_id = hashlib.sha1(raw).hexdigest()
+        user_assets_coll.update_one({'_id': asset_id}, {'$setOnInsert': {
+            'mimetype': m.group(1), 'data': raw, 'size': len(raw), 'created_at': datetime.utcnow()}}, upsert=True)
+        return f"/api/settings_asset/{asset_id}"
+
+    def get_settings_asset(asset_id: str):
+        if user_assets_coll is None or not re.fullmatch(r'[0-9a-f]{40}', asset_id or ''):
+            return None
+        return user_assets_coll.find_one({'_id': asset_id})
+
+    def get_user_settings(uid: str) -> dict:
+        uid_s = str(uid)
+        if r is None:
+            doc = _find_doc_in_coll_variants(registered_users, uid_s, projection={'settings': 1}) if registered_users is not None else None
+            return {k: v for k, v in ((doc or {}).get('settings') or {}).items() if k in SETTINGS_FIELDS and v is not None}
+        key = SETTINGS_KEY.format(uid_s)
+        h = r.hgetall(key) or {}
+        if not h:
+            h = {'_loaded': '1'}
+            if registered_users is not None:
+                doc = _find_doc_in_coll_variants(registered_users, uid_s, projection={'settings': 1})
+                for k, v in ((doc or {}).get('settings') or {}).items():
+                    if k in SETTINGS_FIELDS and v is not None:
+                        h[k] = str(v)
+            # only fill in fields a concurrent patch has not already written
+            pipe = r.pipeline(transaction=False)
+            for k, v in h.items():
+                pipe.hsetnx(key, k, v)
+            pipe.execute()
+        return {k: v for k, v in h.items() if k in SETTINGS_FIELDS}
+
+    def update_user_settings(uid: str, patch: dict) -> dict:
+        """Apply a partial multi-field settings patch in one redis round trip. None clears a field."""
+        uid_s = str(uid)
+        updates, clears = {}, []
+        for field, (target, kind) in SETTINGS_UPLOADS.items():
+            if patch.get(field):
+                updates[target] = _store_settings_asset(patch[field], kind)
+        for field in SETTINGS_FIELDS:
+            if field not in patch or field in updates:
+                continue
+            v = patch[field]
+            if v is None or v == '':
+                clears.append(field)
+            elif len(str(v)) > SETTINGS_VALUE_MAX:
+                raise ValueError(f"{field} is too long")
+            else:
+                updates[field] = str(v)
+        if not updates and not clears:
+            raise ValueError("no settings to update")
+        if r is not None:
+            get_user_settings(uid_s)
+            pipe = r.pipeline(transaction=True)
+            if updates:
+                pipe.hset(SETTINGS_KEY.format(uid_s), mapping=updates)
+            if clears:
+                pipe.hdel(SETTINGS_KEY.format(uid_s), *clears)
+            pipe.execute()
+            queue_profile_write(uid_s, registered=dict({f"settings.{k}": v for k, v in updates.items()},
+                                                       **{f"settings.{k}": None for k in clears}))
+        elif registered_users is not None:
+            registered_users.update_one({'user_id': uid_s}, {'$set': dict(
+                {f"settings.{k}": v for k, v in updates.items()}, **{f"settings.{k}": None for k in clears})}, upsert=True)
+        return get_user_settings(uid_s)
+
+    # ---------- receive QR codes ----------
+    # A user's receive code never changes for a given payload and render
+    # settings, so it is rendered once and kept as PNG bytes on local disk
+    # and (base64, since the shared client decodes responses) in redis. The
+    # cache key doubles as the ETag and as the `v` that makes the raw PNG
+    # URL immutable.
+    QR_PAYLOAD_TEMPLATE = os.getenv('QR_PAYLOAD_TEMPLATE', '{user_id}')
+    QR_BOX_SIZE = safe_int(os.getenv('QR_BOX_SIZE'), 8)
+    QR_BORDER = safe_int(os.getenv('QR_BORDER'), 2)
+    QR_CACHE_DIR = os.getenv('QR_CACHE_DIR', os.path.join('/tmp', 'keep-qr-cache'))
+    QR_REDIS_TTL = safe_int(os.getenv('QR_REDIS_TTL'), 30 * 86400)
+    _qr_stats = {'disk_hits': 0, 'redis_hits': 0, 'renders': 0, 'errors': 0}
+
+    def run_blocking(fn, *args):
+        """Run CPU-bound fn on a real OS thread when gevent has patched threading, so the hub keeps serving."""
+        if gevent is not None:
+            from gevent import monkey as _gevent_monkey
+            if _gevent_monkey.is_module_patched('threading'):
+                return gevent.get_hub().threadpool.apply(fn, args)
+        return fn(*args)
+
+    def qr_cache_key(uid: str) -> str:
+        payload = QR_PAYLOAD_TEMPLATE.format(user_id=uid)
+        raw = f"{payload}|{QR_BOX_SIZE}|{QR_BORDER}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:20]
+
+    def _render_qr_png(payload: str) -> bytes:
+        qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=QR_BOX_SIZE, border=QR_BORDER)
+        qr.add_data(payload)
+        qr.make(fit=True)
+        buf = io.BytesIO()
+        qr.make_image(fill_color='black', back_color='white').save(buf, format='PNG', optimize=True)
+        return buf.getvalue()
+
+    def _qr_disk_path(key: str) -> str:
+        return os.path.join(QR_CACHE_DIR, f"{key}.png")
+
+    def _qr_disk_store(key: str, png: bytes):
+        try:
+            os.makedirs(QR_CACHE_DIR, exist_ok=True)
+            tmp = f"{_qr_disk_path(key)}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as fh:
+                fh.write(png)
+            os.replace(tmp, _qr_disk_path(key))
+        except Exception as ex:
+            print(f"[qr_code][disk_error] {ex}", flush=True)
+
+    def get_qr_png(uid: str):
+        """Return (png_bytes, key) for uid's receive code, rendering it at most once per payload."""
+        uid_s = str(uid)
+        key = qr_cache_key(uid_s)
+        try:
+            with open(_qr_disk_path(key), 'rb') as fh:
+                _qr_stats['disk_hits'] += 1
+                return fh.read(), key
+        except OSError:
+            pass
+        if r is not None:
+            try:
+                cached = r.get(f"qr:{key}")
+                if cached:
+                    png = base64.b64decode(cached)
+                    _qr_stats['redis_hits'] += 1
+                    _qr_disk_store(key, png)
+                    return png, key
+            except Exception as ex:
+                print(f"[qr_code][redis_error] {ex}", flush=True)
+        if qrcode is None:
+            raise RuntimeError("qrcode is not installed")
+        try:
+            png = run_blocking(_render_qr_png, QR_PAYLOAD_TEMPLATE.format(user_id=uid_s))
+        except Exception:
+            _qr_stats['errors'] += 1
+            raise
+        _qr_stats['renders'] += 1
+        _qr_disk_store(key, png)
+        if r is not None:
+            try:
+                r.set(f"qr:{key}", base64.b64encode(png).decode('ascii'), ex=QR_REDIS_TTL)
+            except Exception as ex:
+                print(f"[qr_code][redis_error] {ex}", flush=True)
+        return png, key
+
+    # ---------- character-count leaderboards ----------
+    # Per-type character counts are kept both as a stored, indexed
+    # `character_count` field on the user documents and in the
+    # leaderboard:chars:{type} sorted set, so the typed fallback of /api/top
+    # is a top-N read instead of a $size aggregation over the collection.
+    # The backfill-character-counts command seeds both; afterwards a change
+    # stream watcher (and record_character_count for our own writes) keeps
+    # them current.
+    CHAR_COUNT_KEY = 'leaderboard:chars:{}'
+    CHAR_COUNT_PROJECTION = {"user_id": {"$ifNull": ["$id", "$user_id"]},
+                             "character_count": {"$cond": {"if": {"$isArray": "$characters"}, "then": {"$size": "$characters"}, "else": 0}}}
+
+    def _char_count_colls():
+        out = []
+        for typ, coll in (('waifu', waifu_users_coll), ('husband', husband_users_coll)):
+            if coll is not None:
+                out.append((typ, coll))
+        return out
+
+    def record_character_count(typ: str, uid: str, count: int, doc_id=None):
+        """Store a user's character count for typ (field + sorted set)."""
+        coll = dict(_char_count_colls()).get(typ)
+        if r is not None:
+            try:
+                r.zadd(CHAR_COUNT_KEY.format(typ), {str(uid): int(count)})
+            except Exception as ex:
+                print(f"[character_count][redis_error] {ex}", flush=True)
+        if coll is not None and doc_id is not None:
+            try:
+                coll.update_one({'_id': doc_id}, {'$set': {'character_count': int(count)}})
+            except Exception as ex:
+                print(f"[character_count][mongo_error] {ex}", flush=True)
+
+    def refresh_character_count(typ: str, doc_id):
+        """Recount one document server-side (no characters transferred) and record it."""
+        coll = dict(_char_count_colls()).get(typ)
+        if coll is None:
+            return None
+        for d in coll.aggregate([{"$match": {"_id": doc_id}}, {"$project": CHAR_COUNT_PROJECTION}]):
+            if d.get('user_id') is not None:
+                record_character_count(typ, d.get('user_id'), d.get('character_count') or 0, doc_id=doc_id)
+            return d.get('character_count') or 0
+        return None
+
+    def backfill_character_counts(types=None, batch: int = 1000, log=print) -> dict:
+        result = {}
+        for typ, coll in _char_count_colls():
+            if types and typ not in types:
+                continue
+            try:
+                coll.create_index([('character_count', -1)])
+            except Exception as ex:
+                log(f"[backfill_character_counts] {typ}: index error {ex}")
+            key = CHAR_COUNT_KEY.format(typ)
+            n = 0
+            ops = []
+            members = {}
+
+            def _flush():
+                if ops:
+                    coll.bulk_write(ops, ordered=False)
+                if r is not None and members:
+                    r.zadd(key, members)
+                ops.clear()
+                members.clear()
+
+            if r is not None:
+                r.delete(key)
+            for d in coll.aggregate([{"$project": CHAR_COUNT_PROJECTION}], allowDiskUse=True):
+                cnt = int(d.get('character_count') or 0)
+                ops.append(UpdateOne({'_id': d['_id']}, {'$set': {'character_count': cnt}}))
+                if d.get('user_id') is not None:
+                    members[str(d.get('user_id'))] = cnt
+                n += 1
+                if len(ops) >= batch:
+                    _flush()
+            _flush()
+            result[typ] = n
+            log(f"[backfill_character_counts] {typ}: {n} documents")
+        return result
+
+    def top_by_character_count(typ: str, users_coll, limit: int):
+        """(uid, count) pairs: sorted set, then the indexed field, then the old aggregation."""
+        try:
+            if r is not None:
+                raw = r.zrevrange(CHAR_COUNT_KEY.format(typ), 0, limit - 1, withscores=True)
+                if raw:
+                    return [(str(m), int(sc)) for m, sc in raw]
+        except Exception:
+            pass
+        raw = []
+        try:
+            cursor = users_coll.find({'character_count': {'$exists': True}}, {'id': 1, 'user_id': 1, 'character_count': 1})
+            for d in cursor.sort('character_count', -1).limit(limit):
+                uid = d.get('id') or d.get('user_id')
+                if uid:
+                    raw.append((str(uid), int(d.get('character_count') or 0)))
+        except Exception:
+            raw = []
+        if raw:
+            return raw
+        try:
+            for d in build_top_from_users_coll(users_coll, limit=limit):
+                uid = d.get('user_id') or d.get('id') or d.get('_id')
+                if not uid:
+                    continue
+                raw.append((str(uid), int(d.get('character_count') or 0)))
+        except Exception:
+            raw = []
+        return raw
+
+    # One change-stream watcher per collection across all workers: whoever
+    # holds charcount:watch:lock:<ns> watches, the others retry the lock
+    # every CHARACTER_COUNT_WATCH_LOCK_TTL/2 seconds and take over when the
+    # holder stops renewing it.
+    CHARACTER_COUNT_WATCH_LOCK_TTL = max(10, safe_int(os.getenv('CHARACTER_COUNT_WATCH_LOCK_TTL'), 60))
+
+    def _change_streams_supported(coll):
+        """True/False when known, None when the server could not be asked (retry later).
+
+        Change streams need a replica set or a mongos; mongomock and
+        standalone servers have none.
+        """
+        client = coll.database.client
+        if type(client).__module__.split('.')[0] == 'mongomock':
+            return False
+        try:
+            hello = client.admin.command('hello')
+        except Exception as ex:
+            print(f"[character_count] hello failed for {coll.full_name}: {ex}", flush=True)
+            return None
+        return bool(hello.get('setName')) or hello.get('msg') == 'isdbgrid'
+
+    def _watch_lock(lock_key: str, token: str, renew: bool = False) -> bool:
+        if r is None:
+            return True  # single process: nothing to coordinate with
+        try:
+            if renew and _lock_renew_script is not None:
+                return bool(_lock_renew_script(keys=[lock_key], args=[token, CHARACTER_COUNT_WATCH_LOCK_TTL]))
+            if renew:
+                return r.get(lock_key) == token and bool(r.expire(lock_key, CHARACTER_COUNT_WATCH_LOCK_TTL))
+            if r.set(lock_key, token, nx=True, ex=CHARACTER_COUNT_WATCH_LOCK_TTL):
+                return True
+        except Exception as ex:
+            print(f"[character_count] lock error key={lock_key} err={ex}", flush=True)
+            return False
+        return _watch_lock(lock_key, token, renew=True)  # already ours, e.g. after the stream closed
+
+    def _character_count_watch_loop(types, coll):
+        while True:
+            supported = _change_streams_supported(coll)
+            if supported is not None:
+                break
+            time.sleep(30)
+        if not supported:
+            print(f"[character_count] change streams unavailable for {coll.full_name}; counts refresh on write only", flush=True)
+            return
+
+        resume_key = f"charcount:resume:{coll.full_name}"
+        lock_key = f"charcount:watch:lock:{coll.full_name}"
+        lock_token = f"{os.getpid()}:{uuid.uuid4().hex}"
+        renew_every = CHARACTER_COUNT_WATCH_LOCK_TTL / 3
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace']}}},
+                    {'$project': {'documentKey': 1, 'operationType': 1, 'updateDescription.updatedFields': 1}}]
+        while True:
+            if not _watch_lock(lock_key, lock_token):
+                time.sleep(CHARACTER_COUNT_WATCH_LOCK_TTL / 2)
+                continue
+            try:
+                token = None
+                if r is not None:
+                    raw_token = r.get(resume_key)
+                    token = json.loads(raw_token) if raw_token else None
+                renewed_at = time.monotonic()
+                # bounded waits so the lock is renewed even when nothing changes
+                with coll.watch(pipeline, resume_after=token, max_await_time_ms=int(renew_every * 1000)) as stream:
+                    while stream.alive:
+                        if time.monotonic() - renewed_at >= renew_every:
+                            if not _watch_lock(lock_key, lock_token, renew=True):
+                                print(f"[character_count] lost watch lock for {coll.full_name}", flush=True)
+                                break
+                            renewed_at = time.monotonic()
+                        change = stream.try_next()
+                        if change is None:
+                            continue
+                        fields = ((change.get('updateDescription') or {}).get('updatedFields') or {})
+                        if change.get('operationType') == 'update' and not any(k.split('.')[0] == 'characters' for k in fields):
+                            continue
+                        for typ in types:
+                            refresh_character_count(typ, (change.get('documentKey') or {}).get('_id'))
+                        if r is not None:
+                            r.set(resume_key, json.dumps(stream.resume_token, default=str))
+            except Exception as ex:
+                if getattr(ex, 'code', None) in (40573, 136):
+                    print(f"[character_count] change streams unavailable for {coll.full_name}: {ex}", flush=True)
+                    return
+                print(f"[character_count] watch {coll.full_name} err={ex}", flush=True)
+                time.sleep(30)
+
+    if os.getenv('CHARACTER_COUNT_WATCH', '1') not in ('0', 'false', 'no'):
+        _watched = {}
+        for _typ, _coll in _char_count_colls():
+            _watched.setdefault(getattr(_coll, 'full_name', _typ), (_coll, []))[1].append(_typ)
+        for _coll, _types in _watched.values():
+            threading.Thread(target=_character_count_watch_loop, args=(_types, _coll),
+                             name=f"character-count-watch-{'-'.join(_types)}", daemon=True).start()
+
+    def build_top_from_users_coll(users_coll, limit=100):
+        if users_coll is None:
+            return []
+        try:
+            pipeline = [
+                {"$addFields": {"character_count": {"$cond": {"if": {"$isArray": "$characters"}, "then": {"$size": "$characters"}, "else": 0}}}},
+                {"$project": {"user_id": {"$ifNull": ["$id", "$user_id"]}, "first_name": 1, "username": 1, "character_count": 1}},
+                {"$sort": {"character_count": -1}},
+                {"$limit": limit}
+            ]
+            cursor = users_coll.aggregate(pipeline)
+            return list(cursor)
+        except Exception:
+            return []
+
+except Exception:
+    _init_error = traceback.format_exc()
+    market_client = waifu_client = husband_client = None
+    def backend_health(force=False): return {'init': {'ok': False, 'error': 'init failed'}}
+    breakers = {}
+    def backends_degraded(): return False
+    def stale_top_snapshot(typ, bucket): return None
+    registered_users = global_user_profiles_coll = top_global_coll = market_coll = friendships_coll = user_assets_coll = None
+    r = None
+    def get_charms(uid): return 0
+    def update_charms(uid, amt, typ=None, title=None, ref=None): return False
+    def apply_charm_delta(uid, amt, typ=None, title=None, ref=None): return None
+    def read_charm_history(uid, cursor=None, limit=None): return [], None
+    _qr_stats = {}
+    def qr_cache_key(uid): return hashlib.sha1(str(uid).encode('utf-8')).hexdigest()[:20]
+    def get_qr_png(uid): raise RuntimeError("qr codes unavailable")
+    _ledger_stats = {}
+    def ensure_user_profile(uid, first_name=None, username=None, avatar=None):
+        return {'user_id': str(uid), 'firstname': first_name or DEFAULT_NAME, 'username': username, 'photo_url': avatar or None, 'avatar': avatar or None}
+    def upsert_top_global(uid, firstname=None, username=None, avatar=None): return None
+    def pending_profile_writes(): return 0
+    def flush_profile_writes(): return 0
+    profile_cache = TTLCache(maxsize=1, ttl=0)
+    uid_field_cache = TTLCache(maxsize=1, ttl=0)
+    character_image_cache = TTLCache(maxsize=1, ttl=0)
+    _uid_index_report = {}
+    COLLECTION_LOOKUP_ORDER = None
+    MARKET_SORTS = {}
+    def get_market_page(typ, sort, rarity=None, cursor=None, limit=None): return json.dumps({"ok": True, "items": []})
+    def invalidate_market(typ=None): return None
+    class PurchaseError(Exception):
+        def __init__(self, message, status=400):
+            super().__init__(message)
+            self.status = status
+    def buy_market_item(uid, item_id, idempotency_key=None): raise PurchaseError("market unavailable", 503)
+    class TransferError(Exception):
+        def __init__(self, message, status=400, retry_after=None):
+            super().__init__(message)
+            self.status = status
+            self.retry_after = retry_after
+    def transfer_charms(from_uid, to_uid, amount, idempotency_key=None): raise TransferError("transfers unavailable", 503)
+    class FriendError(Exception):
+        def __init__(self, message, status=400):
+            super().__init__(message)
+            self.status = status
+    def add_friend(uid, friend_id): raise FriendError("friends unavailable", 503)
+    def remove_friend(uid, friend_id): raise FriendError("friends unavailable", 503)
+    def list_friends(uid, limit=None): return {'items': [], 'requests': [], 'count': 0}
+    def get_user_settings(uid): return {}
+    def update_user_settings(uid, patch): raise RuntimeError("settings unavailable")
+    def get_settings_asset(asset_id): return None
+    COLLECTION_PAGE_DEFAULT = 500
+    COLLECTION_PAGE_MAX = 1000
+    def load_collection_page(users_coll, uid, offset=0, limit=None, rarity=None, name=None, with_version=False):
+        return ([], 0, None) if with_version else ([], 0)
+    def character_image(c, typ='waifu'): return None
+    REBUILD_BATCH = 500
+    SSE_RETRY_MS = 5000
+    SSE_HEARTBEAT_SECONDS = 15
+    charms_hub = PubSubHub(lambda: None, 'charms_updates')
+    def get_rebuild_state(): return {}
+    def start_top_global_rebuild(limit, batch=None, resume=True, wait=False): return False, {}
+    def _find_doc_in_coll_variants(coll, uid_s, projection=None, order=None): return None
+    def build_top_from_users_coll(users_coll, limit=100): return []
+    def backfill_character_counts(types=None, batch=1000, log=print): return {}
+    def record_character_count(typ, uid, count, doc_id=None): return None
+    def hydrate_top_rows(pairs):
+        return [{"rank": i, "user_id": str(m), "name": DEFAULT_NAME, "username": None, "avatar": None,
+                 "charms": int(sc), "score": int(sc), "count": int(sc)} for i, (m, sc) in enumerate(pairs, start=1)]
+    def hydrate_top_global_docs(docs): return []
+    TOP_LIMIT_BUCKETS = (10, 25, 50, 100)
+    def normalize_top_type(typ): return (typ or '').lower().strip()
+    def compute_top(typ, limit): return []
+    def get_top_snapshot(typ, bucket): return None
+    def top_snapshot_etag(typ, bucket): return None
+    def store_top_snapshot(typ, bucket, items, version=None):
+        body = json.dumps({"ok": True, "items": items})
+        return {'body': body, 'etag': hashlib.sha1(body.encode('utf-8')).hexdigest()[:20], 'version': '0'}
+
+# ---------- response builders ----------
+# Shared by the single-purpose routes and /api/bootstrap, which runs them
+# concurrently for one resolved user.
+BOOTSTRAP_TIMEOUT = float(os.getenv('BOOTSTRAP_TIMEOUT', '10') or 10)
+BOOTSTRAP_COLLECTION_PREVIEW = safe_int(os.getenv('BOOTSTRAP_COLLECTION_PREVIEW'), 12)
+
+def _client_avatar(a):
+    if a and isinstance(a, str) and 'picsum.photos' not in a and not a.startswith('/static/'):
+        return a
+    return None
+
+def build_profile_payload(uid, firstname=None, username=None, avatar=None) -> dict:
+    doc = ensure_user_profile(uid, first_name=firstname, username=username, avatar=avatar)
+    uid_s = str(uid)
+    avatar_final = None
+    try:
+        avatar_final = _client_avatar(avatar)
+        if not avatar_final and r is not None:
+            try:
+                h = r.hgetall(f"user:{uid_s}") or {}
+                avatar_final = _client_avatar(h.get('avatar') or h.get('photo_url') or h.get('photo') or None)
+            except Exception as ex:
+                print(f"[api_user_info][redis_read_err] {ex}", flush=True)
+        if not avatar_final and isinstance(doc, dict):
+            avatar_final = _client_avatar(doc.get('avatar') or doc.get('photo_url'))
+    except Exception:
+        pass
+    return {
+        "id": uid_s,
+        "name": firstname or (doc.get('firstname') if isinstance(doc, dict) else None) or DEFAULT_NAME,
+        "username": username or (doc.get('username') if isinstance(doc, dict) else None),
+        "avatar": avatar_final,
+    }
+
+def build_settings_payload(uid) -> dict:
+    try:
+        settings = get_user_settings(str(uid))
+    except Exception as ex:
+        print(f"[api_user_info][settings_err] {ex}", flush=True)
+        settings = {}
+    return {"settings": settings, "lang": settings.get('lang'), "theme_url": settings.get('theme_url'),
+            "bgm_url": settings.get('bgm_url')}
+
+def build_collection_items(raw_items, typ: str) -> list:
+    items = []
+    for c in raw_items:
+        try:
+            if not isinstance(c, dict):
+                continue
+            img = character_image(c, typ)
+            if not img:
+                continue
+
+            item = {
+                "id": str(c.get('id') or c.get('_id') or c.get('char_id') or ''),
+                "name": c.get('name') or c.get('title') or c.get('character_name') or 'Unknown',
+                "rarity": c.get('rarity') or c.get('rank') or None,
+                "img_url": img
+            }
+            items.append(item)
+        except Exception:
+            continue
+    return items
+
+def build_collection_summary(uid, typ: str, limit: int = None) -> dict:
+    users_coll = husband_users_coll if typ == 'husband' else waifu_users_coll
+    if users_coll is None:
+        return {"items": [], "total": 0, "next_cursor": None}
+    raw_items, total = load_collection_page(users_coll, str(uid), offset=0, limit=limit or BOOTSTRAP_COLLECTION_PREVIEW)
+    # same offset cursor as /api/my_collection so the client can keep paging from the preview
+    next_cursor = str(len(raw_items)) if raw_items and len(raw_items) < total else None
+    return {"items": build_collection_items(raw_items, typ), "total": total, "next_cursor": next_cursor}
+
+def top_bucket(limit: int) -> int:
+    return next(b for b in TOP_LIMIT_BUCKETS if b >= limit)
+
+def load_top_snapshot(typ: str, limit: int):
+    """Snapshot for the smallest bucket covering limit, built on a miss. Returns (snap, bucket).
+
+    While a backend breaker is not closed the last good snapshot is served
+    as is (marked stale) rather than paying for a rebuild that would fail.
+    """
+    bucket = top_bucket(limit)
+    if backends_degraded():
+        stale = stale_top_snapshot(typ, bucket)
+        if stale is not None:
+            metrics.fallback('top_stale_snapshot')
+            return dict(stale, stale=True), bucket
+    snap = get_top_snapshot(typ, bucket)
+    if snap is None:
+        if not typ and pending_profile_writes():
+            # the global board reads top_global_db, which trails registrations
+            # by the write-behind delay; sync it before building from it
+            flush_profile_writes()
+        snap = store_top_snapshot(typ, bucket, compute_top(typ, bucket))
+    return snap, bucket
+
+def gather(tasks: dict, timeout: float = None):
+    """Run independent zero-arg callables concurrently on greenlets. Returns (results, errors) keyed by name."""
+    results, errors = {}, {}
+    if gevent is None:
+        for name, fn in tasks.items():
+            try:
+                results[name] = fn()
+            except Exception as ex:
+                errors[name] = str(ex)
+        return results, errors
+    jobs = {name: gevent.spawn(metrics.bind(fn)) for name, fn in tasks.items()}
+    gevent.joinall(list(jobs.values()), timeout=timeout)
+    for name, job in jobs.items():
+        if job.successful():
+            results[name] = job.value
+        else:
+            errors[name] = str(job.exception) if job.ready() else 'timeout'
+            job.kill(block=False)
+    return results, errors
+
+# ---------- static assets ----------
+# At startup the page's scripts are concatenated (in page order) and, like
+# the stylesheet, stripped of comments and indentation, named by content
+# hash and pre-compressed with gzip (and brotli when installed). Everything
+# is kept in memory and served from /assets/ as immutable; index.html gets
+# the hashed URLs through asset_urls(). If the build fails the page falls
+# back to the individual files under /static/.
+JS_BUNDLE = ('i18n.js', 'core.js', 'market.js', 'wallet.js', 'profile.js', 'settings.js', 'top.js', 'friends.js')
+CSS_FILES = ('style.css',)
+ASSET_MAX_AGE = 365 * 86400
+_JS_REGEX_KEYWORDS = ('return', 'typeof', 'case', 'do', 'else', 'in', 'of', 'void', 'throw',
+                      'delete', 'new', 'instanceof', 'yield', 'await')
+_assets = {}
+_asset_urls = {'js': ['/static/js/' + f for f in JS_BUNDLE], 'css': ['/static/css/' + f for f in CSS_FILES]}
+
+def _is_word(ch: str) -> bool:
+    return bool(ch) and (ch.isalnum() or ch in '_$')
+
+def _minify_js(src: str) -> str:
+    """Drop comments and collapse whitespace; strings, templates and regex literals are copied verbatim.
+
+    Newlines are kept wherever automatic semicolon insertion could depend
+    on them, so the output parses exactly like the input.
+    """
+    out = []
+    i, n = 0, len(src)
+    braces = []  # brace depth inside each open ${ ... } of a template literal
+
+    def last():
+        return out[-1][-1] if out and out[-1] else ''
+
+    while i < n:
+        c = src[i]
+        nxt = src[i + 1] if i + 1 < n else ''
+        if c == '`' or (c == '}' and braces and braces[-1] == 0):
+            if c == '}':
+                braces.pop()
+            j = i + 1
+            while j < n and src[j] != '`':
+                if src[j] == '\\':
+                    j += 2
+                    continue
+                if src[j] == '$' and src[j + 1:j + 2] == '{':
+                    break
+                j += 1
+            if j < n and src[j] == '$':
+                braces.append(0)
+                j += 2
+            else:
+                j += 1
+            out.append(src[i:j])
+            i = j
+            continue
+        if c in '"\'':
+            j = i + 1
+            while j < n and src[j] != c and src[j] != '\n':
+                j += 2 if src[j] == '\\' else 1
+            out.append(src[i:j + 1])
+            i = j + 1
+            continue
+        if c == '/' and nxt == '/':
+            while i < n and src[i] != '\n':
+                i += 1
+            continue
+        if c == '/' and nxt == '*':
+            end = src.find('*/', i + 2)
+            end = n if end < 0 else end + 2
+            out.append('\n' if '\n' in src[i:end] else ' ')
+            i = end
+            continue
+        if c == '/':
+            prev = ''.join(out[-20:]).rstrip()
+            word = re.search(r'[A-Za-z_$][\w$]*$', prev)
+            if not prev or prev[-1] in '(,=:[!&|?{};+-*%<>~^' or (word and word.group(0) in _JS_REGEX_KEYWORDS):
+                j, in_class = i + 1, False
+                while j < n and src[j] != '\n':
+                    if src[j] == '\\':
+                        j += 2
+                        continue
+                    if src[j] == '[':
+                        in_class = True
+                    elif src[j] == ']':
+                        in_class = False
+                    elif src[j] == '/' and not in_class:
+                        break
+                    j += 1
+                j += 1
+                while j < n and _is_word(src[j]):
+                    j += 1
+                out.append(src[i:j])
+                i = j
+                continue
+        if c.isspace():
+            j = i
+            while j < n and src[j].isspace():
+                j += 1
+            following = src[j] if j < n else ''
+            prev = last()
+            if '\n' in src[i:j]:
+                if prev and prev not in '{;,\n':
+                    out.append('\n')
+            elif (_is_word(prev) and _is_word(following)) or (prev in '+-' and prev and following == prev):
+                out.append(' ')
+            i = j
+            continue
+        if braces and c == '{':
+            braces[-1] += 1
+        elif braces and c == '}':
+            braces[-1] -= 1
+        out.append(c)
+        i += 1
+    return ''.join(out).strip() + '\n'
+
+def _minify_css(src: str) -> str:
+    src = re.sub(r'/\*.*?\*/', '', src, flags=re.S)
+    lines = (line.strip() for line in src.splitlines())
+    return '\n'.join(line for line in lines if line) + '\n'
+
+def _store_asset(logical: str, body: bytes, mimetype: str) -> str:
+    digest = hashlib.sha1(body).hexdigest()[:12]
+    stem, ext = logical.rsplit('.', 1)
+    name = f"{stem}.{digest}.{ext}"
+    variants = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(body, quality=11)
+    _assets[name] = {'etag': digest, 'mimetype': mimetype, 'variants': variants}
+    return f"/assets/{name}"
+
+def build_assets():
+    """Build the bundle and stylesheet once per worker; the names are content hashes so workers agree."""
+    static_dir = app.static_folder
+    t0 = time.time()
+    parts = []
+    for fname in JS_BUNDLE:
+        path = os.path.join(static_dir, 'js', fname)
+        if not os.path.exists(path):
+            print(f"[assets] missing {path}, left out of the bundle", flush=True)
+            continue
+        with open(path, 'r', encoding='utf-8') as fh:
+            parts.append(f"/* {fname} */\n" + fh.read())
+    # the ';' keeps one file's trailing expression from running into the next
+    js = ';\n'.join(_minify_js(p) for p in parts)
+    urls = {'js': [_store_asset('bundle.js', js.encode('utf-8'), 'application/javascript')], 'css': []}
+    for fname in CSS_FILES:
+        with open(os.path.join(static_dir, 'css', fname), 'r', encoding='utf-8') as fh:
+            urls['css'].append(_store_asset(fname, _minify_css(fh.read()).encode('utf-8'), 'text/css'))
+    _asset_urls.update(urls)
+    sizes = {name: {k: len(v) for k, v in a['variants'].items()} for name, a in _assets.items()}
+    print(f"[assets] built in {time.time() - t0:.2f}s: {sizes}", flush=True)
+
+try:
+    build_assets()
+except Exception as ex:
+    print(f"[assets] build failed, serving /static files: {ex}", flush=True)
 
-except Exception:
-    _init_error = traceback.format_exc()
-    market_client = waifu_client = husband_client = None
-    registered_users = global_user_profiles_coll = top_global_coll = None
-    r = None
-    def serialize_mongo(x): return x
-    def get_charms(uid): return 0
-    def ensure_user_profile(uid, first_name=None, username=None, avatar=None):
-        return {'user_id': str(uid), 'firstname': first_name or DEFAULT_NAME, 'username': username, 'photo_url': avatar or None, 'avatar': avatar or None}
-    def upsert_top_global(uid, firstname=None, username=None, avatar=None): return None
-    def build_top_from_users_coll(users_coll, limit=100): return []
+@app.context_processor
+def _inject_asset_urls():
+    return {'asset_urls': lambda kind: _asset_urls.get(kind, [])}
 
 # ROUTES
+@app.before_request
+def _metrics_start():
+    metrics.start_request()
+
+@app.after_request
+def _metrics_finish(resp):
+    try:
+        elapsed, ops = metrics.end_request()
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.inc('keep_requests_total', route=route, method=request.method, status=resp.status_code)
+        if elapsed is not None:
+            metrics.observe('keep_request_duration_seconds', elapsed, Metrics.LATENCY_BUCKETS, route=route)
+        for backend, n in ops.items():
+            metrics.observe('keep_request_backend_roundtrips', n, Metrics.ROUNDTRIP_BUCKETS, route=route, backend=backend)
+    except Exception as ex:
+        print(f"[metrics] err={ex}", flush=True)
+    return resp
+
+# JSON (and /metrics text) responses above COMPRESS_MIN_BYTES are gzip or
+# brotli encoded per Accept-Encoding. GET JSON without a route-provided
+# ETag gets one from its body hash, so a repeat fetch costs a 304 instead
+# of the payload. Bodies with route ETags (snapshots, collection pages)
+# keep their compressed form for a while, keyed by ETag.
+COMPRESS_MIN_BYTES = safe_int(os.getenv('COMPRESS_MIN_BYTES'), 1024)
+COMPRESS_MIMETYPES = ('application/json', 'text/plain')
+GZIP_LEVEL = safe_int(os.getenv('GZIP_LEVEL'), 6)
+BROTLI_QUALITY = safe_int(os.getenv('BROTLI_QUALITY'), 5)
+_compressed_bodies = TTLCache(maxsize=256, ttl=300)
+
+@app.after_request
+def _compress_response(resp):
+    try:
+        if resp.direct_passthrough or resp.is_streamed or resp.status_code != 200:
+            return resp
+        route_etag = resp.get_etag()[0]
+        if request.method == 'GET' and resp.mimetype == 'application/json':
+            if route_etag is None:
+                resp.add_etag()
+            resp.headers.setdefault('Cache-Control', 'no-cache')
+            resp.make_conditional(request)
+            if resp.status_code != 200:
+                return resp
+        if 'Content-Encoding' in resp.headers or resp.mimetype not in COMPRESS_MIMETYPES:
+            return resp
+        resp.vary.add('Accept-Encoding')
+        encoding = None
+        for candidate in ('br', 'gzip'):
+            if (candidate != 'br' or brotli is not None) and request.accept_encodings[candidate]:
+                encoding = candidate
+                break
+        body = resp.get_data()
+        if encoding is None or len(body) < COMPRESS_MIN_BYTES:
+            return resp
+        # route etags already differ per compact mode; the flag in the key
+        # keeps a route that forgets from serving the other variant
+        compact = 'c' if app.json.compact_requested() else 'f'
+        key = f"{route_etag}:{compact}:{encoding}" if route_etag else None
+        data = _compressed_bodies.get(key) if key else None
+        if data is None:
+            if encoding == 'br':
+                data = brotli.compress(body, quality=BROTLI_QUALITY)
+            else:
+                data = gzip.compress(body, compresslevel=GZIP_LEVEL)
+            if key:
+                _compressed_bodies.set(key, data)
+        resp.set_data(data)
+        resp.headers['Content-Encoding'] = encoding
+        etag, weak = resp.get_etag()
+        if etag and not weak:
+            resp.set_etag(etag, weak=True)
+    except Exception as ex:
+        print(f"[compress] err={ex}", flush=True)
+    return resp
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape target for this worker."""
+    gauges = {
+        'keep_circuit_breaker_open': ('1 while a backend circuit breaker is open or half-open.',
+                                      [({'backend': name}, 0 if b.healthy else 1) for name, b in breakers.items()]),
+        'keep_circuit_breaker_rejected': ('Calls rejected by an open circuit breaker since start.',
+                                          [({'backend': name}, b.rejected) for name, b in breakers.items()]),
+        'keep_pending_profile_writes': ('Profile writes queued for the write-behind flush.',
+                                        [({}, pending_profile_writes())]),
+    }
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     if _init_error:
         return ("<h3>App started but init failed</h3><p>Check <a href='/__init_error'>/__init_error</a> for details.</p>"), 500
     return render_template('index.html')
 
+@app.route('/assets/<name>')
+def serve_asset(name):
+    asset = _assets.get(name)
+    if asset is None:
+        return Response("not found", status=404, mimetype='text/plain')
+    headers = {'Cache-Control': f'public, max-age={ASSET_MAX_AGE}, immutable', 'ETag': f'"{asset["etag"]}"',
+               'Vary': 'Accept-Encoding'}
+    if f'"{asset["etag"]}"' in (request.headers.get('If-None-Match') or ''):
+        return Response(status=304, headers=headers)
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in asset['variants'] and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(asset['variants'][encoding], mimetype=asset['mimetype'], headers=headers)
+
 @app.route('/__init_error')
 def show_init_error():
     if _init_error:
         return Response(_init_error, mimetype='text/plain'), 500
     return jsonify({"ok": True, "msg": "no init error"}), 200
 
+@app.route('/api/health')
+def api_health():
+    """Readiness: 200 when every configured backend answers a ping, 503 otherwise."""
+    try:
+        checks = backend_health(force=request.args.get('fresh') in ('1', 'true', 'yes'))
+    except Exception as e:
+        checks = {'error': {'ok': False, 'error': str(e)}}
+    ready = not _init_error and all(c.get('ok') for c in checks.values())
+    return jsonify({"ok": ready, "checks": checks}), 200 if ready else 503
+
 @app.route('/api/debug_top_status')
 def api_debug_top_status():
     info = {
@@ -586,17 +3999,22 @@ def api_debug_top_status():
         "waifu_users_coll_exists": waifu_users_coll is not None,
         "husband_users_coll_exists": husband_users_coll is not None,
         "redis_available": r is not None,
+        "pending_profile_writes": pending_profile_writes(),
+        "profile_cache": profile_cache.stats(),
+        "uid_field_cache": uid_field_cache.stats(),
+        "uid_indexes": _uid_index_report,
+        "charms_stream": charms_hub.stats(),
+        "character_image_cache": character_image_cache.stats(),
+        "top_snapshots": dict(_top_snapshot_stats, version=leaderboard_version()),
+        "ledger": _ledger_stats,
+        "qr_codes": _qr_stats,
+        "breakers": {name: b.stats() for name, b in breakers.items()},
+        "json_provider": app.json.name,
     }
     try:
         if top_global_coll is not None:
             info['top_global_count'] = int(top_global_coll.count_documents({}))
-            sample = []
-            for d in list(top_global_coll.find({}, {"_id": 0}).limit(5)):
-                dd = dict(d)
-                if 'updated_at' in dd and isinstance(dd['updated_at'], datetime):
-                    dd['updated_at'] = dd['updated_at'].strftime("%a, %d %b %Y %H:%M:%S GMT")
-                sample.append(dd)
-            info['top_global_sample'] = sample
+            info['top_global_sample'] = list(top_global_coll.find({}, {"_id": 0}).limit(5))
         else:
             info['top_global_count'] = 0
             info['top_global_sample'] = []
@@ -628,31 +4046,31 @@ def api_inspect_user():
     try:
         if registered_users is not None:
             doc = _find_doc_in_coll_variants(registered_users, uid_s)
-            out['sources']['registered_users'] = serialize_mongo(doc) if doc else None
+            out['sources']['registered_users'] = doc or None
     except Exception as ex:
         out['sources']['registered_users_error'] = str(ex)
     try:
         if global_user_profiles_coll is not None:
             doc = _find_doc_in_coll_variants(global_user_profiles_coll, uid_s)
-            out['sources']['global_user_profiles_coll'] = serialize_mongo(doc) if doc else None
+            out['sources']['global_user_profiles_coll'] = doc or None
     except Exception as ex:
         out['sources']['global_user_profiles_coll_error'] = str(ex)
     try:
         if waifu_users_coll is not None:
             doc = _find_doc_in_coll_variants(waifu_users_coll, uid_s)
-            out['sources']['waifu_users_coll'] = serialize_mongo(doc) if doc else None
+            out['sources']['waifu_users_coll'] = doc or None
     except Exception as ex:
         out['sources']['waifu_users_coll_error'] = str(ex)
     try:
         if husband_users_coll is not None:
             doc = _find_doc_in_coll_variants(husband_users_coll, uid_s)
-            out['sources']['husband_users_coll'] = serialize_mongo(doc) if doc else None
+            out['sources']['husband_users_coll'] = doc or None
     except Exception as ex:
         out['sources']['husband_users_coll_error'] = str(ex)
     try:
         if top_global_coll is not None:
             t = top_global_coll.find_one({'user_id': uid_s})
-            out['sources']['top_global_coll'] = serialize_mongo(t) if t else None
+            out['sources']['top_global_coll'] = t or None
     except Exception as ex:
         out['sources']['top_global_coll_error'] = str(ex)
     try:
@@ -679,38 +4097,88 @@ def api_user_info():
     if uid is None:
         return jsonify({"ok": False, "error": "missing user_id"}), 400
 
-    doc = ensure_user_profile(uid, first_name=firstname, username=username, avatar=avatar)
+    out = build_profile_payload(uid, firstname=firstname, username=username, avatar=avatar)
+    out["balance"] = get_charms(out["id"])
+    out.update(build_settings_payload(out["id"]))
+    return jsonify(dict(out, ok=True))
+
+@app.route('/api/bootstrap', methods=['GET', 'POST'])
+def api_bootstrap():
+    """Everything the first screen needs, with the user resolved once and the sources read concurrently."""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or request.form.to_dict()
+    else:
+        data = request.args.to_dict()
+    uid = data.get('user_id') or data.get('id') or data.get('uid')
+    if uid is None:
+        return jsonify({"ok": False, "error": "missing user_id"}), 400
     uid_s = str(uid)
-    avatar_final = None
-    try:
-        if avatar and isinstance(avatar, str) and 'picsum.photos' not in avatar and not avatar.startswith('/static/'):
-            avatar_final = avatar
-        if not avatar_final and r is not None:
-            try:
-                h = r.hgetall(f"user:{uid_s}") or {}
-                a = h.get('avatar') or h.get('photo_url') or h.get('photo') or None
-                if a and isinstance(a, str) and 'picsum.photos' not in a and not a.startswith('/static/'):
-                    avatar_final = a
-            except Exception as ex:
-                print(f"[api_user_info][redis_read_err] {ex}", flush=True)
-        if not avatar_final and isinstance(doc, dict):
-            a = doc.get('avatar') or doc.get('photo_url')
-            if a and isinstance(a, str) and 'picsum.photos' not in a and not a.startswith('/static/'):
-                avatar_final = a
-    except Exception:
-        pass
+    firstname = data.get('firstname') or data.get('first_name') or None
+    username = data.get('username') or data.get('user_name') or None
+    avatar = data.get('avatar') or data.get('photo_url') or data.get('avatar_url') or None
+    top_type = normalize_top_type(data.get('top_type') or 'waifu')
+    top_limit = max(1, min(safe_int(data.get('top_limit'), 100), 100))
 
-    name_final = firstname or (doc.get('firstname') if isinstance(doc, dict) else None) or DEFAULT_NAME
-    username_final = username or (doc.get('username') if isinstance(doc, dict) else None)
+    def _top():
+        snap, _bucket = load_top_snapshot(top_type, top_limit)
+        return {"type": top_type, "items": json.loads(snap['body'])['items'][:top_limit]}
 
-    return jsonify({
+    def _history():
+        items, next_cursor = read_charm_history(uid_s)
+        return {"items": items, "next_cursor": next_cursor}
+
+    results, errors = gather({
+        'profile': lambda: build_profile_payload(uid_s, firstname=firstname, username=username, avatar=avatar),
+        'balance': lambda: get_charms(uid_s),
+        'settings': lambda: build_settings_payload(uid_s),
+        'waifu': lambda: build_collection_summary(uid_s, 'waifu'),
+        'husband': lambda: build_collection_summary(uid_s, 'husband'),
+        'top': _top,
+        'history': _history,
+    }, timeout=BOOTSTRAP_TIMEOUT)
+
+    user = results.get('profile') or {"id": uid_s, "name": firstname or DEFAULT_NAME, "username": username,
+                                      "avatar": _client_avatar(avatar)}
+    user["balance"] = results.get('balance', 0)
+    user.update(results.get('settings') or {"settings": {}, "lang": None, "theme_url": None, "bgm_url": None})
+    out = {
         "ok": True,
-        "id": uid_s,
-        "name": name_final,
-        "username": username_final,
-        "avatar": avatar_final,
-        "balance": get_charms(uid_s)
-    })
+        "user": user,
+        "collection": {t: results.get(t) or {"items": [], "total": 0, "next_cursor": None} for t in ('waifu', 'husband')},
+        "top": results.get('top') or {"type": top_type, "items": []},
+        "history": results.get('history') or {"items": [], "next_cursor": None},
+    }
+    if errors:
+        print(f"[api_bootstrap][partial] uid={uid_s} errors={errors}", flush=True)
+        out["errors"] = errors
+    return jsonify(out)
+
+@app.route('/api/update_settings', methods=['POST'])
+def api_update_settings():
+    data = request.get_json(silent=True) or request.form.to_dict()
+    uid = data.get('user_id') or data.get('uid')
+    if not uid:
+        return jsonify({"ok": False, "error": "missing user_id"}), 400
+    try:
+        return jsonify({"ok": True, "settings": update_user_settings(uid, data)})
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+@app.route('/api/settings_asset/<asset_id>')
+def api_settings_asset(asset_id):
+    if request.headers.get('If-None-Match') == f'"{asset_id}"':
+        resp = Response(status=304)
+    else:
+        doc = get_settings_asset(asset_id)
+        if not doc:
+            return jsonify({"ok": False, "error": "not found"}), 404
+        resp = Response(bytes(doc['data']), mimetype=doc.get('mimetype') or 'application/octet-stream')
+    resp.headers['ETag'] = f'"{asset_id}"'
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return resp
 
 @app.route('/api/my_collection')
 def api_my_collection():
@@ -720,358 +4188,282 @@ def api_my_collection():
     try:
         if not uid:
             return jsonify({"ok": False, "error": "missing user_id"}), 400
-        user_doc = None
-        if users_coll is not None:
-            try:
-                user_doc = users_coll.find_one({'id': str(uid)})
-                if not user_doc and uid.isdigit():
-                    try:
-                        user_doc = users_coll.find_one({'id': int(uid)})
-                    except Exception:
-                        pass
-                if not user_doc:
-                    try:
-                        user_doc = users_coll.find_one({'user_id': str(uid)}) or users_coll.find_one({'user_id': int(uid)})
-                    except Exception:
-                        pass
-            except Exception:
-                user_doc = None
-
-        if not user_doc:
-            return jsonify({"ok": True, "items": []})
+        if users_coll is None:
+            return jsonify({"ok": True, "items": [], "total": 0, "next_cursor": None})
 
-        raw_items = user_doc.get('characters') or user_doc.get('waifu') or user_doc.get('husband') or user_doc.get('char') or []
-        items = []
-        for c in (raw_items if isinstance(raw_items, list) else []):
-            try:
-                if not isinstance(c, dict):
-                    continue
-                candidate = (c.get('img_url') or c.get('image') or c.get('image_url') or c.get('avatar') or
-                             c.get('photo') or c.get('picture') or c.get('thumbnail') or c.get('img') or None)
-                img = _pick_first_valid_image(candidate)
-                if not img:
-                    found = None
-                    for k, v in c.items():
-                        if isinstance(v, (list, str)):
-                            try_img = _pick_first_valid_image(v)
-                            if try_img:
-                                found = try_img
-                                break
-                    img = found
-                if not img:
-                    continue
+        offset = safe_int(request.args.get('cursor') or request.args.get('offset'), 0)
+        limit = max(1, min(safe_int(request.args.get('limit'), COLLECTION_PAGE_DEFAULT), COLLECTION_PAGE_MAX))
+        rarity = (request.args.get('rarity') or '').strip()
+        if rarity.lower() in ('all', 'any'):
+            rarity = ''
+        name = (request.args.get('name') or request.args.get('q') or '').strip()
 
-                item = {
-                    "id": str(c.get('id') or c.get('_id') or c.get('char_id') or ''),
-                    "name": c.get('name') or c.get('title') or c.get('character_name') or 'Unknown',
-                    "rarity": c.get('rarity') or c.get('rank') or None,
-                    "img_url": img
-                }
-                items.append(item)
-            except Exception:
-                continue
+        # the etag follows the characters array (see load_collection_page) and
+        # is checked before the page is hydrated and serialized
+        raw_items, total, version = load_collection_page(users_coll, uid, offset=offset, limit=limit,
+                                                         rarity=rarity or None, name=name or None, with_version=True)
+        etag = None
+        if version:
+            compact = int(app.json.compact_requested())
+            etag = '"c' + hashlib.sha1(f"{version}|{db_type}|{offset}|{limit}|{rarity}|{name}|{compact}"
+                                       .encode('utf-8')).hexdigest()[:20] + '"'
+            if etag in (request.headers.get('If-None-Match') or ''):
+                return Response(status=304, headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+        items = build_collection_items(raw_items, 'husband' if db_type == 'husband' else 'waifu')
 
-        return jsonify({"ok": True, "items": items})
+        next_offset = offset + len(raw_items)
+        next_cursor = str(next_offset) if raw_items and next_offset < total else None
+        resp = jsonify({"ok": True, "items": items, "total": total, "next_cursor": next_cursor})
+        if etag:
+            resp.headers['ETag'] = etag
+        return resp
     except Exception as e:
         traceback.print_exc()
         return jsonify({"ok": False, "items": [], "error": str(e)}), 500
 
-@app.route('/api/top')
-def api_top():
+@app.route('/api/market')
+def api_market():
+    if market_coll is None:
+        return jsonify({"ok": False, "error": "market collection not available", "items": []}), 503
     try:
-        limit = safe_int(request.args.get('limit'), 100)
-        if limit <= 0 or limit > 100:
-            limit = 100
-        typ = (request.args.get('type') or '').lower().strip()
-
-        if top_global_coll is not None and not typ:
-            try:
-                cursor = top_global_coll.find({}, {"_id": 0}).sort("charms", -1).limit(limit)
-                items = []
-                rank = 1
-                for doc in cursor:
-                    uid = str(doc.get('user_id'))
-                    name = doc.get('firstname') or DEFAULT_NAME
-                    username = doc.get('username') or None
-                    avatar = doc.get('avatar') or None
-                    try:
-                        if r is not None:
-                            h = r.hgetall(f"user:{uid}") or {}
-                            a = h.get('avatar') or h.get('photo_url')
-                            if a and 'picsum.photos' not in a and not a.startswith('/static/'):
-                                avatar = a
-                            if h.get('firstname'):
-                                name = h.get('firstname')
-                            if h.get('username'):
-                                username = username or h.get('username')
-                    except Exception:
-                        pass
-                    if (not avatar or 'picsum.photos' in str(avatar)) and registered_users is not None:
-                        try:
-                            ru = registered_users.find_one({'user_id': uid})
-                            if ru:
-                                a2 = _try_many_fields_for_avatar(ru)
-                                if a2:
-                                    avatar = a2
-                                name = ru.get('firstname') or name
-                                username = username or ru.get('username')
-                        except Exception:
-                            pass
-                    # ensure we don't return picsum or local static paths here
-                    if avatar and ('picsum.photos' in avatar or avatar.startswith('/static/')):
-                        avatar = None
-                    items.append({
-                        "rank": rank,
-                        "user_id": uid,
-                        "name": name,
-                        "username": username,
-                        "avatar": avatar,
-                        "charms": int(doc.get('charms') or 0),
-                        "score": int(doc.get('charms') or 0),
-                        "count": int(doc.get('charms') or 0)
-                    })
-                    rank += 1
-                return jsonify({"ok": True, "items": items})
-            except Exception as ex:
-                print("[api_top][top_global_read_error]", ex, flush=True)
-
-        redis_key = 'leaderboard:charms'
-        users_coll = None
-        if typ == 'waifu':
-            redis_key = 'leaderboard:charms:waifu'
-            users_coll = waifu_users_coll
-        elif typ == 'husband':
-            redis_key = 'leaderboard:charms:husband'
-            users_coll = husband_users_coll
-
-        raw = []
-        try:
-            if r is not None:
-                raw = r.zrevrange(redis_key, 0, limit - 1, withscores=True)
-        except Exception:
-            raw = []
-
-        if not raw and typ in ('waifu', 'husband') and users_coll is not None:
-            try:
-                agg = build_top_from_users_coll(users_coll, limit=limit)
-                raw = []
-                for d in agg:
-                    uid = d.get('user_id') or d.get('id') or d.get('_id')
-                    if not uid:
-                        continue
-                    raw.append((str(uid), int(d.get('character_count') or 0)))
-            except Exception:
-                raw = []
-
-        if not raw and (not typ):
-            try:
-                if r is not None:
-                    raw = r.zrevrange('leaderboard:charms', 0, limit - 1, withscores=True)
-            except Exception:
-                raw = []
-
-        if not raw:
-            raw = []
-            if registered_users is not None:
-                try:
-                    for u in registered_users.find({}, {'user_id': 1}):
-                        uid = u.get('user_id')
-                        if not uid:
-                            continue
-                        c = get_charms(uid)
-                        if c > 0:
-                            raw.append((str(uid), int(c)))
-                    raw.sort(key=lambda x: -x[1])
-                    raw = raw[:limit]
-                except Exception:
-                    raw = []
+        typ = (request.args.get('type') or 'waifu').lower().strip()
+        if typ not in ('waifu', 'husband'):
+            typ = 'waifu'
+        sort = (request.args.get('sort') or 'newest').lower().strip()
+        if sort not in MARKET_SORTS and sort != 'random':
+            sort = 'newest'
+        body = get_market_page(typ, sort, rarity=request.args.get('rarity'),
+                               cursor=request.args.get('cursor') or None, limit=request.args.get('limit'))
+        return Response(body, mimetype='application/json')
+    except (ValueError, TypeError) as e:
+        return jsonify({"ok": False, "error": f"bad cursor: {e}", "items": []}), 400
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"ok": False, "error": str(e), "items": []}), 500
 
-        items = []
-        rank = 1
-        for member, score in raw:
-            uid = str(member)
-            name = DEFAULT_NAME
-            username = None
-            avatar = None
+@app.route('/api/buy_market', methods=['POST'])
+def api_buy_market():
+    data = request.get_json(silent=True) or request.form.to_dict()
+    uid = data.get('user_id') or data.get('uid')
+    item_id = data.get('item_id')
+    if not uid or not item_id:
+        return jsonify({"ok": False, "error": "missing user_id or item_id"}), 400
+    idem = request.headers.get('Idempotency-Key') or data.get('idempotency_key') or None
+    try:
+        return jsonify(buy_market_item(uid, item_id, idempotency_key=idem))
+    except PurchaseError as e:
+        return jsonify({"ok": False, "error": str(e)}), e.status
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"ok": False, "error": str(e)}), 500
 
-            try:
-                if r is not None:
-                    h = r.hgetall(f"user:{uid}") or {}
-                    if h.get('firstname'):
-                        name = h.get('firstname')
-                    if h.get('username'):
-                        username = username or h.get('username')
-                    a = h.get('avatar') or h.get('photo_url')
-                    if a and 'picsum.photos' not in a and not a.startswith('/static/'):
-                        avatar = a
-            except Exception:
-                pass
+@app.route('/api/transfer', methods=['POST'])
+def api_transfer():
+    data = request.get_json(silent=True) or request.form.to_dict()
+    uid = data.get('user_id') or data.get('from_user_id') or data.get('uid')
+    to_uid = data.get('to_user_id') or data.get('to')
+    if not uid or not to_uid:
+        return jsonify({"ok": False, "error": "missing user_id or to_user_id"}), 400
+    idem = request.headers.get('Idempotency-Key') or data.get('idempotency_key') or None
+    try:
+        return jsonify(transfer_charms(uid, to_uid, data.get('amount'), idempotency_key=idem))
+    except TransferError as e:
+        resp = jsonify({"ok": False, "error": str(e)})
+        resp.status_code = e.status
+        if e.retry_after:
+            resp.headers['Retry-After'] = str(e.retry_after)
+        return resp
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"ok": False, "error": str(e)}), 500
 
-            try:
-                prof = ensure_user_profile(uid)
-                if isinstance(prof, dict):
-                    if prof.get('firstname'):
-                        name = prof.get('firstname')
-                    if prof.get('username'):
-                        username = username or prof.get('username')
-                    a = prof.get('avatar') or prof.get('photo_url')
-                    if a and 'picsum.photos' not in a and not a.startswith('/static/'):
-                        avatar = a
-            except Exception:
-                pass
+@app.route('/api/friends')
+def api_friends():
+    uid = request.args.get('user_id') or request.args.get('uid')
+    if not uid:
+        return jsonify({"ok": False, "error": "missing user_id", "items": []}), 400
+    try:
+        out = list_friends(uid, limit=request.args.get('limit'))
+        return jsonify(dict(out, ok=True))
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"ok": False, "error": str(e), "items": []}), 500
 
-            if (not avatar) and top_global_coll is not None:
-                try:
-                    tg = top_global_coll.find_one({'user_id': uid})
-                    if tg:
-                        tg_av = tg.get('avatar')
-                        if tg_av and 'picsum.photos' not in tg_av and not tg_av.startswith('/static/'):
-                            avatar = tg_av
-                        name = tg.get('firstname') or name
-                        username = username or tg.get('username')
-                except Exception:
-                    pass
+@app.route('/api/friends/add', methods=['POST'])
+def api_friends_add():
+    data = request.get_json(silent=True) or request.form.to_dict()
+    uid = data.get('user_id') or data.get('uid')
+    fid = data.get('friend_id') or data.get('to_user_id')
+    if not uid or not fid:
+        return jsonify({"ok": False, "error": "missing user_id or friend_id"}), 400
+    try:
+        return jsonify({"ok": True, "status": add_friend(uid, fid)})
+    except FriendError as e:
+        return jsonify({"ok": False, "error": str(e)}), e.status
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"ok": False, "error": str(e)}), 500
 
-            if (not avatar) and waifu_users_coll is not None:
-                try:
-                    d = _find_doc_in_coll_variants(waifu_users_coll, uid)
-                    if d:
-                        a2 = _try_many_fields_for_avatar(d)
-                        if a2:
-                            avatar = a2
-                        name = d.get('first_name') or d.get('firstname') or name
-                        username = username or d.get('username')
-                except Exception:
-                    pass
-            if (not avatar) and husband_users_coll is not None:
-                try:
-                    d = _find_doc_in_coll_variants(husband_users_coll, uid)
-                    if d:
-                        a2 = _try_many_fields_for_avatar(d)
-                        if a2:
-                            avatar = a2
-                        name = d.get('first_name') or d.get('firstname') or name
-                        username = username or d.get('username')
-                except Exception:
-                    pass
+@app.route('/api/friends/remove', methods=['POST'])
+def api_friends_remove():
+    data = request.get_json(silent=True) or request.form.to_dict()
+    uid = data.get('user_id') or data.get('uid')
+    fid = data.get('friend_id') or data.get('to_user_id')
+    if not uid or not fid:
+        return jsonify({"ok": False, "error": "missing user_id or friend_id"}), 400
+    try:
+        remove_friend(uid, fid)
+        return jsonify({"ok": True})
+    except FriendError as e:
+        return jsonify({"ok": False, "error": str(e)}), e.status
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"ok": False, "error": str(e)}), 500
 
-            if avatar and ('picsum.photos' in avatar or avatar.startswith('/static/')):
-                avatar = None
+@app.route('/api/history')
+def api_history():
+    uid = request.args.get('user_id') or request.args.get('uid')
+    if not uid:
+        return jsonify({"ok": False, "error": "missing user_id", "items": []}), 400
+    try:
+        items, next_cursor = read_charm_history(uid, cursor=request.args.get('cursor'), limit=request.args.get('limit'))
+        return jsonify({"ok": True, "items": items, "next_cursor": next_cursor})
+    except ValueError as e:
+        return jsonify({"ok": False, "error": f"bad cursor: {e}", "items": []}), 400
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"ok": False, "error": str(e), "items": []}), 500
 
-            items.append({
-                "rank": rank,
-                "user_id": uid,
-                "name": name,
-                "username": username,
-                "avatar": avatar,
-                "charms": int(score),
-                "score": int(score),
-                "count": int(score)
-            })
-            rank += 1
+@app.route('/api/qr_code')
+def api_qr_code():
+    uid = request.args.get('user_id') or request.args.get('uid')
+    if not uid:
+        return jsonify({"ok": False, "error": "missing user_id"}), 400
+    raw = (request.args.get('format') or '').lower() == 'png'
+    try:
+        key = qr_cache_key(str(uid))
+        etag = f'"{key}-png"' if raw else f'"{key}"'
+        if request.headers.get('If-None-Match') == etag:
+            resp = Response(status=304)
+        else:
+            png, key = get_qr_png(uid)
+            if raw:
+                resp = Response(png, mimetype='image/png')
+            else:
+                resp = jsonify({"ok": True, "user_id": str(uid), "image_b64": base64.b64encode(png).decode('ascii'),
+                                "url": f"/api/qr_code?user_id={uid}&format=png&v={key}"})
+        resp.headers['ETag'] = etag
+        if raw and request.args.get('v') == key:
+            resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            resp.headers['Cache-Control'] = 'public, max-age=86400'
+        return resp
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"ok": False, "error": str(e)}), 503
 
-        return jsonify({"ok": True, "items": items})
+@app.route('/api/top')
+def api_top():
+    try:
+        limit = safe_int(request.args.get('limit'), 100)
+        if limit <= 0 or limit > 100:
+            limit = 100
+        typ = normalize_top_type(request.args.get('type'))
+        # snapshots are stored pre-serialized in full form; compact responses
+        # are re-encoded from them and carry their own etag
+        compact = app.json.compact_requested()
+        variant = f"{limit}-c" if compact else str(limit)
+        if_none_match = request.headers.get('If-None-Match') or ''
+        if if_none_match and not backends_degraded():
+            # revalidation only needs the stored snapshot's etag, not its body
+            current = top_snapshot_etag(typ, top_bucket(limit))
+            if current and f'"{current}-{variant}"' in if_none_match:
+                _top_snapshot_stats['not_modified'] += 1
+                return Response(status=304, headers={'ETag': f'"{current}-{variant}"', 'Cache-Control': 'no-cache'})
+        snap, bucket = load_top_snapshot(typ, limit)
+        etag = f'"{snap["etag"]}-{variant}"'
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if snap.get('uncached'):
+            # nothing to revalidate against; the next request rebuilds
+            headers = {'Cache-Control': 'no-store'}
+            etag = None
+        if snap.get('stale'):
+            headers['Warning'] = '110 - "Response is Stale"'
+        if etag and etag in if_none_match:
+            return Response(status=304, headers=headers)
+        body = snap['body']
+        if compact:
+            body = app.json.dumps(_drop_nulls({"ok": True, "items": json.loads(body)['items'][:limit]}))
+        elif limit != bucket:
+            body = json.dumps({"ok": True, "items": json.loads(body)['items'][:limit]})
+        return Response(body, mimetype='application/json', headers=headers)
     except Exception as e:
         traceback.print_exc()
         return jsonify({"ok": False, "error": str(e), "items": []}), 500
 
-@app.route('/api/rebuild_top_global')
+@app.route('/api/rebuild_top_global', methods=['GET', 'POST'])
 def api_rebuild_top_global():
     if top_global_coll is None:
         return jsonify({"ok": False, "error": "top_global_db collection not available"}), 400
+    if registered_users is None and r is None:
+        return jsonify({"ok": False, "error": "no source to rebuild from"}), 400
     try:
         limit = safe_int(request.args.get('limit'), 10000)
-        count = 0
-        if registered_users is not None:
-            for u in registered_users.find({}, {'user_id': 1, 'firstname': 1, 'photo_url': 1, 'avatar': 1, 'username': 1}):
-                uid = u.get('user_id')
-                if not uid:
-                    continue
-                firstname = u.get('firstname') or DEFAULT_NAME
-                avatar = _try_many_fields_for_avatar(u) or u.get('photo_url') or u.get('avatar') or None
-                username = u.get('username') or None
-                if avatar and 'picsum.photos' in avatar:
-                    avatar = None
-                top_global_coll.update_one({'user_id': str(uid)}, {'$set': {'user_id': str(uid), 'firstname': firstname, 'avatar': avatar, 'username': username, 'charms': int(get_charms(uid)), 'updated_at': datetime.utcnow()}}, upsert=True)
-                try:
-                    if r is not None:
-                        mapping = {'firstname': firstname, 'charm': str(get_charms(uid)), 'charms': str(get_charms(uid))}
-                        if username:
-                            mapping['username'] = username
-                        if avatar:
-                            mapping['avatar'] = avatar; mapping['photo_url'] = avatar
-                        try:
-                            r.hset(f"user:{uid}", mapping=mapping)
-                        except Exception:
-                            for k, v in mapping.items():
-                                try:
-                                    r.hset(f"user:{uid}", k, v)
-                                except Exception:
-                                    pass
-                except Exception:
-                    pass
-                count += 1
-                if count >= limit:
-                    break
-            return jsonify({"ok": True, "count": count})
-        if r is not None:
-            pairs = r.zrevrange('leaderboard:charms', 0, limit - 1, withscores=True)
-            for uid, score in pairs:
-                firstname = DEFAULT_NAME
-                avatar = None
-                username = None
-                try:
-                    if global_user_profiles_coll is not None:
-                        d = _find_doc_in_coll_variants(global_user_profiles_coll, str(uid))
-                        if d:
-                            firstname = d.get('firstname') or d.get('first_name') or firstname
-                            username = username or d.get('username')
-                            avatar = _try_many_fields_for_avatar(d) or avatar
-                    if firstname == DEFAULT_NAME and waifu_users_coll is not None:
-                        d2 = _find_doc_in_coll_variants(waifu_users_coll, str(uid))
-                        if d2:
-                            firstname = d2.get('first_name') or d2.get('firstname') or firstname
-                            username = username or d2.get('username')
-                            avatar = avatar or _try_many_fields_for_avatar(d2)
-                    if (not avatar) and husband_users_coll is not None:
-                        d3 = _find_doc_in_coll_variants(husband_users_coll, str(uid))
-                        if d3:
-                            firstname = firstname or d3.get('first_name') or d3.get('firstname')
-                            username = username or d3.get('username')
-                            avatar = avatar or _try_many_fields_for_avatar(d3)
-                except Exception:
-                    pass
-                if avatar and 'picsum.photos' in str(avatar):
-                    avatar = None
-                top_global_coll.update_one({'user_id': str(uid)}, {'$set': {'user_id': str(uid), 'firstname': firstname, 'username': username, 'avatar': avatar, 'charms': int(score), 'updated_at': datetime.utcnow()}}, upsert=True)
-            return jsonify({"ok": True, "count": len(pairs)})
-        return jsonify({"ok": False, "error": "no source to rebuild from"}), 400
+        batch = safe_int(request.args.get('batch'), REBUILD_BATCH)
+        resume = request.args.get('resume', '1') not in ('0', 'false', 'no')
+        wait = request.args.get('wait', '0') in ('1', 'true', 'yes')
+        started, state = start_top_global_rebuild(limit, batch=batch, resume=resume, wait=wait)
+        if not started:
+            return jsonify({"ok": False, "error": "rebuild already running", "job": state}), 409
+        if wait:
+            return jsonify({"ok": state.get('status') == 'done', "count": safe_int(state.get('processed'), 0), "job": state})
+        return jsonify({"ok": True, "job": state}), 202
     except Exception as e:
         traceback.print_exc()
         return jsonify({"ok": False, "error": str(e)}), 500
 
+@app.route('/api/rebuild_top_global/status')
+def api_rebuild_top_global_status():
+    try:
+        return jsonify({"ok": True, "job": get_rebuild_state()})
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 500
+
 @app.route('/stream/charms')
 def stream_charms():
+    user_id = request.args.get('user_id') or None
+    typ = (request.args.get('type') or '').strip() or None
+
     def event_stream():
-        if r is None:
-            while True:
-                yield "data: {}\n\n"
-        pubsub = r.pubsub(ignore_subscribe_messages=True)
-        pubsub.subscribe('charms_updates')
+        # subscribe only once the body is actually being sent: a client that
+        # disconnects before that never starts the generator, so its finally
+        # (and the unsubscribe) would never run
+        sub = charms_hub.subscribe(user_id=user_id, typ=typ)
         try:
-            for message in pubsub.listen():
-                if message is None:
-                    continue
-                if message.get('type') != 'message':
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            while True:
+                try:
+                    data = sub['queue'].get(timeout=SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
                     continue
-                data = message.get('data')
                 yield f"data: {data}\n\n"
-        except GeneratorExit:
-            try:
-                pubsub.close()
-            except Exception:
-                pass
-    return Response(event_stream(), mimetype='text/event-stream')
+        finally:
+            charms_hub.unsubscribe(sub)
+
+    resp = Response(event_stream(), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+@app.cli.command('backfill-character-counts')
+@click.option('--type', 'types', multiple=True, type=click.Choice(['waifu', 'husband']),
+              help='Limit the backfill to one collection type (repeatable).')
+@click.option('--batch', default=1000, show_default=True, help='bulk_write batch size.')
+def backfill_character_counts_command(types, batch):
+    """Store character_count on every user doc and seed leaderboard:chars:{type}."""
+    result = backfill_character_counts(types=list(types) or None, batch=batch, log=click.echo)
+    click.echo(json.dumps(result))
 
 if __name__ == "__main__":
     port = safe_int(os.getenv('PORT'), 5000)
@@ -0,0 +1,142 @@
+"""Load test for /api/buy_market: hammer one limited item and check nothing is oversold.
+
+Runs against the backends configured through the usual env vars (MONGO_URI,
+MARKET_DB_URL, REDIS_HOST, ...). Point them at a local mongod/redis-server;
+the script refuses to run when they are left at the app's hosted defaults.
+
+    MONGO_URI=mongodb://localhost:27017 REDIS_HOST=localhost REDIS_PORT=6379 REDIS_PASSWORD= \
+        python bench/buy_market_load.py --stock 500 --buyers 2000 --requests 5000 --concurrency 200
+
+By default requests go through Flask's test client inside this process (one
+greenlet per in-flight request); --url sends them to a running server instead.
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import argparse
+import os
+import random
+import sys
+import time
+import uuid
+
+import gevent
+from gevent.pool import Pool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('--stock', type=int, default=500)
+    p.add_argument('--price', type=int, default=10)
+    p.add_argument('--buyers', type=int, default=2000)
+    p.add_argument('--balance', type=int, default=25, help='starting charms per buyer')
+    p.add_argument('--requests', type=int, default=5000)
+    p.add_argument('--concurrency', type=int, default=200)
+    p.add_argument('--retry-ratio', type=float, default=0.1,
+                   help='fraction of requests that replay a previous idempotency key')
+    p.add_argument('--url', default=None, help='base URL of a running server (default: in-process test client)')
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not os.getenv('MONGO_URI') or not os.getenv('REDIS_HOST'):
+        sys.exit("refusing to run: set MONGO_URI and REDIS_HOST to local/test instances")
+
+    import app as appmod
+    if appmod.r is None or appmod.market_coll is None:
+        sys.exit(f"backends unavailable: {appmod._init_error or 'redis/mongo not reachable'}")
+
+    r = appmod.r
+    run = uuid.uuid4().hex[:8]
+    item_id = appmod.market_coll.insert_one({
+        'type': 'waifu', 'name': f'loadtest-{run}', 'rarity': '🟡 Legendary', 'price': args.price,
+        'stock': args.stock, 'image': 'https://example.com/loadtest.png',
+    }).inserted_id
+    buyers = [f"lt{run}{i}" for i in range(args.buyers)]
+    pipe = r.pipeline(transaction=False)
+    for uid in buyers:
+        pipe.hset(f"user:{uid}", mapping={'charm': args.balance, 'charms': args.balance})
+    pipe.execute()
+
+    if args.url:
+        import requests
+        session = requests.Session()
+
+        def post(body, key):
+            resp = session.post(f"{args.url.rstrip('/')}/api/buy_market", json=body,
+                                headers={'Idempotency-Key': key}, timeout=30)
+            return resp.status_code, resp.json()
+    else:
+        client = appmod.app.test_client()
+
+        def post(body, key):
+            resp = client.post('/api/buy_market', json=body, headers={'Idempotency-Key': key})
+            return resp.status_code, resp.get_json()
+
+    keys = []
+    results = {'ok': 0, 'replayed': 0, 'sold_out': 0, 'no_balance': 0, 'error': 0}
+    latencies = []
+
+    def one(i):
+        if keys and random.random() < args.retry_ratio:
+            uid, key = keys[i % len(keys)]
+        else:
+            uid, key = buyers[i % len(buyers)], uuid.uuid4().hex
+        t0 = time.perf_counter()
+        status, data = post({'user_id': uid, 'item_id': str(item_id)}, key)
+        latencies.append(time.perf_counter() - t0)
+        if status == 200 and data.get('ok'):
+            if data.get('replayed'):
+                results['replayed'] += 1
+            else:
+                results['ok'] += 1
+                keys.append((uid, key))
+        elif status == 409:
+            results['sold_out'] += 1
+        elif status == 402:
+            results['no_balance'] += 1
+        else:
+            results['error'] += 1
+
+    pool = Pool(args.concurrency)
+    t0 = time.perf_counter()
+    for i in range(args.requests):
+        pool.spawn(one, i)
+    pool.join()
+    elapsed = time.perf_counter() - t0
+    gevent.sleep(0)
+
+    redis_stock = int(r.hget(f"market:item:{item_id}", 'stock') or 0)
+    mongo_stock = appmod.market_coll.find_one({'_id': item_id}).get('stock')
+    delivered = appmod.market_purchases_coll.count_documents({'item_id': str(item_id)})
+    spent = 0
+    pipe = r.pipeline(transaction=False)
+    for uid in buyers:
+        pipe.hget(f"user:{uid}", 'charm')
+    for v in pipe.execute():
+        spent += args.balance - int(v or 0)
+
+    latencies.sort()
+    pct = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else 0.0
+    print(f"requests={args.requests} concurrency={args.concurrency} elapsed={elapsed:.2f}s "
+          f"throughput={args.requests / elapsed:.0f} req/s p50={pct(0.5):.1f}ms p99={pct(0.99):.1f}ms")
+    print(f"results={results}")
+    print(f"stock: initial={args.stock} redis={redis_stock} mongo={mongo_stock} purchases={delivered} "
+          f"charms_spent={spent}")
+
+    oversold = results['ok'] > args.stock or redis_stock < 0 or (mongo_stock is not None and mongo_stock < 0)
+    consistent = (args.stock - redis_stock == results['ok'] == delivered
+                  and spent == results['ok'] * args.price)
+    print("OVERSOLD" if oversold else "no oversell", "| consistent" if consistent else "| INCONSISTENT")
+
+    appmod.market_coll.delete_one({'_id': item_id})
+    r.delete(f"market:item:{item_id}")
+    sys.exit(1 if oversold or not consistent else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""Offline benchmark suite: latency, throughput and backend round trips for the read endpoints.
+
+Seeds N users with M characters each in both the waifu and husband
+collections (plus registered_users, the user:{uid} hashes and
+leaderboard:charms), then drives /api/top, /api/user_info,
+/api/my_collection and /api/rebuild_top_global through Flask's test client.
+Round trips per request are taken from the app's own /metrics histograms,
+so they count exactly what the breaker-guarded clients sent (work the
+rebuild job does on its own thread is not attributed to the request).
+
+With --backend fake (the default) everything runs in-process against
+mongomock and fakeredis (pip install -r bench/requirements.txt); nothing
+leaves the machine and no credentials are needed:
+
+    python bench/offline_suite.py --users 2000 --chars 50 --requests 300
+
+With --backend local the app uses the usual env vars; point them at a local
+mongod/redis-server (the script refuses to run on the hosted defaults):
+
+    MONGO_URI=mongodb://localhost:27017 REDIS_HOST=localhost REDIS_PORT=6379 REDIS_PASSWORD= \
+        python bench/offline_suite.py --backend local --json results.json
+
+Compare the --json output of two runs to spot regressions in review.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+RARITIES = ('🟢 Common', '🟣 Rare', '🟡 Legendary', '💮 Special Edition')
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('--backend', choices=('fake', 'local'), default='fake')
+    p.add_argument('--users', type=int, default=1000)
+    p.add_argument('--chars', type=int, default=50, help='characters per user in each collection')
+    p.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    p.add_argument('--seed', type=int, default=1, help='random seed for the dataset and request mix')
+    p.add_argument('--json', default=None, help='also write the results to this file')
+    return p.parse_args()
+
+
+def use_fake_backends():
+    """Route the app's MongoClient and redis pool to mongomock / fakeredis before it is imported."""
+    import fakeredis
+    import mongomock
+    import pymongo
+    import redis
+
+    server = fakeredis.FakeServer()
+
+    class FakePool(redis.BlockingConnectionPool):
+        def __init__(self, **kwargs):
+            kwargs.update(connection_class=fakeredis.FakeConnection, server=server)
+            super().__init__(**kwargs)
+
+    clients = {}
+
+    def fake_client(uri=None, *args, **kwargs):
+        if uri not in clients:
+            clients[uri] = mongomock.MongoClient()
+        return clients[uri]
+
+    redis.BlockingConnectionPool = FakePool
+    pymongo.MongoClient = fake_client
+    os.environ.update({
+        'MONGO_URI': 'mongodb://bench-market', 'MONGO_URL_WAIFU': 'mongodb://bench-waifu',
+        'MONGO_URL_HUSBAND': 'mongodb://bench-husband',
+        'REDIS_HOST': 'bench-fake', 'REDIS_PORT': '6379', 'REDIS_PASSWORD': '',
+    })
+
+
+def seed(appmod, prefix, users, chars, rng):
+    r = appmod.r
+    uids = [f"{prefix}{i}" for i in range(users)]
+    registered, waifu_docs, husband_docs = [], [], []
+    for i, uid in enumerate(uids):
+        registered.append({'user_id': uid, 'firstname': f'Bench{i}', 'username': f'bench{i}',
+                           'photo_url': f'https://cdn.example/{uid}.jpg'})
+        for docs, kind in ((waifu_docs, 'w'), (husband_docs, 'h')):
+            docs.append({'id': uid, 'first_name': f'Bench{i}', 'characters': [
+                {'id': f'{kind}{j}', 'name': f'Char {kind}{j}', 'anime': f'Series {j % 40}',
+                 'rarity': RARITIES[j % len(RARITIES)], 'img_url': f'https://img.example/{kind}/{j}.png'}
+                for j in range(chars)]})
+    appmod.registered_users.insert_many(registered)
+    appmod.waifu_users_coll.insert_many(waifu_docs)
+    appmod.husband_users_coll.insert_many(husband_docs)
+    pipe = r.pipeline(transaction=False)
+    for uid in uids:
+        charms = rng.randint(0, 100000)
+        pipe.hset(f"user:{uid}", mapping={'charm': charms, 'charms': charms})
+        pipe.zadd('leaderboard:charms', {uid: charms})
+    pipe.execute()
+    return uids
+
+
+def cleanup(appmod, uids):
+    appmod.registered_users.delete_many({'user_id': {'$in': uids}})
+    appmod.waifu_users_coll.delete_many({'id': {'$in': uids}})
+    appmod.husband_users_coll.delete_many({'id': {'$in': uids}})
+    if appmod.top_global_coll is not None:
+        appmod.top_global_coll.delete_many({'user_id': {'$in': uids}})
+    pipe = appmod.r.pipeline(transaction=False)
+    for uid in uids:
+        pipe.delete(f"user:{uid}")
+    pipe.zrem('leaderboard:charms', *uids)
+    pipe.execute()
+
+
+_SAMPLE = re.compile(r'^keep_request_backend_roundtrips_(sum|count)\{backend="(\w+)",route="([^"]+)"\} (\S+)$')
+
+
+def roundtrips(client):
+    """{(route, backend): (sum, count)} from the app's /metrics."""
+    out = {}
+    for line in client.get('/metrics').get_data(as_text=True).splitlines():
+        m = _SAMPLE.match(line)
+        if m:
+            kind, backend, route, value = m.groups()
+            s, c = out.get((route, backend), (0.0, 0))
+            out[(route, backend)] = (float(value), c) if kind == 'sum' else (s, int(value))
+    return out
+
+
+def measure(client, route, make_request, n):
+    before = roundtrips(client)
+    latencies, errors = [], 0
+    t0 = time.perf_counter()
+    for i in range(n):
+        start = time.perf_counter()
+        resp = make_request(i)
+        latencies.append(time.perf_counter() - start)
+        if resp.status_code >= 400:
+            errors += 1
+    elapsed = time.perf_counter() - t0
+    after = roundtrips(client)
+
+    latencies.sort()
+    pct = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else 0.0
+    result = {'requests': n, 'errors': errors, 'throughput': round(n / elapsed, 1) if elapsed else 0.0,
+              'p50_ms': round(pct(0.5), 2), 'p99_ms': round(pct(0.99), 2)}
+    for backend in ('redis', 'mongo'):
+        s1, c1 = after.get((route, backend), (0.0, 0))
+        s0, c0 = before.get((route, backend), (0.0, 0))
+        result[f'{backend}_roundtrips'] = round((s1 - s0) / (c1 - c0), 1) if c1 > c0 else 0.0
+    return result
+
+
+def main():
+    args = parse_args()
+    if args.backend == 'fake':
+        use_fake_backends()
+    elif not os.getenv('MONGO_URI') or not os.getenv('REDIS_HOST'):
+        sys.exit("refusing to run: set MONGO_URI and REDIS_HOST to local/test instances")
+
+    import app as appmod
+    if appmod._init_error or appmod.r is None or appmod.registered_users is None:
+        sys.exit(f"backends unavailable: {appmod._init_error or 'redis/mongo not configured'}")
+
+    rng = random.Random(args.seed)
+    t0 = time.perf_counter()
+    uids = seed(appmod, f"bench{uuid.uuid4().hex[:6]}", args.users, args.chars, rng)
+    print(f"seeded users={args.users} chars={args.chars} in {time.perf_counter() - t0:.1f}s", flush=True)
+
+    client = appmod.app.test_client()
+    picks = [rng.choice(uids) for _ in range(args.requests)]
+    limits = (10, 25, 50, 100)
+    rebuild_runs = max(1, min(5, args.requests // 40))
+    suite = (
+        ('/api/top', args.requests,
+         lambda i: client.get(f"/api/top?type={('', 'charms', 'waifu', 'husband')[i % 4]}&limit={limits[i % 4]}")),
+        ('/api/user_info', args.requests, lambda i: client.get(f"/api/user_info?user_id={picks[i]}")),
+        ('/api/my_collection', args.requests,
+         lambda i: client.get(f"/api/my_collection?user_id={picks[i]}&type={('waifu', 'husband')[i % 2]}&limit=100")),
+        ('/api/rebuild_top_global', rebuild_runs,
+         lambda i: client.post(f"/api/rebuild_top_global?limit={args.users}&resume=0&wait=1")),
+    )
+
+    results = {}
+    try:
+        for route, n, make_request in suite:
+            results[route] = res = measure(client, route, make_request, n)
+            print(f"{route:<26} n={n:<5} {res['throughput']:>8.1f} req/s  p50={res['p50_ms']:>8.2f}ms  "
+                  f"p99={res['p99_ms']:>8.2f}ms  redis/req={res['redis_roundtrips']:<6} "
+                  f"mongo/req={res['mongo_roundtrips']:<6} errors={res['errors']}", flush=True)
+    finally:
+        cleanup(appmod, uids)
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump({'backend': args.backend, 'users': args.users, 'chars': args.chars,
+                       'requests': args.requests, 'seed': args.seed, 'results': results}, fh, indent=2)
+    sys.exit(1 if any(res['errors'] for res in results.values()) else 0)
+
+
+if __name__ == '__main__':
+    main()
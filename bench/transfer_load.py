@@ -0,0 +1,141 @@
+"""Sustained-load test for /api/transfer: random transfers between seeded users, checking charms are conserved.
+
+Runs against the backends configured through the usual env vars (MONGO_URI,
+MARKET_DB_URL, REDIS_HOST, ...). Point them at a local mongod/redis-server;
+the script refuses to run when they are left at the app's hosted defaults.
+
+To measure both gunicorn workers, start the server with the per-user rate
+limit disabled and pass --url:
+
+    TRANSFER_RATE_LIMIT=0 MONGO_URI=mongodb://localhost:27017 REDIS_HOST=localhost REDIS_PORT=6379 REDIS_PASSWORD= \
+        gunicorn app:app --workers 2 --threads 4 --worker-class gevent --bind 127.0.0.1:8000
+    MONGO_URI=mongodb://localhost:27017 REDIS_HOST=localhost REDIS_PORT=6379 REDIS_PASSWORD= \
+        python bench/transfer_load.py --url http://127.0.0.1:8000 --users 1000 --duration 30 --concurrency 200
+
+Without --url requests go through Flask's test client inside this process.
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import argparse
+import os
+import random
+import sys
+import time
+import uuid
+
+import gevent
+from gevent.pool import Pool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('--users', type=int, default=1000)
+    p.add_argument('--balance', type=int, default=1000, help='starting charms per user')
+    p.add_argument('--max-amount', type=int, default=20)
+    p.add_argument('--duration', type=float, default=30.0, help='seconds to keep sending')
+    p.add_argument('--concurrency', type=int, default=200)
+    p.add_argument('--url', default=None, help='base URL of a running server (default: in-process test client)')
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not os.getenv('MONGO_URI') or not os.getenv('REDIS_HOST'):
+        sys.exit("refusing to run: set MONGO_URI and REDIS_HOST to local/test instances")
+    if not args.url:
+        os.environ.setdefault('TRANSFER_RATE_LIMIT', '0')
+
+    import app as appmod
+    if appmod.r is None:
+        sys.exit(f"backends unavailable: {appmod._init_error or 'redis not reachable'}")
+
+    r = appmod.r
+    run = uuid.uuid4().hex[:8]
+    users = [f"tl{run}{i}" for i in range(args.users)]
+    pipe = r.pipeline(transaction=False)
+    for uid in users:
+        pipe.hset(f"user:{uid}", mapping={'charm': args.balance, 'charms': args.balance})
+        pipe.zadd('leaderboard:charms', {uid: args.balance})
+    pipe.execute()
+
+    if args.url:
+        import requests
+        session = requests.Session()
+
+        def post(body):
+            resp = session.post(f"{args.url.rstrip('/')}/api/transfer", json=body,
+                                headers={'Idempotency-Key': uuid.uuid4().hex}, timeout=30)
+            return resp.status_code
+    else:
+        client = appmod.app.test_client()
+
+        def post(body):
+            return client.post('/api/transfer', json=body, headers={'Idempotency-Key': uuid.uuid4().hex}).status_code
+
+    results = {'ok': 0, 'no_balance': 0, 'rate_limited': 0, 'error': 0}
+    latencies = []
+    deadline = time.perf_counter() + args.duration
+
+    def sender():
+        while time.perf_counter() < deadline:
+            a, b = random.sample(users, 2)
+            t0 = time.perf_counter()
+            status = post({'user_id': a, 'to_user_id': b, 'amount': random.randint(1, args.max_amount)})
+            latencies.append(time.perf_counter() - t0)
+            if status == 200:
+                results['ok'] += 1
+            elif status == 402:
+                results['no_balance'] += 1
+            elif status == 429:
+                results['rate_limited'] += 1
+            else:
+                results['error'] += 1
+
+    pool = Pool(args.concurrency)
+    t0 = time.perf_counter()
+    for _ in range(args.concurrency):
+        pool.spawn(sender)
+    pool.join()
+    elapsed = time.perf_counter() - t0
+    gevent.sleep(0)
+
+    pipe = r.pipeline(transaction=False)
+    for uid in users:
+        pipe.hget(f"user:{uid}", 'charm')
+    balances = [int(v or 0) for v in pipe.execute()]
+    pipe = r.pipeline(transaction=False)
+    for uid in users:
+        pipe.xlen(f"ledger:{uid}")
+    lengths = [int(v or 0) for v in pipe.execute()]
+    ledger_entries = sum(lengths)
+
+    latencies.sort()
+    pct = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else 0.0
+    total = len(latencies)
+    print(f"transfers={total} concurrency={args.concurrency} elapsed={elapsed:.2f}s "
+          f"throughput={results['ok'] / elapsed:.0f} transfers/s p50={pct(0.5):.1f}ms p99={pct(0.99):.1f}ms")
+    print(f"results={results}")
+    expected = args.users * args.balance
+    print(f"charms: expected={expected} actual={sum(balances)} negative={sum(1 for b in balances if b < 0)} "
+          f"ledger_entries={ledger_entries}")
+
+    conserved = sum(balances) == expected and min(balances) >= 0
+    # the ledger streams are capped, so entry counts only add up while none has been trimmed
+    trimmed = max(lengths) >= appmod.LEDGER_STREAM_MAXLEN
+    ledger_ok = trimmed or ledger_entries == 2 * results['ok']
+    print("conserved" if conserved else "NOT CONSERVED", "| ledger ok" if ledger_ok else "| LEDGER MISMATCH")
+
+    pipe = r.pipeline(transaction=False)
+    for uid in users:
+        pipe.delete(f"user:{uid}", f"ledger:{uid}")
+    pipe.zrem('leaderboard:charms', *users)
+    pipe.execute()
+    sys.exit(0 if conserved and ledger_ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -185,12 +185,5 @@ async function renderCollection() {
     }
 }
 
-// --- FRIENDS ---
-async function renderFriends() {
-    // Mock/Redis Fetch
-    const data = await apiCall(`/api/friends?user_id=${state.user.id}`);
-    // Render list...
-}
-
 // --- UTILS ---
 function showToast(msg) { alert(msg); } // Simple alert for now
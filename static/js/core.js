@@ -16,10 +16,14 @@ window.addEventListener('load', async () => {
     document.getElementById('profile-name').innerText = state.user.name;
     document.getElementById('profile-avatar').src = state.user.avatar;
 
-    // Load Settings & Balance
-    const res = await fetch(`/api/user_info?user_id=${state.user.id}`);
+    // Load profile, balance, settings and first-screen data in one call
+    const res = await fetch(`/api/bootstrap?user_id=${encodeURIComponent(state.user.id)}`);
     if(res.ok) {
-        const data = await res.json();
+        const boot = await res.json();
+        const data = boot.user || {};
+        state.prefetch = { history: boot.history };
+        Object.entries(boot.collection || {}).forEach(([type, page]) => { state.prefetch['collection:' + type] = page; });
+        if(boot.top) state.prefetch['top:' + boot.top.type] = boot.top;
         state.user.balance = data.balance;
         document.getElementById('balance-display').innerText = state.user.balance;
         
@@ -36,6 +40,14 @@ window.addEventListener('load', async () => {
     }
 });
 
+// Hand out data preloaded by /api/bootstrap once; later renders fetch fresh.
+function takePrefetched(key) {
+    if(!state.prefetch || !state.prefetch[key]) return null;
+    const data = state.prefetch[key];
+    delete state.prefetch[key];
+    return Object.assign({ ok: true }, data);
+}
+
 function navigateTo(viewId) {
     document.querySelectorAll('.view-section').forEach(el => el.classList.remove('active'));
     const target = document.getElementById(`view-${viewId}`);
@@ -47,6 +59,7 @@ function navigateTo(viewId) {
     if(viewId === 'history') renderHistory();
     if(viewId === 'collection') renderCollection('waifu');
     if(viewId === 'top') renderTop('waifu');
+    if(viewId === 'friends') renderFriends();
     if(viewId === 'profile') {
         document.getElementById('profile-name-lg').innerText = state.user.name;
         document.getElementById('profile-avatar-lg').src = state.user.avatar;
@@ -0,0 +1,100 @@
+// static/js/friends.js
+// Friends ranked by charms, incoming requests with accept buttons, and the
+// add-friend form. Names come from other users, so everything is escaped
+// (escapeHtml/escapeAttr from top.js).
+
+function friendRow(f, right) {
+  let avatar = f.avatar || null;
+  if (!avatar || String(avatar).trim() === '' || avatar.includes('picsum.photos')) {
+    avatar = DEFAULT_AVATAR;
+  }
+  const name = f.name || 'Traveler';
+  const username = f.username ? String(f.username).replace(/^@/, '') : null;
+  return `
+    <div class="glass-card" style="display:flex; align-items:center; gap:12px; padding:12px;">
+      <img src="${escapeAttr(avatar)}" onerror="this.onerror=null;this.src='${DEFAULT_AVATAR}';"
+           style="width:40px; height:40px; border-radius:50%; object-fit:cover; border:2px solid rgba(255,255,255,0.12);">
+      <div style="flex:1;">
+        <div style="font-weight:700; font-size:15px; color:#fff;">
+          ${escapeHtml(name)}
+          ${username ? `<span style="font-weight:400; font-size:12px; opacity:0.75; margin-left:6px;">@${escapeHtml(username)}</span>` : ''}
+        </div>
+        <div style="font-size:12px; opacity:0.7;">ID ${escapeHtml(String(f.user_id))}</div>
+      </div>
+      ${right}
+    </div>
+  `;
+}
+
+async function renderFriends() {
+  const list = document.getElementById('friends-list');
+  const requests = document.getElementById('friend-requests');
+  if (!list || !requests || !state.user) return;
+  list.innerHTML = '<div style="text-align:center; color:rgba(255,255,255,0.5);">Loading Friends...</div>';
+
+  let data = null;
+  try {
+    const res = await fetch(`/api/friends?user_id=${encodeURIComponent(state.user.id)}`);
+    data = await res.json();
+  } catch (err) {
+    console.error('Error fetching /api/friends', err);
+  }
+  if (!data || !data.ok) {
+    list.innerHTML = '<div style="text-align:center; color:red;">Error loading friends.</div>';
+    requests.innerHTML = '';
+    return;
+  }
+
+  const incoming = data.requests || [];
+  requests.innerHTML = incoming.length ? '<h3>Requests</h3>' + incoming.map(f => friendRow(f,
+    `<button class="glass-btn primary-btn" data-friend-id="${escapeAttr(f.user_id)}" onclick="acceptFriend(this.dataset.friendId)">Accept</button>`
+  )).join('') : '';
+
+  if (!Array.isArray(data.items) || data.items.length === 0) {
+    list.innerHTML = `
+      <div style="text-align:center; padding:20px; color:rgba(255,255,255,0.5);">
+        <i class="fa-solid fa-user-group" style="font-size:40px; margin-bottom:10px; display:block;"></i>
+        <p>No friends yet.</p>
+      </div>`;
+    return;
+  }
+  list.innerHTML = data.items.map(f => friendRow(f, `
+    <div style="text-align:right;">
+      <div style="font-family:var(--font-accent); color:var(--accent);">#${Number(f.rank) || ''}</div>
+      <div style="color:#ffd700; font-weight:bold; font-size:14px;">${Number(f.charms || 0).toLocaleString()}</div>
+    </div>`)).join('');
+}
+
+async function postFriend(endpoint, friendId) {
+  try {
+    const res = await fetch(endpoint, {
+      method: 'POST', headers: {'Content-Type': 'application/json'},
+      body: JSON.stringify({ user_id: state.user.id, friend_id: friendId })
+    });
+    return await res.json();
+  } catch (err) {
+    console.error(`Error posting ${endpoint}`, err);
+    return null;
+  }
+}
+
+async function sendFriendRequest() {
+  const input = document.getElementById('friend-id-input');
+  const friendId = (input.value || '').trim();
+  if (!friendId) return;
+  const data = await postFriend('/api/friends/add', friendId);
+  if (data && data.ok) {
+    input.value = '';
+    showToast(data.status === 'friends' ? 'You are now friends!' : 'Friend request sent');
+    renderFriends();
+  } else {
+    showToast((data && data.error) || 'Request failed');
+  }
+}
+
+// accepting is sending a request back: the server links both sides
+async function acceptFriend(friendId) {
+  const data = await postFriend('/api/friends/add', friendId);
+  showToast(data && data.ok ? 'Friend added!' : ((data && data.error) || 'Accept failed'));
+  renderFriends();
+}
@@ -59,8 +59,10 @@ function applyFilter() {
 async function buyMarket(id, price) {
     if(state.user.balance < price) return showToast("No Balance");
     if(confirm("Buy this item?")) {
+        // one key per confirmed purchase so retries/double taps are not charged twice
+        const key = (window.crypto && crypto.randomUUID) ? crypto.randomUUID() : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
         const res = await fetch('/api/buy_market', {
-            method: 'POST', headers:{'Content-Type':'application/json'},
+            method: 'POST', headers:{'Content-Type':'application/json', 'Idempotency-Key': key},
             body: JSON.stringify({ user_id: state.user.id, item_id: id })
         });
         const data = await res.json();
@@ -227,8 +227,11 @@ async function initProfile(user) {
 // ================= HISTORY (unchanged) =================
 async function renderHistory() {
     try {
-        const res = await fetch(`/api/history?user_id=${state.user.id}`);
-        const data = await res.json();
+        let data = (typeof takePrefetched === 'function') ? takePrefetched('history') : null;
+        if (!data) {
+            const res = await fetch(`/api/history?user_id=${state.user.id}`);
+            data = await res.json();
+        }
         const list = document.getElementById('history-list');
         if (!list) return;
         list.innerHTML = '';
@@ -253,7 +256,37 @@ async function renderHistory() {
     }
 }
 
-// ================= COLLECTION (fixed: no picsum fallback, skip missing images) =================
+// ================= COLLECTION (paged: follows next_cursor while the user scrolls) =================
+const COLLECTION_PAGE_SIZE = 100;
+let collectionRender = 0;      // bumps on every tab switch so stale pages are dropped
+let collectionObserver = null;
+
+function collectionCard(char) {
+    // Require server to provide img_url (my_collection does this). If missing, skip.
+    const imgUrl = char.img_url;
+    if (!imgUrl || typeof imgUrl !== 'string') return '';
+    return `
+        <div class="char-card-small">
+            <img 
+                src="${escapeAttr(imgUrl)}" 
+                class="char-img" 
+                loading="lazy"
+                onerror="this.onerror=null;this.src='/static/default.png';"
+            >
+            <div class="char-name">
+                ${escapeHtml(char.name || 'Unknown')}
+            </div>
+        </div>
+    `;
+}
+
+async function fetchCollectionPage(type, cursor) {
+    const params = new URLSearchParams({ user_id: state.user.id, type, limit: COLLECTION_PAGE_SIZE });
+    if (cursor) params.set('cursor', cursor);
+    const res = await fetch(`/api/my_collection?${params}`);
+    return await res.json();
+}
+
 async function renderCollection(type, ev = null) {
     const grid = document.getElementById('collection-grid');
     if (!grid) {
@@ -272,57 +305,72 @@ async function renderCollection(type, ev = null) {
         if (tab) tab.classList.add('active');
     }
 
+    const render = ++collectionRender;
+    if (collectionObserver) collectionObserver.disconnect();
+
     grid.innerHTML = `
         <p style="text-align:center; opacity:0.6;">
             Loading Collection...
         </p>
     `;
 
-    try {
-        const res = await fetch(
-            `/api/my_collection?user_id=${state.user.id}&type=${type}`
-        );
-        const data = await res.json();
-
-        grid.innerHTML = '';
+    // the sentinel sits after the cards; when it scrolls into view the next page loads
+    const sentinel = document.createElement('div');
+    sentinel.style.gridColumn = '1/-1';
+    let cursor = null;
+    let loading = false;
 
-        if (!data.ok || !data.items || data.items.length === 0) {
-            grid.innerHTML = `
-                <div style="text-align:center; grid-column:1/-1; opacity:0.6;">
-                    No characters yet.
-                </div>
-            `;
-            return;
-        }
-
-        data.items.forEach(char => {
-            // Require server to provide img_url (my_collection does this). If missing, skip.
-            const imgUrl = char.img_url;
-            if (!imgUrl || typeof imgUrl !== 'string') return;
-
-            grid.innerHTML += `
-                <div class="char-card-small">
-                    <img 
-                        src="${escapeAttr(imgUrl)}" 
-                        class="char-img" 
-                        loading="lazy"
-                        onerror="this.onerror=null;this.src='/static/default.png';"
-                    >
-                    <div class="char-name">
-                        ${escapeHtml(char.name || 'Unknown')}
+    const loadMore = async () => {
+        if (loading || render !== collectionRender) return;
+        loading = true;
+        try {
+            // the first page may come from /api/bootstrap's preview; paging continues from its cursor
+            const prefetched = (cursor === null && typeof takePrefetched === 'function') ? takePrefetched('collection:' + type) : null;
+            const data = prefetched || await fetchCollectionPage(type, cursor);
+            if (render !== collectionRender) return;
+            if (!data.ok) throw new Error(data.error || 'my_collection failed');
+            if (cursor === null) {
+                grid.innerHTML = '';
+                if (!data.items || data.items.length === 0) {
+                    grid.innerHTML = `
+                        <div style="text-align:center; grid-column:1/-1; opacity:0.6;">
+                            No characters yet.
+                        </div>
+                    `;
+                    return;
+                }
+                grid.appendChild(sentinel);
+            }
+            sentinel.insertAdjacentHTML('beforebegin', (data.items || []).map(collectionCard).join(''));
+            cursor = data.next_cursor;
+            if (!cursor) {
+                collectionObserver.disconnect();
+                sentinel.remove();
+            }
+        } catch (err) {
+            console.error("Error loading collection:", err);
+            if (render !== collectionRender) return;
+            if (cursor === null) {
+                grid.innerHTML = `
+                    <div style="text-align:center;">
+                        Error loading collection.
                     </div>
-                </div>
-            `;
-        });
+                `;
+            }
+        } finally {
+            loading = false;
+        }
+        // a short page may leave the sentinel visible without a new intersection event
+        if (cursor && render === collectionRender && sentinel.getBoundingClientRect().top < window.innerHeight) {
+            loadMore();
+        }
+    };
 
-    } catch (err) {
-        console.error("Error loading collection:", err);
-        grid.innerHTML = `
-            <div style="text-align:center;">
-                Error loading collection.
-            </div>
-        `;
-    }
+    collectionObserver = new IntersectionObserver(entries => {
+        if (entries.some(e => e.isIntersecting)) loadMore();
+    }, { rootMargin: '400px' });
+    collectionObserver.observe(sentinel);
+    await loadMore();
 }
 
 /* Small helpers used above (XSS safe insertion) */
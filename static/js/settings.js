@@ -1,3 +1,30 @@
+// Settings changes made close together are sent as one partial patch
+let pendingSettings = {};
+let settingsWaiters = [];
+let settingsTimer = null;
+function saveSettings(patch) {
+    Object.assign(pendingSettings, patch);
+    clearTimeout(settingsTimer);
+    settingsTimer = setTimeout(async () => {
+        const body = Object.assign({ user_id: state.user.id }, pendingSettings);
+        const waiters = settingsWaiters;
+        pendingSettings = {};
+        settingsWaiters = [];
+        let data = null;
+        try {
+            const res = await fetch('/api/update_settings', {
+                method: 'POST', headers:{'Content-Type':'application/json'},
+                body: JSON.stringify(body)
+            });
+            data = await res.json();
+        } catch (err) {
+            console.error("saveSettings error", err);
+        }
+        waiters.forEach(resolve => resolve(data));
+    }, 300);
+    return new Promise(resolve => settingsWaiters.push(resolve));
+}
+
 // Theme Persistence
 document.getElementById('theme-file').addEventListener('change', async (e) => {
     const file = e.target.files[0];
@@ -8,11 +35,8 @@ document.getElementById('theme-file').addEventListener('change', async (e) => {
             // Apply immediately
             document.getElementById('app-bg').style.backgroundImage = `url(${b64})`;
             // Save to DB
-            await fetch('/api/update_settings', {
-                method: 'POST', headers:{'Content-Type':'application/json'},
-                body: JSON.stringify({ user_id: state.user.id, theme_b64: b64 })
-            });
-            showToast("Theme Saved!");
+            const data = await saveSettings({ theme_b64: b64 });
+            showToast(data && data.ok ? "Theme Saved!" : ((data && data.error) || "Save failed"));
         };
         reader.readAsDataURL(file);
     }
@@ -29,14 +53,11 @@ document.getElementById('bgm-file').addEventListener('change', async (e) => {
         });
         
         // Save to DB
-        await fetch('/api/update_settings', {
-            method: 'POST', headers:{'Content-Type':'application/json'},
-            body: JSON.stringify({ user_id: state.user.id, bgm_b64: b64 })
-        });
+        const data = await saveSettings({ bgm_b64: b64 });
         
         // Play
         new Audio(b64).play();
-        showToast("BGM Saved!");
+        showToast(data && data.ok ? "BGM Saved!" : ((data && data.error) || "Save failed"));
     }
 });
 
@@ -44,8 +65,5 @@ document.getElementById('bgm-file').addEventListener('change', async (e) => {
 document.getElementById('lang-select').addEventListener('change', async (e) => {
     const lang = e.target.value;
     setLanguage(lang);
-    await fetch('/api/update_settings', {
-        method: 'POST', headers:{'Content-Type':'application/json'},
-        body: JSON.stringify({ user_id: state.user.id, lang: lang })
-    });
+    await saveSettings({ lang: lang });
 });
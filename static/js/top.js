@@ -36,10 +36,12 @@ async function renderTop(type = 'waifu', ev = null) {
     if (activeTab) activeTab.classList.add('active');
   }
 
-  let data;
+  let data = (typeof takePrefetched === 'function') ? takePrefetched('top:' + type) : null;
   try {
-    const res = await fetch(`/api/top?type=${encodeURIComponent(type)}&limit=100`);
-    data = await res.json();
+    if (!data) {
+      const res = await fetch(`/api/top?type=${encodeURIComponent(type)}&limit=100`);
+      data = await res.json();
+    }
   } catch (err) {
     console.error('Error fetching /api/top', err);
     list.innerHTML = '<div style="text-align:center; color:red;">Error loading top list.</div>';
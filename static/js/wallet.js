@@ -1,9 +1,7 @@
 async function renderQR() {
-    const res = await fetch(`/api/qr_code?user_id=${state.user.id}`);
-    const data = await res.json();
-    if(data.ok) {
-        document.getElementById('receive-qr').innerHTML = `<img src="data:image/png;base64,${data.image_b64}" style="border-radius:12px;">`;
-    }
+    // raw PNG: cached by the browser and no base64 inflation
+    const uid = encodeURIComponent(state.user.id);
+    document.getElementById('receive-qr').innerHTML = `<img src="/api/qr_code?user_id=${uid}&format=png" style="border-radius:12px;">`;
 }
 
 function openScanner() { 
@@ -14,14 +12,34 @@ function closeScanner() {
     document.getElementById('camera-view').style.display = 'none'; 
 }
 
-function sendCharms() {
-    const uid = document.getElementById('send-uid').value;
-    const amt = document.getElementById('send-amt').value;
+async function sendCharms() {
+    const uid = document.getElementById('send-uid').value.trim();
+    const amt = parseInt(document.getElementById('send-amt').value, 10);
     if(!uid || !amt) return alert("Fill all fields");
-    alert("Sending Logic (Mock): " + amt + " to " + uid);
+    if(amt <= 0) return showToast("Invalid amount");
+    if(state.user.balance !== undefined && state.user.balance < amt) return showToast("No Balance");
+    // one key per confirmed send so a retried request is never charged twice
+    const key = (window.crypto && crypto.randomUUID) ? crypto.randomUUID() : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    try {
+        const res = await fetch('/api/transfer', {
+            method: 'POST', headers: {'Content-Type': 'application/json', 'Idempotency-Key': key},
+            body: JSON.stringify({ user_id: state.user.id, to_user_id: uid, amount: amt })
+        });
+        const data = await res.json();
+        if(data.ok) {
+            state.user.balance = data.balance;
+            const el = document.getElementById('balance-display');
+            if(el) el.innerText = data.balance;
+            document.getElementById('send-amt').value = '';
+            showToast("Sent!");
+        } else { showToast(data.error || "Transfer failed"); }
+    } catch (err) {
+        console.error("sendCharms error", err);
+        showToast("Transfer failed");
+    }
 }
 
 // Init Swipe for Send
 initSwipe('send-swipe-container', () => {
-    alert("Swiped to send!");
+    sendCharms();
 });